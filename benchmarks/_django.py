@@ -0,0 +1,29 @@
+"""Boot the example project with a throwaway database and media root, for benchmarks that need models"""
+import shutil
+import tempfile
+
+import django
+from django.conf import settings
+
+from django_photos.django_photos.settings import get_settings
+
+
+def setup_django(**overrides):
+    media_root = tempfile.mkdtemp(prefix='photos-benchmark-')
+    options = get_settings()
+    options.update({
+        'DATABASES': {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+        'MEDIA_ROOT': media_root,
+        'DEBUG': False,
+    })
+    options.update(overrides)
+    settings.configure(**options)
+    django.setup()
+
+    from django.core.management import call_command
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    return media_root
+
+
+def teardown_django(media_root):
+    shutil.rmtree(media_root, ignore_errors=True)
@@ -0,0 +1,82 @@
+"""Storages that keep every file in a dict, to measure the pipeline without any disk I/O"""
+import threading
+import time
+from urllib.parse import urljoin
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage
+from django.utils.deconstruct import deconstructible
+from django.utils.encoding import filepath_to_uri
+
+
+@deconstructible
+class MemoryStorage(Storage):
+    def __init__(self, base_url='/memory/'):
+        self.base_url = base_url
+        self.files = {}
+        self._lock = threading.Lock()
+
+    def _open(self, name, mode='rb'):
+        try:
+            return ContentFile(self.files[name], name=name)
+        except KeyError:
+            raise FileNotFoundError(name)
+
+    def _save(self, name, content):
+        data = b''.join(content.chunks())
+        with self._lock:
+            self.files[name] = data
+        return name
+
+    def delete(self, name):
+        with self._lock:
+            self.files.pop(name, None)
+
+    def exists(self, name):
+        return name in self.files
+
+    def size(self, name):
+        return len(self.files[name])
+
+    def listdir(self, path):
+        prefix = path.rstrip('/') + '/' if path else ''
+        directories, files = set(), []
+        for name in self.files:
+            if name.startswith(prefix):
+                head, _, tail = name[len(prefix):].partition('/')
+                if tail:
+                    directories.add(head)
+                else:
+                    files.append(head)
+        return sorted(directories), sorted(files)
+
+    def url(self, name):
+        return urljoin(self.base_url, filepath_to_uri(name))
+
+
+@deconstructible
+class LatencyStorage(MemoryStorage):
+    """A MemoryStorage whose every call first waits latency seconds, like a round-trip to a remote storage"""
+    def __init__(self, latency=0.05, base_url='/memory/'):
+        super().__init__(base_url)
+        self.latency = latency
+
+    def _open(self, name, mode='rb'):
+        time.sleep(self.latency)
+        return super()._open(name, mode)
+
+    def _save(self, name, content):
+        time.sleep(self.latency)
+        return super()._save(name, content)
+
+    def delete(self, name):
+        time.sleep(self.latency)
+        super().delete(name)
+
+    def exists(self, name):
+        time.sleep(self.latency)
+        return super().exists(name)
+
+    def size(self, name):
+        time.sleep(self.latency)
+        return super().size(name)
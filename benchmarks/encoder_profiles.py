@@ -0,0 +1,90 @@
+"""
+Report the encode time and the output size of every encoder profile, for the renditions of a fixed set of sample
+images. Use it to pick the profiles of PHOTOS_IMAGE_SIZES.
+
+Run from the repository root: python -m benchmarks.encoder_profiles [--repeat 3] [--profile NAME ...]
+"""
+import argparse
+import random
+import time
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+from photos.renditions import iter_renditions, encode_image, supports_format
+
+from .renditions import SIZES, make_image
+
+PROFILES = {
+    'default': {},
+    'no-optimize': {'optimize': False},
+    'jpeg-q85-progressive': {'format': 'JPEG', 'quality': 85, 'progressive': True, 'strip_metadata': True},
+    'jpeg-q70-420': {'format': 'JPEG', 'quality': 70, 'subsampling': 2, 'optimize': False, 'strip_metadata': True},
+    'webp-q80': {'format': 'WEBP', 'quality': 80, 'strip_metadata': True},
+    'webp-q60': {'format': 'WEBP', 'quality': 60, 'strip_metadata': True},
+    'avif-q60': {'format': 'AVIF', 'quality': 60, 'strip_metadata': True},
+}
+
+
+def make_screenshot(width, height):
+    """A deterministic screenshot-like PNG: flat colours, text-like lines and sharp edges"""
+    rng = random.Random(0)
+    image = Image.new('RGB', (width, height), (245, 245, 245))
+    draw = ImageDraw.Draw(image)
+    for y in range(0, height, 24):
+        length = rng.randrange(width // 4, width)
+        draw.rectangle((16, y + 6, length, y + 14), fill=(rng.randrange(80), rng.randrange(80), rng.randrange(160)))
+    buffer = BytesIO()
+    image.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def make_noise(width, height):
+    """A deterministic worst case: every pixel is random, like film grain or foliage"""
+    rng = random.Random(0)
+    image = Image.frombytes('RGB', (width, height), bytes(rng.getrandbits(8) for _ in range(width * height * 3)))
+    buffer = BytesIO()
+    image.save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+SAMPLES = {
+    'photo 6000x4000 JPEG': lambda: make_image(6000, 4000, 'JPEG'),
+    'photo 3000x2000 PNG': lambda: make_image(3000, 2000, 'PNG'),
+    'screenshot 2560x1440 PNG': lambda: make_screenshot(2560, 1440),
+    'noise 1600x1200 JPEG': lambda: make_noise(1600, 1200),
+}
+
+
+def measure(renditions, original_format, profile, repeat):
+    """CPU seconds and bytes needed to encode all renditions once"""
+    image_format = profile.get('format', original_format)
+    start = time.process_time()
+    for _ in range(repeat):
+        total = sum(len(encode_image(rendition, image_format, profile)) for rendition in renditions)
+    return (time.process_time() - start) / repeat, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--profile', action='append', choices=sorted(PROFILES),
+                        help='Only measure these profiles, can be given more than once')
+    args = parser.parse_args()
+    profiles = {name: PROFILES[name] for name in (args.profile or PROFILES)
+                if supports_format(PROFILES[name].get('format', 'PNG'))}
+
+    print('{} sizes: {}'.format(len(SIZES), ', '.join('{}x{}'.format(*size) for size in SIZES)))
+    for sample, make in SAMPLES.items():
+        with Image.open(BytesIO(make())) as image:
+            original_format = image.format
+            renditions = [rendition.copy() for size, rendition in iter_renditions(image, SIZES)]
+        print()
+        print(sample)
+        for name, profile in profiles.items():
+            seconds, total = measure(renditions, original_format, profile, args.repeat)
+            print('  {:24} {:8.1f} ms CPU {:10,} bytes'.format(name, seconds * 1000, total))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Compare the installed image engines (see photos.engines): wall time, CPU time and peak memory to create and encode
+all renditions of one large photo. Every engine runs in its own fresh process, so the peak RSS is its own.
+
+Run from the repository root: python -m benchmarks.engines [--width 8000 --height 6000 --repeat 3]
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from django.conf import settings
+
+from .renditions import SIZES, make_image
+
+
+def configure():
+    # photos.engines only reads its settings, no apps or database are needed
+    if not settings.configured:
+        settings.configure()
+
+
+def run(path, engine_name, repeat):
+    from photos.engines import available_engines
+    engine = available_engines()[engine_name]
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    for _ in range(repeat):
+        with open(path, 'rb') as file, engine.open(file) as image:
+            image_format = engine.metadata(image)['format']
+            for size, rendition in engine.thumbnails(image, SIZES):
+                engine.encode(rendition, image_format)
+    return ((time.perf_counter() - wall) / repeat, (time.process_time() - cpu) / repeat,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--width', type=int, default=8000)
+    parser.add_argument('--height', type=int, default=6000)
+    parser.add_argument('--format', default='JPEG')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    configure()
+    from photos.engines import available_engines
+
+    with tempfile.NamedTemporaryFile(suffix='.' + args.format.lower(), delete=False) as file:
+        file.write(make_image(args.width, args.height, args.format))
+    try:
+        print('{} {}x{}, {} sizes'.format(args.format, args.width, args.height, len(SIZES)))
+        context = multiprocessing.get_context('spawn')  # A fresh process, with a fresh peak RSS
+        for name in available_engines():
+            with context.Pool(1, initializer=configure) as pool:
+                wall, cpu, rss = pool.apply(run, (file.name, name, args.repeat))
+            print('{:8} {:8.1f} ms wall {:8.1f} ms CPU {:8.1f} MiB peak RSS'.format(
+                name, wall * 1000, cpu * 1000, rss / 1024))
+    finally:
+        os.remove(file.name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""
+Time every stage of the processing pipeline on its own, on deterministic synthetic photos and zips, with an
+in-memory storage and with the local filesystem:
+
+    verify                  verify_header (the header check every uploaded file gets)
+    create_size             ImageModel._create_size, for every size
+    create_sizes            ImageModel._create_sizes
+    handle_zip              photo_processors.utils.handle_zip, serially
+    link_photos_to_gallery  BasePhotoProcessor.link_photos_to_gallery
+    render_photo_list       rendering photos/photomodel_list.html
+
+Results can be saved as JSON and compared to an earlier run, the exit status is 1 when a stage got slower than the
+threshold allows.
+
+Run from the repository root:
+    python -m benchmarks.pipeline [--storage memory --repeat 5 --output results.json --compare old.json]
+"""
+import argparse
+import json
+import multiprocessing
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+from io import BytesIO
+from uuid import uuid4
+
+from benchmarks._django import setup_django, teardown_django
+from benchmarks.samples import make_photo, make_zip
+
+STORAGES = ('memory', 'filesystem')
+# (width, height, format) of the photos the single photo stages run on
+PHOTOS = ((640, 480, 'JPEG'), (1920, 1080, 'PNG'), (4000, 3000, 'JPEG'))
+# (members, width, height) of the zips
+ZIPS = ((10, 1024, 768), (4, 3000, 2000))
+# Photos in the gallery that is linked and rendered
+GALLERY_PHOTOS = 40
+
+
+def timed(function, repeat, setup=None, teardown=None):
+    """Wall seconds of every call of function, setup and teardown run before and after each call, untimed"""
+    runs = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        runs.append(time.perf_counter() - start)
+        if teardown is not None:
+            teardown()
+    return runs
+
+
+def _store_photo(data, name):
+    from django.core.files.base import ContentFile
+    from photos.models import PHOTO_MODEL
+
+    photo = PHOTO_MODEL(image=ContentFile(data, name=name))
+    photo.save(process=False)
+    return photo
+
+
+def _forget_renditions(photo):
+    for entry in photo.renditions.get('sizes', {}).values():
+        for name in [entry['name']] + [variant['name'] for variant in entry.get('formats', {}).values()]:
+            photo.image.storage.delete(name)
+    photo.renditions = {}
+    photo.perceptual_hash = ''  # Only photos without a hash are hashed, every run should hash like a new upload
+
+
+def _delete_photos():
+    from photos.models import PHOTO_MODEL
+    for photo in PHOTO_MODEL.objects.all():
+        photo.delete()
+
+
+def bench_photos(repeat):
+    from photos.models import IMAGE_SIZES
+    from photos.photo_processors.utils import verify_header
+
+    for width, height, image_format in PHOTOS:
+        case = '{}x{} {}'.format(width, height, image_format)
+        data = make_photo(width, height, image_format)
+        yield 'verify', case, timed(lambda: verify_header(BytesIO(data)), repeat)
+
+        photo = _store_photo(data, 'photo.{}'.format(image_format.lower()))
+        for size_name, size in IMAGE_SIZES.items():
+            yield 'create_size', '{} {}'.format(case, size_name), timed(
+                lambda: photo._create_size(size), repeat, teardown=lambda: _forget_renditions(photo))
+        yield 'create_sizes', case, timed(photo._create_sizes, repeat, teardown=lambda: _forget_renditions(photo))
+        photo.delete()
+
+
+def bench_zips(repeat):
+    from photos.photo_processors.utils import handle_zip
+
+    for members, width, height in ZIPS:
+        data = make_zip(members, width, height)
+        yield 'handle_zip', '{} x {}x{} JPEG'.format(members, width, height), timed(
+            lambda: handle_zip(BytesIO(data), uuid4(), workers=1), repeat, teardown=_delete_photos)
+
+
+def bench_gallery(repeat):
+    from django.template.loader import render_to_string
+    from photos.models import PHOTO_MODEL, GALLERY_MODEL, UploadedPhotoModel
+    from photos.photo_processors.base_processor import get_photo_processor
+
+    photos = [_store_photo(make_photo(640, 480, seed=i), 'photo{}.jpg'.format(i)) for i in range(GALLERY_PHOTOS)]
+    for photo in photos:
+        photo.update_sizes()
+        photo.save(process=False)
+    gallery = GALLERY_MODEL.objects.create(title='Benchmark', slug='benchmark')
+    upload_id = uuid4()
+    case = '{} photos'.format(GALLERY_PHOTOS)
+
+    def stage():
+        gallery.photos.clear()
+        UploadedPhotoModel.objects.bulk_create([UploadedPhotoModel(upload_id=upload_id, photo=photo)
+                                                for photo in photos])
+
+    yield 'link_photos_to_gallery', case, timed(
+        lambda: get_photo_processor().link_photos_to_gallery(upload_id, gallery), repeat, setup=stage)
+
+    photo_list = list(PHOTO_MODEL.objects.order_by('-created_at'))
+    yield 'render_photo_list', case, timed(
+        lambda: render_to_string('photos/photomodel_list.html', {'photo_list': photo_list}), repeat)
+    gallery.delete()
+    _delete_photos()
+
+
+def run_storage(storage, repeat):
+    """Runs in a fresh process: the storage is read from the settings when photos.models is imported"""
+    overrides = {}
+    if storage == 'memory':
+        from benchmarks._storage import MemoryStorage
+        overrides['PHOTOS_IMAGE_STORAGE'] = MemoryStorage()
+    media_root = setup_django(**overrides)
+    try:
+        results = []
+        for bench in (bench_photos, bench_zips, bench_gallery):
+            for stage, case, runs in bench(repeat):
+                results.append({'storage': storage, 'stage': stage, 'case': case, 'runs': runs,
+                                'min': min(runs), 'median': statistics.median(runs)})
+                print('{:10} {:24} {:32} {:9.2f} ms median'.format(storage, stage, case, results[-1]['median'] * 1000),
+                      flush=True)
+        return results
+    finally:
+        teardown_django(media_root)
+
+
+def environment():
+    import django
+    import PIL
+    return {'python': platform.python_version(), 'django': django.get_version(), 'pillow': PIL.__version__,
+            'platform': platform.platform(), 'created_at': datetime.now(timezone.utc).isoformat()}
+
+
+def compare(results, baseline, threshold):
+    """Print the change of every median against baseline, return whether one got slower than the threshold allows"""
+    old = {(result['storage'], result['stage'], result['case']): result['median'] for result in baseline['results']}
+    regressed = False
+    print()
+    print('Compared to {}'.format(baseline['environment'].get('created_at', 'the baseline')))
+    for result in results:
+        key = (result['storage'], result['stage'], result['case'])
+        if key not in old:
+            continue
+        ratio = result['median'] / old[key]
+        slower = ratio > 1 + threshold
+        regressed = regressed or slower
+        print('{:10} {:24} {:32} {:+7.1%}{}'.format(*key, ratio - 1, '  REGRESSION' if slower else ''))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--storage', action='append', choices=STORAGES,
+                        help='Only run with this storage, can be given more than once')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='Save the results to this JSON file')
+    parser.add_argument('--compare', help='Compare the results to this JSON file of an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Medians that got slower by more than this fraction count as a regression')
+    args = parser.parse_args()
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for storage in args.storage or STORAGES:
+        with context.Pool(1) as pool:
+            results.extend(pool.apply(run_storage, (storage, args.repeat)))
+
+    document = {'environment': environment(), 'repeat': args.repeat, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(document, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            if compare(results, json.load(file), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
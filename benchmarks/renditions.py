@@ -0,0 +1,67 @@
+"""
+Compare the CPU time needed to create all renditions of one photo with the old per-size decoding and with the
+single-decode cascade of photos.renditions.
+
+Run from the repository root: python -m benchmarks.renditions [--width 6000 --height 4000 --repeat 5]
+"""
+import argparse
+import time
+from io import BytesIO
+
+from PIL import Image
+
+from photos.renditions import iter_renditions, encode_image
+
+SIZES = ((100, 100), (500, 500), (1920, 1080))  # admin_thumbnail, display and hd
+
+
+def make_image(width, height, image_format='JPEG'):
+    """A deterministic photo-like image: gradients in every channel, so the encoder has real work to do"""
+    red = Image.linear_gradient('L').resize((width, height))
+    green = Image.radial_gradient('L').resize((width, height))
+    blue = red.transpose(Image.ROTATE_90).resize((width, height))
+    buffer = BytesIO()
+    Image.merge('RGB', (red, green, blue)).save(buffer, image_format, quality=90)
+    return buffer.getvalue()
+
+
+def per_size(data):
+    for size in SIZES:
+        with Image.open(BytesIO(data)) as image:
+            image.thumbnail(size, Image.ANTIALIAS)
+            encode_image(image, image.format)
+
+
+def cascade(data):
+    with Image.open(BytesIO(data)) as image:
+        for size, rendition in iter_renditions(image, SIZES):
+            encode_image(rendition, image.format)
+
+
+def measure(function, data, repeat):
+    function(data)  # warm up
+    start = time.process_time()
+    for _ in range(repeat):
+        function(data)
+    return (time.process_time() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--width', type=int, default=6000)
+    parser.add_argument('--height', type=int, default=4000)
+    parser.add_argument('--format', default='JPEG')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    data = make_image(args.width, args.height, args.format)
+    old = measure(per_size, data, args.repeat)
+    new = measure(cascade, data, args.repeat)
+    print('{} {}x{}, {} sizes'.format(args.format, args.width, args.height, len(SIZES)))
+    print('per-size decode: {:8.1f} ms CPU per photo'.format(old * 1000))
+    print('cascade:         {:8.1f} ms CPU per photo'.format(new * 1000))
+    print('saved:           {:8.1f} ms CPU per photo ({:.0%})'.format((old - new) * 1000, 1 - new / old))
+
+
+if __name__ == '__main__':
+    main()
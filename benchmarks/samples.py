@@ -0,0 +1,37 @@
+"""Deterministic synthetic photos and zips for the benchmarks: the same arguments always give the same bytes"""
+import random
+import zipfile
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+
+def make_photo(width, height, image_format='JPEG', seed=0):
+    """
+    A photo-like image: gradients in every channel with some seeded shapes on top, so the encoder has real work
+    to do and photos with another seed have other content (and another content hash).
+    """
+    rng = random.Random(seed)
+    red = Image.linear_gradient('L').resize((width, height))
+    green = Image.radial_gradient('L').resize((width, height))
+    blue = red.transpose(Image.ROTATE_90).resize((width, height))
+    image = Image.merge('RGB', (red, green, blue))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randrange(width), rng.randrange(height)
+        radius = rng.randrange(max(width, height) // 20 + 1, max(width, height) // 4 + 2)
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius),
+                     fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    buffer = BytesIO()
+    image.save(buffer, image_format, quality=90)
+    return buffer.getvalue()
+
+
+def make_zip(members, width, height, image_format='JPEG'):
+    """A zip of members different photos, stored without compression like most photo zips"""
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as zip_file:
+        for i in range(members):
+            zip_file.writestr('photo{:04}.{}'.format(i, image_format.lower()),
+                              make_photo(width, height, image_format, seed=i))
+    return buffer.getvalue()
@@ -0,0 +1,48 @@
+"""
+Time creating all sizes of a photo on a storage that adds a fixed latency to every call, like a remote storage
+would, with different amounts of PHOTOS_STORAGE_WORKERS (the threads that store the renditions while the next ones
+are encoded). Every amount runs in a fresh process, the settings are read when photos.models is imported.
+
+Run from the repository root:
+    python -m benchmarks.storage_latency [--latency 50 --workers 1 2 4 8 --repeat 3]
+"""
+import argparse
+import multiprocessing
+import statistics
+
+from benchmarks._django import setup_django, teardown_django
+from benchmarks.pipeline import timed, _store_photo, _forget_renditions
+from benchmarks.samples import make_photo
+
+
+def run(workers, latency, width, height, repeat):
+    from benchmarks._storage import LatencyStorage
+    media_root = setup_django(PHOTOS_IMAGE_STORAGE=LatencyStorage(latency), PHOTOS_STORAGE_WORKERS=workers)
+    try:
+        from photos.models import IMAGE_SIZES, EXTRA_FORMATS
+        photo = _store_photo(make_photo(width, height), 'photo.jpg')
+        runs = timed(photo._create_sizes, repeat, teardown=lambda: _forget_renditions(photo))
+        return statistics.median(runs), len(IMAGE_SIZES) * (1 + len(EXTRA_FORMATS))
+    finally:
+        teardown_django(media_root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency', type=float, default=50, help='Milliseconds every storage call takes')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--width', type=int, default=3000)
+    parser.add_argument('--height', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    for workers in args.workers:
+        with context.Pool(1) as pool:
+            median, files = pool.apply(run, (workers, args.latency / 1000, args.width, args.height, args.repeat))
+        print('{:2} storage workers {:9.1f} ms median for {} files, {} ms latency each'.format(
+            workers, median * 1000, files, args.latency), flush=True)
+
+
+if __name__ == '__main__':
+    main()
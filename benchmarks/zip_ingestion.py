@@ -0,0 +1,51 @@
+"""
+Measure the wall time handle_zip needs for a zip of N photos, serially and with a process pool.
+
+Run from the repository root: python -m benchmarks.zip_ingestion [--photos 24 --workers 4]
+"""
+import argparse
+import os
+import time
+from io import BytesIO
+from uuid import uuid4
+
+from benchmarks._django import setup_django, teardown_django
+from benchmarks.samples import make_zip
+
+
+def measure(data, workers):
+    from photos.models import PHOTO_MODEL
+    from photos.photo_processors.utils import handle_zip
+
+    start = time.perf_counter()
+    handle_zip(BytesIO(data), uuid4(), workers=workers)
+    elapsed = time.perf_counter() - start
+    for photo in PHOTO_MODEL.objects.all():
+        photo.delete()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--photos', type=int, default=24)
+    parser.add_argument('--width', type=int, default=3000)
+    parser.add_argument('--height', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    media_root = setup_django()
+    try:
+        data = make_zip(args.photos, args.width, args.height)
+        serial = measure(data, 1)
+        parallel = measure(data, args.workers)
+    finally:
+        teardown_django(media_root)
+
+    print('{} photos of {}x{}'.format(args.photos, args.width, args.height))
+    print('serial:       {:6.2f} s'.format(serial))
+    print('{:2} workers:   {:6.2f} s'.format(args.workers, parallel))
+    print('speedup:      {:6.2f}x'.format(serial / parallel))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,12 +3,12 @@ from django.contrib.admin.utils import model_ngettext
 from django.http import HttpResponseRedirect
 from django.template.response import TemplateResponse
 from django.contrib.admin import helpers
-from .models import PHOTO_MODEL, GALLERY_MODEL
+from .models import PHOTO_MODEL, GALLERY_MODEL, SIMILARITY_MAX_DISTANCE
 from django.urls import path
+from django.utils.http import urlencode
 from .views import UploadPhotoAdminApiView
 from .forms import SinglePhotoForm, GalleryForm
 from django.utils.translation import ugettext_lazy as _
-from django.db.models import Count
 from .photo_processors.base_processor import get_photo_processor, PhotoProcessingError
 from django.contrib import messages
 
@@ -23,9 +23,11 @@ class PhotoAdmin(admin.ModelAdmin):
     list_per_page = 20
     list_display = ('image_filename', 'admin_thumbnail_tag')
     form = SinglePhotoForm
+    actions = ('find_similar_photos',)
 
     def get_queryset(self, request):
-        return PHOTO_MODEL.objects.filter(uploaded_photo__isnull=True)
+        # Photos staged again by a duplicate upload already exist, only photos created by an upload are pending
+        return PHOTO_MODEL.objects.exclude(uploaded_photo__created_photo=True)
 
     @staticmethod
     def photo_admin_context(context):
@@ -38,24 +40,37 @@ class PhotoAdmin(admin.ModelAdmin):
         return context
 
     def delete_queryset(self, request, queryset):
-        for photo in queryset:
-            photo.delete_all_files()
-        super().delete_queryset(request, queryset)
+        get_photo_processor().delete_photos(queryset)
+
+    def find_similar_photos(self, request, queryset):
+        # One index for all selected photos, every lookup only visits a small part of it
+        index = self.get_queryset(request).similarity_index()
+        selected = {photo.pk: photo.perceptual_hash for photo in queryset.only('pk', 'perceptual_hash')}
+        similar = set(selected)
+        for perceptual_hash in selected.values():
+            if perceptual_hash:
+                similar.update(pk for distance, pk in index.search(perceptual_hash, SIMILARITY_MAX_DISTANCE))
+
+        if similar == set(selected):
+            self.message_user(request, _('No similar photos were found.'), messages.INFO)
+            return None
+        return HttpResponseRedirect('?{}'.format(urlencode({'pk__in': ','.join(str(pk) for pk in similar)})))
+
+    find_similar_photos.short_description = _('Show selected photos and similar ones')
 
 
 class GalleryAdmin(admin.ModelAdmin):
     list_per_page = 20
-    list_display = ('__str__', 'random_photo_tag', 'count_photos')
+    list_display = ('__str__', 'cover_photo_tag', 'count_photos')
+    list_select_related = ('cover_photo',)
     form = GalleryForm
     actions = ('delete_with_photos',)
 
-    def get_queryset(self, request):
-        return GALLERY_MODEL.objects.all().annotate(count_photos=Count('photos'))
-
     def count_photos(self, obj):
-        return obj.count_photos
+        return obj.photo_count
 
     count_photos.short_description = _('Photos')
+    count_photos.admin_order_field = 'photo_count'
 
     def get_urls(self):
         custom_urls = [
@@ -76,17 +91,19 @@ class GalleryAdmin(admin.ModelAdmin):
 
     def _delete_with_photos(self, request):
         ids = [id for id in request.POST.getlist('id[]', [])]
-        queryset = GALLERY_MODEL.objects.filter(id__in=ids)
+        galleries = list(GALLERY_MODEL.objects.filter(id__in=ids))
 
-        photos = PHOTO_MODEL.objects.filter(galleries__id__in=ids)
+        # Duplicate uploads share one photo, photos that other galleries still show are kept
+        photos = PHOTO_MODEL.objects.filter(galleries__id__in=ids) \
+            .exclude(galleries__in=GALLERY_MODEL.objects.exclude(id__in=ids))
         try:
             get_photo_processor().delete_photos(photos)
         except PhotoProcessingError as e:
             messages.add_message(request, messages.ERROR, _(e.message))
 
-        queryset.delete()
+        GALLERY_MODEL.objects.filter(id__in=ids).delete()
 
-        for gallery in queryset:
+        for gallery in galleries:
             self.log_deletion(request, gallery, str(gallery))
 
         return HttpResponseRedirect('..')
@@ -0,0 +1,92 @@
+import os
+import tempfile
+from uuid import UUID
+
+from django.conf import settings
+from django.core.files.base import File
+
+from .exceptions import PhotoProcessingError
+
+# Chunks are written to local files, so every chunk of a file has to reach the same server
+CHUNKED_UPLOAD_DIR = getattr(settings, 'PHOTOS_CHUNKED_UPLOAD_DIR',
+                             os.path.join(tempfile.gettempdir(), 'photos-chunked-uploads'))
+# Largest file, in bytes, that can be uploaded in chunks
+MAX_UPLOAD_SIZE = getattr(settings, 'PHOTOS_MAX_UPLOAD_SIZE', 1024 * 1024 * 1024)
+
+
+class AssembledFile(File):
+    """A completely uploaded file. Like a TemporaryUploadedFile, storages can move it instead of copying it."""
+    def temporary_file_path(self):
+        return self.file.name
+
+
+class ChunkedUpload:
+    """
+    A file that is uploaded in chunks, identified by the upload_id of the form and a uuid per file.
+    Every chunk is written at its offset in one temporary file, so the file is complete as soon as the last chunk
+    arrives. The indices of the stored chunks are kept next to it, so an interrupted upload can be resumed.
+    """
+    def __init__(self, upload_id, file_uuid):
+        try:
+            self.directory = os.path.join(CHUNKED_UPLOAD_DIR, str(UUID(str(upload_id))))
+            self.path = os.path.join(self.directory, str(UUID(str(file_uuid))))
+        except ValueError:
+            raise PhotoProcessingError('Invalid upload')
+        self.index_path = self.path + '.chunks'
+
+    @staticmethod
+    def validate_chunk(index, offset, chunk, chunk_size, total_chunks, total_size):
+        """Raise a PhotoProcessingError unless chunk is chunk index of a file of total_size in total_chunks chunks"""
+        if not 0 < total_size <= MAX_UPLOAD_SIZE:
+            raise PhotoProcessingError('The file is too large' if total_size > 0 else 'Invalid chunk')
+        if chunk_size <= 0 or total_chunks != -(-total_size // chunk_size) or not 0 <= index < total_chunks \
+                or offset != index * chunk_size or chunk.size != min(chunk_size, total_size - offset):
+            raise PhotoProcessingError('Invalid chunk')
+
+    def write_chunk(self, index, offset, chunk, chunk_size, total_chunks, total_size):
+        self.validate_chunk(index, offset, chunk, chunk_size, total_chunks, total_size)
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o600)
+        with os.fdopen(fd, 'wb') as file:
+            file.seek(offset)
+            for data in chunk.chunks():
+                file.write(data)
+        # Only recorded once the data was written, a chunk that failed halfway is sent again
+        with open(self.index_path, 'a') as index_file:
+            index_file.write('{}\n'.format(index))
+
+    def received_chunks(self):
+        try:
+            with open(self.index_path) as index_file:
+                return sorted({int(line) for line in index_file if line.strip()})
+        except FileNotFoundError:
+            return []
+
+    def next_chunk(self):
+        received = set(self.received_chunks())
+        index = 0
+        while index in received:
+            index += 1
+        return index
+
+    def status(self):
+        return {'received_chunks': self.received_chunks(), 'next_chunk': self.next_chunk()}
+
+    def is_complete(self, total_chunks, total_size):
+        if self.received_chunks() != list(range(total_chunks)):
+            return False
+        return os.path.getsize(self.path) == total_size
+
+    def open(self, name):
+        return AssembledFile(open(self.path, 'rb'), name=name)
+
+    def delete(self):
+        for path in (self.path, self.index_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:  # The storage might have moved the file
+                pass
+        try:
+            os.rmdir(self.directory)
+        except OSError:  # Other files of this upload are still in progress
+            pass
@@ -0,0 +1,31 @@
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .base import BaseEngine
+
+# Dotted path of the engine that creates the renditions, e.g. 'photos.engines.vips.VipsEngine' (needs pyvips)
+IMAGE_ENGINE = getattr(settings, 'PHOTOS_IMAGE_ENGINE', 'photos.engines.pillow.PillowEngine')
+ENGINES = ('photos.engines.pillow.PillowEngine', 'photos.engines.vips.VipsEngine')
+
+
+@lru_cache(maxsize=None)
+def load_engine(path) -> BaseEngine:
+    return import_string(path)()
+
+
+def get_engine() -> BaseEngine:
+    return load_engine(IMAGE_ENGINE)
+
+
+def available_engines():
+    """The engines of ENGINES whose libraries are installed, by name"""
+    engines = {}
+    for path in ENGINES:
+        try:
+            engine = load_engine(path)
+        except (ImportError, OSError):  # OSError: pyvips is installed, libvips isn't
+            continue
+        engines[engine.name] = engine
+    return engines
@@ -0,0 +1,45 @@
+class BaseEngine:
+    """
+    Everything photos does with image data goes through an engine. Images and renditions are the engine's own
+    objects, only the engine itself looks inside them.
+    Formats are named like Pillow names them ('JPEG', 'PNG', 'WEBP', ...), whatever the engine uses internally, since
+    they are stored in the renditions manifest and used in the settings.
+    Files that can't be read as an image raise an OSError.
+    """
+    name = None
+
+    def supports_format(self, image_format):
+        """Whether this engine can encode image_format"""
+        raise NotImplementedError
+
+    def open(self, file):
+        """A context manager giving the image in file. Only the header has to be read."""
+        raise NotImplementedError
+
+    def verify(self, file):
+        """Raise an OSError if file isn't an image, then seek back to the start of file"""
+        raise NotImplementedError
+
+    def metadata(self, image):
+        """A dict with the width, height and format of image"""
+        raise NotImplementedError
+
+    def thumbnails(self, image, sizes, low_memory=False, budget=None):
+        """
+        Yield (size, rendition) for every size (a box) in sizes, from the largest rendition to the smallest. Every
+        rendition fits in its box, keeps the aspect ratio and has the dimensions photos.renditions.fit_size gives.
+        The decoded pixels are reserved from budget, a PixelBudget, if one is given.
+        """
+        raise NotImplementedError
+
+    def rendition_size(self, rendition):
+        """The (width, height) of a rendition"""
+        raise NotImplementedError
+
+    def encode(self, rendition, image_format, profile=None):
+        """The bytes of rendition in image_format, see photos.renditions.encoder_options for the profile"""
+        raise NotImplementedError
+
+    def perceptual_hash(self, rendition):
+        """The difference hash of rendition, see photos.similarity"""
+        raise NotImplementedError
@@ -0,0 +1,42 @@
+from PIL import Image
+
+from .. import metrics
+from ..renditions import iter_renditions, encode_image, supports_format
+from ..similarity import perceptual_hash
+from .base import BaseEngine
+
+
+class PillowEngine(BaseEngine):
+    """The default engine. Renditions are made with the single-decode cascade of photos.renditions."""
+    name = 'pillow'
+
+    def supports_format(self, image_format):
+        return supports_format(image_format)
+
+    def open(self, file):
+        return Image.open(file)
+
+    def verify(self, file):
+        with Image.open(file):
+            pass
+        file.seek(0)
+
+    def metadata(self, image):
+        return {'width': image.width, 'height': image.height, 'format': image.format}
+
+    def thumbnails(self, image, sizes, low_memory=False, budget=None):
+        decoded = False
+        for size, rendition in iter_renditions(image, sizes, low_memory, budget, timer=metrics.timer):
+            if not decoded:  # The image now has the size it was decoded at
+                metrics.increment('photos_pixels_decoded_total', image.width * image.height)
+                decoded = True
+            yield size, rendition
+
+    def rendition_size(self, rendition):
+        return rendition.size
+
+    def encode(self, rendition, image_format, profile=None):
+        return encode_image(rendition, image_format, profile)
+
+    def perceptual_hash(self, rendition):
+        return perceptual_hash(rendition)
@@ -0,0 +1,147 @@
+import pyvips
+
+from .. import metrics
+from ..renditions import PixelBudget, fit_size
+from ..similarity import difference_hash, HASH_SIZE
+from .base import BaseEngine
+
+# Pillow's names of the formats libvips loads, by the name of the loader
+_LOADER_FORMATS = {'jpegload': 'JPEG', 'pngload': 'PNG', 'webpload': 'WEBP', 'gifload': 'GIF', 'tiffload': 'TIFF',
+                   'heifload': 'HEIF', 'jp2kload': 'JPEG2000'}
+# The suffix libvips picks the saver by, for every format it can encode
+_FORMAT_SUFFIXES = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp', 'AVIF': '.avif', 'HEIF': '.heic', 'GIF': '.gif',
+                    'TIFF': '.tif', 'JPEG2000': '.jp2'}
+
+
+def _source(file):
+    """A libvips source that reads file from its start, in the chunks libvips asks for, instead of all at once"""
+    file.seek(0)
+    source = pyvips.SourceCustom()
+    source.on_read(file.read)
+
+    def seek(offset, whence):
+        try:
+            return file.seek(offset, whence)
+        except (AttributeError, OSError, ValueError):
+            return -1  # Not seekable, libvips buffers what it has to read again
+    source.on_seek(seek)
+    return source
+
+
+class _VipsImage:
+    """An opened file: its header, and the path or the file libvips decodes the renditions from"""
+    def __init__(self, file):
+        self.path, self.file = None, None
+        try:
+            self.path = file.path  # Storages that have local files let libvips stream from disk
+        except (AttributeError, NotImplementedError, ValueError):
+            self.file = file  # Other storages are streamed through a source, the file isn't read into memory
+        try:
+            if self.path is not None:
+                self.header = pyvips.Image.new_from_file(self.path, access='sequential')
+            else:
+                self.header = pyvips.Image.new_from_source(_source(self.file), '', access='sequential')
+        except pyvips.Error as e:
+            raise OSError('cannot identify image file: {}'.format(e))
+
+    def thumbnail(self, dimensions):
+        """Decode a rendition of dimensions, letting the loader shrink while decoding where the format allows it"""
+        options = {'height': dimensions[1], 'size': 'down', 'no_rotate': True}
+        try:
+            if self.path is not None:
+                return pyvips.Image.thumbnail(self.path, dimensions[0], **options)
+            # A new source, as the one of the header was read sequentially
+            return pyvips.Image.thumbnail_source(_source(self.file), dimensions[0], **options)
+        except pyvips.Error as e:
+            raise OSError(str(e))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.file = None
+
+
+def _resize(image, dimensions):
+    if (image.width, image.height) == tuple(dimensions):
+        return image
+    return image.resize(dimensions[0] / image.width, vscale=dimensions[1] / image.height, kernel='lanczos3')
+
+
+class VipsEngine(BaseEngine):
+    """
+    An engine on libvips, through pyvips. Originals are streamed: the largest rendition is decoded straight at its own
+    scale, the smaller ones are resized from it in memory, so the full resolution bitmap never exists.
+    """
+    name = 'vips'
+
+    def supports_format(self, image_format):
+        suffix = _FORMAT_SUFFIXES.get(image_format.upper())
+        return suffix is not None and suffix in pyvips.get_suffixes()
+
+    def open(self, file):
+        return _VipsImage(file)
+
+    def verify(self, file):
+        _VipsImage(file)
+        file.seek(0)
+
+    def metadata(self, image):
+        loader = image.header.get('vips-loader').split('_')[0]
+        image_format = _LOADER_FORMATS.get(loader, loader.replace('load', '').upper())
+        if image_format == 'HEIF' and image.header.get_typeof('heif-compression') \
+                and image.header.get('heif-compression') == 'av1':
+            image_format = 'AVIF'
+        return {'width': image.header.width, 'height': image.header.height, 'format': image_format}
+
+    def thumbnails(self, image, sizes, low_memory=False, budget=None):
+        # low_memory makes no difference, libvips always decodes at the scale of the largest rendition
+        original_size = (image.header.width, image.header.height)
+        targets = [(fit_size(original_size, size), size) for size in dict.fromkeys(sizes)]
+        targets.sort(key=lambda target: target[0][0] * target[0][1], reverse=True)
+        if not targets:
+            return
+
+        budget = budget or PixelBudget()
+        largest = targets[0][0]
+        with budget.reserve(largest[0] * largest[1]):
+            with metrics.timer('decode'):
+                source = _resize(image.thumbnail(largest), largest).copy_memory()
+            metrics.increment('photos_pixels_decoded_total', largest[0] * largest[1])
+            original = source
+            for dimensions, size in targets:
+                if source.width < dimensions[0] or source.height < dimensions[1]:
+                    source = original
+                with metrics.timer('resize', box='{}x{}'.format(*size)):
+                    rendition = _resize(source, dimensions).copy_memory()
+                yield size, rendition
+                source = rendition
+
+    def rendition_size(self, rendition):
+        return rendition.width, rendition.height
+
+    def encode(self, rendition, image_format, profile=None):
+        profile = profile or {}
+        image_format = image_format.upper()
+        options = {}
+        if 'quality' in profile and image_format in ('JPEG', 'WEBP', 'AVIF', 'HEIF', 'JPEG2000'):
+            options['Q'] = profile['quality']
+        if image_format == 'JPEG':
+            options['optimize_coding'] = profile.get('optimize', True)
+            if profile.get('progressive'):
+                options['interlace'] = True
+            if 'subsampling' in profile:  # Pillow's 0 is 4:4:4, everything else subsamples the chroma
+                options['subsample_mode'] = 'off' if profile['subsampling'] == 0 else 'on'
+        elif image_format == 'PNG' and profile.get('optimize', True):
+            options['compression'] = 9
+        if profile.get('strip_metadata'):
+            options['strip'] = True
+        try:
+            return rendition.write_to_buffer(_FORMAT_SUFFIXES[image_format], **options)
+        except (KeyError, pyvips.Error) as e:
+            raise OSError("Can't encode {}: {}".format(image_format, e))
+
+    def perceptual_hash(self, rendition):
+        grid = rendition.colourspace('b-w')[0]
+        grid = grid.resize((HASH_SIZE + 1) / grid.width, vscale=HASH_SIZE / grid.height, kernel='lanczos3')
+        return difference_hash(list(grid.cast('uchar').write_to_memory()))
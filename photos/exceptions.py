@@ -0,0 +1,8 @@
+class PhotoProcessingError(Exception):
+    """An exception that can be raised when you want to output an error to the user"""
+    def __init__(self, message):
+        self.message = message
+
+
+class ImageTooLargeError(PhotoProcessingError):
+    """Raised when decoding an image would not fit in the pixel budget of the process"""
@@ -25,8 +25,7 @@ class BaseUploadPhotosToGalleryForm(forms.Form):
         upload_id = self.cleaned_data['upload_id']
 
         if self.files:  # Javascript is disabled in the browser
-            for file in self.files.getlist('new_photos'):
-                get_photo_processor().handle_file(file, upload_id)
+            get_photo_processor().handle_files(self.files.getlist('new_photos'), upload_id)
 
         if gallery is not None:
             get_photo_processor().link_photos_to_gallery(upload_id, gallery)
@@ -90,7 +89,7 @@ class SinglePhotoForm(forms.ModelForm):
 
 
 class GalleryForm(BaseAdminUploadPhotosFormAdminUrl, forms.ModelForm):
-    photos = forms.ModelMultipleChoiceField(PHOTO_MODEL.objects.filter(uploaded_photo__isnull=True),
+    photos = forms.ModelMultipleChoiceField(PHOTO_MODEL.objects.exclude(uploaded_photo__created_photo=True),
                                             widget=FilteredSelectMultiple(_('Photos'), False), required=False,
                                             label=_('Uploaded Photos'),
                                             help_text=_('Add already uploaded photos to this gallery'))
@@ -0,0 +1,14 @@
+import hashlib
+
+
+def new_content_hash():
+    return hashlib.sha256()
+
+
+def content_hash(file):
+    """The hex digest of the contents of a (Django) File, read chunk by chunk"""
+    digest = new_content_hash()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
@@ -0,0 +1,51 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+# Seconds after which a lock held by another process is considered abandoned
+LOCK_TIMEOUT = getattr(settings, 'PHOTOS_LOCK_TIMEOUT', 60)
+LOCK_POLL_INTERVAL = 0.1
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+@contextmanager
+def _thread_lock(key):
+    with _locks_lock:
+        lock, users = _locks.get(key, (threading.Lock(), 0))
+        _locks[key] = (lock, users + 1)
+    try:
+        with lock:
+            yield
+    finally:
+        with _locks_lock:
+            lock, users = _locks[key]
+            if users == 1:
+                del _locks[key]
+            else:
+                _locks[key] = (lock, users - 1)
+
+
+@contextmanager
+def single_flight(key, timeout=LOCK_TIMEOUT):
+    """
+    Let only one thread at a time run the block for key. Threads of this process wait on a lock, other processes on
+    a key in the cache (when the cache is shared between processes), at most timeout seconds.
+    Whoever waited should check whether the work was done in the meantime.
+    """
+    cache_key = 'photos:lock:{}'.format(key)
+    with _thread_lock(key):
+        deadline = time.monotonic() + timeout
+        acquired = cache.add(cache_key, True, timeout)
+        while not acquired and time.monotonic() < deadline:
+            time.sleep(LOCK_POLL_INTERVAL)
+            acquired = cache.add(cache_key, True, timeout)
+        try:
+            yield
+        finally:
+            if acquired:
+                cache.delete(cache_key)
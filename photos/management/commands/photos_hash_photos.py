@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from ...hashing import content_hash
+from ...models import PHOTO_MODEL
+
+
+class Command(BaseCommand):
+    help = 'Compute the content and perceptual hashes of every photo that does not have them yet, so duplicate ' \
+           'uploads and similar photos can be found'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Amount of photos that are hashed and updated per query')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        photos = PHOTO_MODEL.objects.filter(Q(content_hash='') | Q(perceptual_hash='')).order_by('pk') \
+            .only('pk', 'image', 'renditions', 'content_hash', 'perceptual_hash')
+        last_pk = None
+        hashed = 0
+        while True:
+            batch = list((photos if last_pk is None else photos.filter(pk__gt=last_pk))[:batch_size])
+            if not batch:
+                break
+            for photo in batch:
+                try:
+                    if not photo.content_hash:
+                        with photo.image.open('rb') as file:
+                            photo.content_hash = content_hash(file)
+                    if not photo.perceptual_hash:
+                        photo.update_perceptual_hash()
+                    hashed += 1
+                except OSError as e:
+                    self.stderr.write("Couldn't hash {}: {}".format(photo.image.name, e))
+            PHOTO_MODEL.objects.bulk_update(batch, ['content_hash', 'perceptual_hash'])
+            last_pk = batch[-1].pk
+        self.stdout.write('Hashed {} photos'.format(hashed))
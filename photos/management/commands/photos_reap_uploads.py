@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from ...reaper import reap_stale_uploads, STALE_UPLOAD_HOURS, REAPER_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Delete what abandoned uploads left behind: staging rows, the photos only they refer to, temporary zips ' \
+           'and unfinished chunked uploads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age-hours', type=float, default=STALE_UPLOAD_HOURS,
+                            help='Only remove uploads older than this')
+        parser.add_argument('--batch-size', type=int, default=REAPER_BATCH_SIZE,
+                            help='Amount of rows that are deleted per query and per transaction')
+
+    def handle(self, *args, **options):
+        reaped = reap_stale_uploads(options['max_age_hours'], options['batch_size'])
+        self.stdout.write(', '.join('{} {}'.format(count, name.replace('_', ' ')) for name, count in reaped.items()))
@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from ...models import refresh_gallery_photo_stats
+
+
+class Command(BaseCommand):
+    help = 'Recompute the photo count and cover photo of every gallery'
+
+    def handle(self, *args, **options):
+        refresh_gallery_photo_stats()
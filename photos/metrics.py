@@ -0,0 +1,121 @@
+"""
+Instrumentation of the processing pipeline. Every stage reports to the backend of PHOTOS_METRICS_BACKEND:
+
+    photos_stage_seconds        duration of a stage (decode, resize, encode, storage_write, db_insert, ...)
+    photos_errors_total         stages that raised an exception
+    photos_bytes_in_total       bytes of the uploaded originals
+    photos_bytes_out_total      bytes of the encoded renditions
+    photos_pixels_decoded_total pixels the engine decoded
+
+Metrics are tagged with the stage and, where it is known, the size name, box, format and processor class.
+The default backend ignores everything, InMemoryBackend aggregates them in this process for MetricsView.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+METRICS_BACKEND = getattr(settings, 'PHOTOS_METRICS_BACKEND', 'photos.metrics.NullBackend')
+
+_tags = ContextVar('photos_metrics_tags', default={})
+
+
+class NullBackend:
+    def timing(self, name, seconds, tags):
+        pass
+
+    def increment(self, name, value, tags):
+        pass
+
+
+class InMemoryBackend(NullBackend):
+    """Sums every metric per name and tags in this process, timings also count their observations"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.timings = {}
+            self.counters = {}
+
+    @staticmethod
+    def _key(name, tags):
+        return name, tuple(sorted((key, str(value)) for key, value in tags.items()))
+
+    def timing(self, name, seconds, tags):
+        key = self._key(name, tags)
+        with self._lock:
+            count, total = self.timings.get(key, (0, 0.0))
+            self.timings[key] = (count + 1, total + seconds)
+
+    def increment(self, name, value, tags):
+        key = self._key(name, tags)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def prometheus_text(self):
+        """The metrics in the Prometheus text exposition format, timings as summaries"""
+        with self._lock:
+            timings, counters = dict(self.timings), dict(self.counters)
+        lines = []
+        for name in sorted({name for name, tags in timings}):
+            lines.append('# TYPE {} summary'.format(name))
+            for (metric, tags), (count, total) in sorted(timings.items()):
+                if metric == name:
+                    lines.append('{}_count{} {}'.format(name, _labels(tags), count))
+                    lines.append('{}_sum{} {!r}'.format(name, _labels(tags), total))
+        for name in sorted({name for name, tags in counters}):
+            lines.append('# TYPE {} counter'.format(name))
+            for (metric, tags), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append('{}{} {}'.format(name, _labels(tags), value))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(tags):
+    if not tags:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for key, value in tags)
+    return '{' + ','.join('{}="{}"'.format(key, value) for (key, _), value in zip(tags, escaped)) + '}'
+
+
+@lru_cache(maxsize=None)
+def _load_backend(path):
+    return import_string(path)()
+
+
+def get_backend():
+    return _load_backend(METRICS_BACKEND)
+
+
+@contextmanager
+def tagged(**tags):
+    """Add tags to every metric recorded in this block, e.g. the processor class"""
+    token = _tags.set({**_tags.get(), **tags})
+    try:
+        yield
+    finally:
+        _tags.reset(token)
+
+
+def increment(name, value=1, **tags):
+    get_backend().increment(name, value, {**_tags.get(), **tags})
+
+
+@contextmanager
+def timer(stage, **tags):
+    """Record the duration of a stage, and count it as an error if it raises"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        increment('photos_errors_total', stage=stage, **tags)
+        raise
+    finally:
+        get_backend().timing('photos_stage_seconds', time.perf_counter() - start,
+                             {**_tags.get(), 'stage': stage, **tags})
@@ -2,33 +2,115 @@
 # Copyright (c) 2007-2019, Justin C. Driscoll and all the people named in
 # https://github.com/richardbarran/django-photologue/blob/master/CONTRIBUTORS.txt.
 
-from django.db import models
+from django.db import models, router, transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import m2m_changed, pre_delete, post_delete
+from django.dispatch import receiver
+from django.urls import reverse
 from django.utils.safestring import mark_safe
 from django.utils.text import slugify
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
-from django.core.files.storage import default_storage
-from PIL import Image
-from django.utils.encoding import force_str
+from django.core.files.storage import default_storage, FileSystemStorage
+from django.core.signals import setting_changed
+from django.utils.encoding import force_str, filepath_to_uri
 import os
-from io import BytesIO
 from django.core.files.base import ContentFile
 from uuid import uuid4
 import random
-from functools import partial
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partialmethod, lru_cache
+from urllib.parse import urljoin
 import logging
+from .renditions import PixelBudget, process_peak_rss, RENDITION_VERSION, format_extension, format_mime_type
+from .engines import get_engine
+from . import metrics
+from .locks import single_flight
+from .hashing import content_hash
+from .similarity import BKTree
 
 logger = logging.getLogger('photos.models')
 
 IMAGE_STORAGE = getattr(settings, 'PHOTOS_IMAGE_STORAGE', default_storage)
 TEMP_FILE_STORAGE = getattr(settings, 'PHOTOS_TEMP_FILE_STORAGE', default_storage)
 IMAGE_SIZES = {'admin_thumbnail': (100, 100)}
+# A size is a box (width, height), or a dict with the box as 'size' and an encoder profile: a target 'format' and
+# the options of photos.renditions.encoder_options
 _IMAGE_SIZES = getattr(settings, 'PHOTOS_IMAGE_SIZES', {'display': (500, 500),
                                                         'hd': (1920, 1080)})  # (Width, Height)
 IMAGE_SIZES.update(_IMAGE_SIZES)
-_SIZE_METHOD_MAP = {}
+IMAGE_SIZE_PROFILES = {}
+for _size_name, _size in IMAGE_SIZES.items():
+    _profile = dict(_size) if isinstance(_size, dict) else {'size': _size}
+    IMAGE_SIZES[_size_name] = tuple(_profile.pop('size'))
+    if 'format' in _profile:
+        _profile['format'] = _profile['format'].upper()
+    IMAGE_SIZE_PROFILES[_size_name] = _profile
 USE_ASYNC = getattr(settings, 'PHOTOS_USE_ASYNC', False)
 UPLOAD_TO = getattr(settings, 'PHOTOS_UPLOAD_TO', 'photos')
+LOW_MEMORY_DECODE = getattr(settings, 'PHOTOS_LOW_MEMORY_DECODE', False)
+# Maximum amount of pixels decoded at the same time by one process, None means unlimited
+MAX_DECODE_PIXELS = getattr(settings, 'PHOTOS_MAX_DECODE_PIXELS', None)
+DECODE_BUDGET_TIMEOUT = getattr(settings, 'PHOTOS_DECODE_BUDGET_TIMEOUT', 60)  # Seconds to wait for free budget
+DECODE_BUDGET = PixelBudget(MAX_DECODE_PIXELS, DECODE_BUDGET_TIMEOUT)
+# Let the url of a size that wasn't created yet point to RenditionView, which creates it on the first request
+LAZY_RENDITIONS = getattr(settings, 'PHOTOS_LAZY_RENDITIONS', False)
+# Urls of images are built by appending their path to this url, set it for storages that aren't FileSystemStorages
+# but whose urls don't need signing. None means: ask the storage for every url.
+IMAGE_BASE_URL = getattr(settings, 'PHOTOS_IMAGE_BASE_URL', None)
+# Every size is also created in these formats, when Pillow can encode them. The first one a browser accepts is used.
+EXTRA_FORMATS = [image_format.upper() for image_format in getattr(settings, 'PHOTOS_EXTRA_FORMATS', ('AVIF', 'WEBP'))
+                 if get_engine().supports_format(image_format)]
+# Every format a size can be stored in, besides the one of the original
+_SIZE_FORMATS = list(dict.fromkeys(EXTRA_FORMATS + [profile['format'] for profile in IMAGE_SIZE_PROFILES.values()
+                                                    if 'format' in profile]))
+# The box of the smallest size, the perceptual hash is made from its rendition so hashes of all photos are comparable
+_HASH_BOX = min((tuple(box) for box in IMAGE_SIZES.values()), key=lambda box: box[0] * box[1])
+# Photos whose perceptual hashes differ in at most this many (of 64) bits are considered similar
+SIMILARITY_MAX_DISTANCE = getattr(settings, 'PHOTOS_SIMILARITY_MAX_DISTANCE', 10)
+# Threads that store the renditions of a photo at the same time, while the next ones are encoded
+STORAGE_WORKERS = getattr(settings, 'PHOTOS_STORAGE_WORKERS', 4)
+# Threads that delete files at the same time, for storages without a delete_many(names) method
+DELETE_WORKERS = getattr(settings, 'PHOTOS_DELETE_WORKERS', 8)
+
+
+@lru_cache(maxsize=None)
+def get_storage_base_url(storage):
+    if IMAGE_BASE_URL is not None:
+        # urljoin would replace the last segment of a base url without a trailing slash
+        return IMAGE_BASE_URL if IMAGE_BASE_URL.endswith('/') else IMAGE_BASE_URL + '/'
+    if isinstance(storage, FileSystemStorage):
+        return storage.base_url
+    return None
+
+
+@receiver(setting_changed)
+def _clear_storage_base_urls(setting, **kwargs):
+    if setting == 'MEDIA_URL':
+        get_storage_base_url.cache_clear()
+
+
+def delete_stored_files(storage, names):
+    """
+    Delete names from storage, with one storage.delete_many(names) call when the storage has that method (e.g. a
+    bulk delete request on object stores), otherwise with up to DELETE_WORKERS calls of storage.delete at a time.
+    """
+    names = list(dict.fromkeys(names))
+    try:
+        if hasattr(storage, 'delete_many'):
+            storage.delete_many(names)
+        elif DELETE_WORKERS > 1 and len(names) > 1:
+            with ThreadPoolExecutor(max_workers=min(DELETE_WORKERS, len(names))) as executor:
+                list(executor.map(storage.delete, names))
+        else:
+            for name in names:
+                storage.delete(name)
+    except OSError as e:
+        logger.warning("Couldn't delete photo: {}".format(e))
+        raise e
 
 
 class UUIDModel(models.Model):
@@ -46,8 +128,50 @@ class UpdateTimesModel(models.Model):
         abstract = True
 
 
+class ImageQuerySet(models.QuerySet):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._similarity_index = None
+
+    def similarity_index(self):
+        """A BKTree of the perceptual hashes of this queryset, built once and kept with it like its result cache"""
+        if self._similarity_index is None:
+            self._similarity_index = BKTree.from_queryset(self)
+        return self._similarity_index
+
+    def similar_to(self, photo, max_distance=None):
+        """
+        The photos in this queryset whose perceptual hash is within max_distance bits of the one of photo, photo
+        itself excluded. Look up many photos with the same queryset, its index is only built for the first one.
+        """
+        if not photo.perceptual_hash:
+            return self.none()
+        max_distance = SIMILARITY_MAX_DISTANCE if max_distance is None else max_distance
+        found = self.similarity_index().search(photo.perceptual_hash, max_distance)
+        return self.filter(pk__in=[pk for distance, pk in found if pk != photo.pk])
+
+    def stored_file_names(self):
+        """The names of the originals and sizes of all photos in this queryset, read without creating models"""
+        seen = set()
+        for pk, image_name, renditions in self.values_list('pk', 'image', 'renditions').iterator():
+            if pk not in seen:  # Joins can return a photo more than once
+                seen.add(pk)
+                yield from self.model.stored_file_names(image_name, renditions)
+
+
 class ImageModel(models.Model):
     image = models.ImageField(verbose_name=_('image'), storage=IMAGE_STORAGE, upload_to=UPLOAD_TO, null=False)
+    # The dimensions of the original and of every created size, see _create_renditions
+    renditions = models.JSONField(verbose_name=_('renditions'), default=dict, blank=True, editable=False)
+    # sha256 of the original, to find duplicate uploads
+    content_hash = models.CharField(verbose_name=_('content hash'), max_length=64, blank=True, db_index=True,
+                                    editable=False)
+    # dHash of the rendition of the smallest size, to find similar photos, see photos.similarity
+    perceptual_hash = models.CharField(verbose_name=_('perceptual hash'), max_length=16, blank=True, editable=False)
+    # Set once every size is in the manifest, by update_sizes or by whoever creates the last missing size
+    renditions_ready = models.BooleanField(verbose_name=_('renditions ready'), default=False, editable=False)
+
+    objects = ImageQuerySet.as_manager()
 
     class Meta:
         abstract = True
@@ -63,110 +187,369 @@ class ImageModel(models.Model):
         return None if self._old_image is None else os.path.basename(force_str(self._old_image.name))
 
     @staticmethod
-    def _get_filepath_for_size(filename, size):
+    def _get_filepath_for_size(filename, size, image_format=None):
         base, ext = os.path.splitext(filename)
+        if image_format is not None:
+            ext = format_extension(image_format)
         return '{}/{}_{}x{}{}'.format(UPLOAD_TO, base, size[0], size[1], ext)
 
-    def get_filepath_for_size(self, size):
-        return self._get_filepath_for_size(self.image_filename(), size)
+    def get_filepath_for_size(self, size, image_format=None):
+        return self._get_filepath_for_size(self.image_filename(), size, image_format)
+
+    def _storage_url(self, name):
+        base_url = get_storage_base_url(self.image.storage)
+        if base_url is None:
+            return self.image.storage.url(name)
+        return urljoin(base_url, filepath_to_uri(name).lstrip('/'))
+
+    def get_image_url(self):
+        """The url of the original, like image.url but without asking the storage, see get_storage_base_url"""
+        return self._storage_url(self.image.name)
 
     def _get_url_for_size(self, size):
-        base, ext = os.path.splitext(self.image.url)
-        return '{}_{}x{}{}'.format(base, size[0], size[1], ext)
+        return self._storage_url(self.get_filepath_for_size(size))
+
+    def _get_size_entry(self, size_name):
+        return self.renditions.get('sizes', {}).get(size_name)
 
     def _get_SIZE_url(self, size_name):  # Call this with get_admin_thumbnail_url()
-        size = IMAGE_SIZES[size_name]
-        return self._get_url_for_size(size)
+        entry = self._get_size_entry(size_name)
+        if entry is not None:
+            return self._storage_url(entry['name'])
+        if LAZY_RENDITIONS:
+            return reverse('photo-rendition', kwargs={'pk': self.pk, 'size_name': size_name})
+        return self._storage_url(self.get_filepath_for_size(IMAGE_SIZES[size_name],
+                                                            IMAGE_SIZE_PROFILES[size_name].get('format')))
+
+    def _get_SIZE_dimensions(self, size_name):  # Call this with get_admin_thumbnail_dimensions()
+        entry = self._get_size_entry(size_name)
+        if entry is None:
+            return None
+        return {'width': entry['width'], 'height': entry['height']}
+
+    def srcset(self, image_format=None):
+        """The srcset of all sizes, in the format of the original or in one of the EXTRA_FORMATS"""
+        entries = {entry['name']: entry for entry in self.renditions.get('sizes', {}).values()}
+        urls = []
+        for entry in sorted(entries.values(), key=lambda entry: entry['width']):
+            name = entry['name'] if image_format is None else entry.get('formats', {}).get(image_format, {}).get('name')
+            if name is not None:
+                urls.append('{} {}w'.format(self._storage_url(name), entry['width']))
+        return ', '.join(urls)
+
+    def sources(self):
+        """The type and srcset of every extra format, for the <source> elements of a <picture>"""
+        sources = []
+        for image_format in EXTRA_FORMATS:
+            srcset = self.srcset(image_format)
+            if srcset:
+                sources.append({'type': format_mime_type(image_format), 'srcset': srcset})
+        return sources
 
     def admin_thumbnail_tag(self):
         return mark_safe('''<a href="{}">
                                 <div style="background: url(\'{}\') no-repeat center center; background-size: cover; 
                                             width: 50px; height: 50px">
                                 </div>
-                            </a>'''.format(self.image.url, self.get_admin_thumbnail_url()))
+                            </a>'''.format(self.get_image_url(), self.get_admin_thumbnail_url()))
 
     admin_thumbnail_tag.short_description = _('Thumbnail')
 
-    def _create_size(self, size):
+    @staticmethod
+    def _extra_formats(image_format):
+        return [extra_format for extra_format in EXTRA_FORMATS if extra_format != image_format]
+
+    def _write(self, name, data, tags):
+        with metrics.timer('storage_write', **tags):
+            return self.image.storage.save(name, ContentFile(data))
+
+    def _save_encoded(self, writes, size, rendition, image_format, profile, extension_format=None, size_name=None):
+        """Encode a rendition and hand it to the executor writes, returns the future of its name and its length"""
+        tags = {'size': size_name, 'format': image_format}
+        with metrics.timer('encode', **tags):
+            data = get_engine().encode(rendition, image_format, profile)
+        metrics.increment('photos_bytes_out_total', len(data), **tags)
+        # The writing thread records its metrics with the tags of this one
+        name = writes.submit(contextvars.copy_context().run, self._write,
+                             self.get_filepath_for_size(size, extension_format), data, tags)
+        return name, len(data)
+
+    def _save_size(self, writes, size, rendition, original_format, profile=None, size_name=None):
+        """
+        Encode one rendition with an encoder profile, in its format and in the extra formats. The files are stored
+        by writes, the names in the returned entry are futures until _written.
+        """
+        profile = profile or {}
+        image_format = profile.get('format', original_format)
+        name, length = self._save_encoded(writes, size, rendition, image_format, profile, profile.get('format'),
+                                          size_name)
+        width, height = get_engine().rendition_size(rendition)
+        entry = {'box': list(size), 'width': width, 'height': height, 'bytes': length, 'name': name,
+                 'format': image_format, 'profile': profile, 'formats': {}}
+        for extra_format in self._extra_formats(image_format):
+            name, length = self._save_encoded(writes, size, rendition, extra_format, profile, extra_format, size_name)
+            entry['formats'][extra_format] = {'name': name, 'bytes': length}
+        return entry
+
+    @staticmethod
+    def _written(entry):
+        """The entry of _save_size with the names its files were stored under, raises the error of a failed write"""
+        formats = {image_format: {**variant, 'name': variant['name'].result()}
+                   for image_format, variant in entry['formats'].items()}
+        return {**entry, 'name': entry['name'].result(), 'formats': formats}
+
+    def _hash_rendition(self, engine, rendition):
+        """Set the perceptual hash from rendition, the original's rendition for _HASH_BOX"""
+        with metrics.timer('perceptual_hash'):
+            self.perceptual_hash = engine.perceptual_hash(rendition)
+
+    def update_perceptual_hash(self):
+        """
+        Hash a photo that was saved before it had a perceptual hash. The renditions of all sizes are made from the
+        original like a processed save makes them, as every rendition is resized from the previous one, so the hash
+        equals the one the photo would have gotten when it was saved. Nothing is encoded or stored.
+        """
+        engine = get_engine()
+        with self.image.open('rb'), engine.open(self.image) as image:
+            for size, rendition in engine.thumbnails(image, self._group_by_box(IMAGE_SIZES), LOW_MEMORY_DECODE,
+                                                     DECODE_BUDGET):
+                if size == _HASH_BOX:
+                    self._hash_rendition(engine, rendition)
+
+    def _create_renditions(self, boxes):
+        """
+        Create a size for every box in boxes, a dict mapping each box to the names of the sizes that use it.
+        The renditions manifest records the dimensions of the original and the result for every size.
+        Renditions are stored by up to STORAGE_WORKERS threads while the next ones are encoded, a size whose files
+        couldn't be stored is left out of the manifest.
+        """
+        engine = get_engine()
+        rss_before = process_peak_rss()
+        encoded = []
         try:
-            with Image.open(self.image) as image:
-                image.thumbnail(size, Image.ANTIALIAS)
-                filename = self.get_filepath_for_size(size)
-                buffer = BytesIO()
-                image.save(buffer, image.format, optimize=True)
-                buffer_contents = ContentFile(buffer.getvalue())
-                self.image.storage.save(filename, buffer_contents)
+            with metrics.timer('create_renditions'), engine.open(self.image) as image, \
+                    ThreadPoolExecutor(max_workers=STORAGE_WORKERS) as writes:
+                metadata = engine.metadata(image)
+                if self.renditions.get('version') != RENDITION_VERSION:
+                    self.renditions = {'version': RENDITION_VERSION, 'sizes': {}}
+                self.renditions.update(metadata)
+                hash_source = None
+                for size, rendition in engine.thumbnails(image, boxes, LOW_MEMORY_DECODE, DECODE_BUDGET):
+                    for size_names in self._group_by_profile(boxes[size]):
+                        encoded.append((size_names, self._save_size(writes, size, rendition, metadata['format'],
+                                                                    IMAGE_SIZE_PROFILES[size_names[0]],
+                                                                    ','.join(size_names))))
+                    if size == _HASH_BOX:
+                        hash_source = rendition
+                # Only once per image, hashing the rendition needs no extra decode
+                if hash_source is not None and not self.perceptual_hash:
+                    self._hash_rendition(engine, hash_source)
         except OSError as e:
             logger.error('Error creating size: {}'.format(e))
             raise e
 
+        errors = []
+        for size_names, entry in encoded:
+            try:
+                entry = self._written(entry)
+            except OSError as e:
+                logger.error('Error creating size {}: {}'.format(','.join(size_names), e))
+                errors.append(e)
+                continue
+            for size_name in size_names:
+                self.renditions['sizes'][size_name] = entry
+        if errors:
+            raise errors[0]
+        if rss_before is not None:
+            rss_after = process_peak_rss()
+            logger.info('Created {} size(s) for {} with the {} engine, process peak RSS {} KiB (raised by {} KiB)'
+                        .format(len(boxes), self.image.name, engine.name, rss_after, rss_after - rss_before))
+
+    @staticmethod
+    def _group_by_box(size_names):
+        boxes = {}
+        for size_name in size_names:
+            boxes.setdefault(tuple(IMAGE_SIZES[size_name]), []).append(size_name)
+        return boxes
+
+    @staticmethod
+    def _group_by_profile(size_names):
+        profiles = {}
+        for size_name in size_names:
+            key = tuple(sorted(IMAGE_SIZE_PROFILES[size_name].items()))
+            profiles.setdefault(key, []).append(size_name)
+        return list(profiles.values())
+
+    def _create_size(self, size):
+        size = tuple(size)
+        self._create_renditions({size: [name for name, box in IMAGE_SIZES.items() if tuple(box) == size]})
+
     def _create_sizes(self):
-        for size in IMAGE_SIZES.values():
-            self._create_size(size)
+        self._create_renditions(self._group_by_box(IMAGE_SIZES))
+
+    def missing_sizes(self):
+        """The names of the sizes that aren't in the manifest, or were created for another box or version"""
+        if self.renditions.get('version') != RENDITION_VERSION:
+            return list(IMAGE_SIZES)
+        sizes = self.renditions.get('sizes', {})
+        return [name for name, box in IMAGE_SIZES.items() if not self._is_current(sizes.get(name), box,
+                                                                                   IMAGE_SIZE_PROFILES[name])]
+
+    def _is_current(self, entry, box, profile):
+        """Whether a manifest entry was created for box, with profile and in all extra formats"""
+        return (entry is not None and tuple(entry['box']) == tuple(box) and entry.get('profile', {}) == profile
+                and set(entry.get('formats', {})) == set(self._extra_formats(entry.get('format'))))
 
     @staticmethod
-    def _delete_size(filename, size):
-        try:
-            IMAGE_STORAGE.delete(ImageModel._get_filepath_for_size(filename, size))
-        except OSError as e:
-            logger.warning("Couldn't delete photo: {}".format(e))
-            raise e
+    def _size_filepaths(filename, size):
+        """The names a size of filename has in every format it can be stored in"""
+        return [ImageModel._get_filepath_for_size(filename, size)] + [
+            ImageModel._get_filepath_for_size(filename, size, image_format) for image_format in _SIZE_FORMATS]
 
     @staticmethod
     def _delete_sizes(filename):
-        for size in IMAGE_SIZES.values():
-            ImageModel._delete_size(filename, size)
+        delete_stored_files(IMAGE_STORAGE, [name for size in IMAGE_SIZES.values()
+                                            for name in ImageModel._size_filepaths(filename, size)])
+
+    @staticmethod
+    def stored_file_names(image_name, renditions):
+        """
+        The names of the original and the sizes of a photo: the ones in its manifest, and the ones the sizes that
+        aren't in it would have, they might be from before there was a manifest
+        """
+        sizes = (renditions or {}).get('sizes', {})
+        names = [image_name]
+        for entry in sizes.values():
+            names.append(entry['name'])
+            names.extend(variant['name'] for variant in entry.get('formats', {}).values())
+        filename = os.path.basename(force_str(image_name))
+        for size_name, size in IMAGE_SIZES.items():
+            if size_name not in sizes:
+                names.extend(ImageModel._size_filepaths(filename, size))
+        return names
 
     @staticmethod
     def delete_files(filepath):
-        IMAGE_STORAGE.delete(filepath)
-        ImageModel._delete_sizes(os.path.basename(force_str(filepath)))
+        delete_stored_files(IMAGE_STORAGE, ImageModel.stored_file_names(filepath, None))
 
     def delete_all_files(self):
         self.image.close()
-        self.delete_files(self.image.name)
+        delete_stored_files(self.image.storage, self.stored_file_names(self.image.name, self.renditions))
 
-    def _update_sizes(self, old_image_filename):
-        if old_image_filename is not None:
+    def _merge_renditions(self, size_names):
+        """
+        Save the manifest entries of size_names, without overwriting entries other processes saved meanwhile, and
+        whether that completed the manifest
+        """
+        with metrics.timer('db_update'), transaction.atomic():
+            saved = type(self).objects.select_for_update().filter(pk=self.pk)
+            renditions, perceptual_hash = saved.values_list('renditions', 'perceptual_hash').get()
+            # Another process may have hashed the photo since this one was loaded
+            self.perceptual_hash = self.perceptual_hash or perceptual_hash
+            if renditions.get('version') == self.renditions['version']:
+                renditions.update({key: value for key, value in self.renditions.items() if key != 'sizes'})
+                renditions['sizes'].update({name: self.renditions['sizes'][name] for name in size_names})
+            else:
+                renditions = self.renditions
+            self.renditions = renditions
+            self.renditions_ready = not self.missing_sizes()
+            type(self).objects.filter(pk=self.pk).update(renditions=renditions, perceptual_hash=self.perceptual_hash,
+                                                         renditions_ready=self.renditions_ready)
+
+    def save_renditions(self):
+        """Save the manifest of a photo whose sizes were created after it was saved, see _merge_renditions"""
+        if self.renditions:
+            self._merge_renditions(list(self.renditions['sizes']))
+
+    def get_or_create_size(self, size_name):
+        """
+        Return the manifest entry of a size, creating and saving only that size if it is missing or outdated.
+        Concurrent calls for the same photo and size create it only once.
+        """
+        if size_name not in self.missing_sizes():
+            return self._get_size_entry(size_name)
+        with single_flight('rendition:{}:{}'.format(self.pk, size_name)):
+            self.refresh_from_db(fields=['renditions'])
+            if size_name in self.missing_sizes():
+                self._delete_outdated_sizes([size_name])
+                self._create_renditions(self._group_by_box([size_name]))
+                self._merge_renditions([size_name])
+        self.mark_renditions_ready()  # When another process created the last size before the manifest was read
+        return self._get_size_entry(size_name)
+
+    def mark_renditions_ready(self):
+        """Save renditions_ready when no size is missing anymore, returns whether the photo is ready"""
+        if not self.renditions_ready and not self.missing_sizes():
+            type(self).objects.filter(pk=self.pk).update(renditions_ready=True)
+            self.renditions_ready = True
+        return self.renditions_ready
+
+    def _delete_outdated_sizes(self, size_names):
+        for size_name in size_names:
+            entry = self._get_size_entry(size_name)
+            if entry is not None:
+                self.image.storage.delete(entry['name'])
+                for variant in entry.get('formats', {}).values():
+                    self.image.storage.delete(variant['name'])
+            elif not self._state.adding:  # Created before there was a manifest
+                self.image.storage.delete(self.get_filepath_for_size(IMAGE_SIZES[size_name]))
+
+    def update_sizes(self, force=False):
+        """Create the sizes that are missing from the manifest, or all of them if the image changed or force is set"""
+        # A photo that was never saved can't have sizes from an older image
+        old_image_filename = None if self._state.adding else self._old_image_filename()
+        if old_image_filename is not None and old_image_filename != self.image_filename():
             self._delete_sizes(old_image_filename)
-        self._create_sizes()
+            self.renditions = {}
+            self.perceptual_hash = ''
+
+        size_names = list(IMAGE_SIZES) if force else self.missing_sizes()
+        if size_names:
+            self._delete_outdated_sizes(size_names)
+            self._create_renditions(self._group_by_box(size_names))
+        self.renditions_ready = not self.missing_sizes()
+
+    def _commit_image(self):
+        if self.image and not self.image._committed:
+            self.image.save(self.image.name, self.image.file, save=False)
 
-    def update_sizes(self):
-        self._update_sizes(self._old_image_filename())
+    def _update_content_hash(self):
+        # Processors hash new photos themselves while receiving them, a replaced image always needs a new hash
+        if self.image and (not self._state.adding or not self.content_hash):
+            self.content_hash = content_hash(self.image)
 
     def save(self, *args, process=True, **kwargs):
+        if self._old_image != self.image or self._state.adding:
+            self._update_content_hash()
         should_update = (self._old_image != self.image or self._state.adding) and process
-        super().save(*args, **kwargs)  # Have to save first because filename might change upon save
         if should_update:
+            # The sizes are created from the stored original, the manifest is saved along with the row
+            self._commit_image()
             self.update_sizes()
+        super().save(*args, **kwargs)
 
     def delete(self, *args, **kwargs):
         self.delete_all_files()
         return super().delete(*args, **kwargs)
 
+    def get_similar_photos(self, max_distance=None):
+        return type(self).objects.similar_to(self, max_distance)
+
     def __str__(self):
         return self.image_filename()
 
-    def __getattr__(self, name):
-        if not _SIZE_METHOD_MAP:
-            init_size_method_map()
-        di = _SIZE_METHOD_MAP.get(name, None)
-        if di is not None:
-            result = partial(getattr(self, di['base_name']), di['size'])
-            setattr(self, name, result)
-            return result
-        else:
-            raise AttributeError
-
 
-def init_size_method_map():
-    for name in IMAGE_SIZES.keys():
-        _SIZE_METHOD_MAP['get_%s_url' % name] = {'base_name': '_get_SIZE_url', 'size': name}
+# get_<size>_url and get_<size>_dimensions for every size, e.g. get_admin_thumbnail_url()
+for _size_name in IMAGE_SIZES:
+    setattr(ImageModel, 'get_%s_url' % _size_name, partialmethod(ImageModel._get_SIZE_url, _size_name))
+    setattr(ImageModel, 'get_%s_dimensions' % _size_name, partialmethod(ImageModel._get_SIZE_dimensions, _size_name))
 
 
 class Photo(UUIDModel, UpdateTimesModel, ImageModel):
     class Meta:
         abstract = True
+        # Keyset pagination, see photos.pagination
+        indexes = [models.Index(fields=['-created_at', '-id'], name='%(app_label)s_%(class)s_keyset')]
 
 
 _PHOTO_MODEL = getattr(settings, 'PHOTOS_PHOTO_MODEL', Photo)
@@ -174,7 +557,7 @@ PHOTO_MODEL = _PHOTO_MODEL
 
 if _PHOTO_MODEL._meta.abstract:
     class PhotoModel(_PHOTO_MODEL):
-        class Meta:
+        class Meta(_PHOTO_MODEL.Meta):
             verbose_name = _('Photo')
             verbose_name_plural = _('Photos')
 
@@ -184,6 +567,10 @@ if _PHOTO_MODEL._meta.abstract:
 
 class BaseGallery(models.Model):
     photos = models.ManyToManyField(PHOTO_MODEL, verbose_name=_('Photos'), blank=True, related_name='galleries')
+    # Kept up to date when photos are added, removed or deleted, see refresh_gallery_photo_stats
+    photo_count = models.PositiveIntegerField(verbose_name=_('photo count'), default=0, editable=False)
+    cover_photo = models.ForeignKey(PHOTO_MODEL, verbose_name=_('cover photo'), null=True, blank=True,
+                                    editable=False, on_delete=models.SET_NULL, related_name='+')
 
     class Meta:
         abstract = True
@@ -203,6 +590,13 @@ class BaseGallery(models.Model):
 
     random_photo_tag.short_description = _('sample')
 
+    def cover_photo_tag(self):
+        if self.cover_photo_id is None:
+            return mark_safe('<div style="width: 50px; height: 50px"></div>')
+        return self.cover_photo.admin_thumbnail_tag()
+
+    cover_photo_tag.short_description = _('sample')
+
 
 class Gallery(UUIDModel, UpdateTimesModel, BaseGallery):
     title = models.CharField(max_length=255, unique=True, verbose_name=_('title'))
@@ -211,6 +605,7 @@ class Gallery(UUIDModel, UpdateTimesModel, BaseGallery):
 
     class Meta:
         abstract = True
+        indexes = [models.Index(fields=['-created_at', '-id'], name='%(app_label)s_%(class)s_keyset')]
 
     def save(self, *args, **kwargs):
         self.slug = slugify(self.title)  # We want to update the slug if title changed
@@ -225,7 +620,7 @@ GALLERY_MODEL = _GALLERY_MODEL
 
 if _GALLERY_MODEL._meta.abstract:
     class GalleryModel(_GALLERY_MODEL):
-        class Meta:
+        class Meta(_GALLERY_MODEL.Meta):
             verbose_name = _('Gallery')
             verbose_name_plural = _('Galleries')
             ordering = ('-created_at', '-updated_at', 'title')
@@ -234,11 +629,107 @@ if _GALLERY_MODEL._meta.abstract:
     GALLERY_MODEL = GalleryModel
 
 
+def refresh_gallery_photo_stats(gallery_ids=None):
+    """Recompute photo_count and cover_photo (the first added photo) of some or all galleries in one query"""
+    through = GALLERY_MODEL.photos.through
+    gallery_field = GALLERY_MODEL.photos.field.m2m_field_name()
+    photo_field = GALLERY_MODEL.photos.field.m2m_reverse_field_name()
+    memberships = through.objects.filter(**{gallery_field: OuterRef('pk')}).order_by()
+
+    galleries = GALLERY_MODEL.objects.all()
+    if gallery_ids is not None:
+        galleries = galleries.filter(pk__in=gallery_ids)
+    galleries.update(
+        photo_count=Coalesce(Subquery(memberships.values(gallery_field).annotate(count=Count('pk')).values('count')),
+                             0),
+        cover_photo=Subquery(memberships.order_by('pk').values(photo_field)[:1]),
+    )
+
+
+def add_photos_to_gallery(gallery, photo_ids, batch_size=500):
+    """
+    Like gallery.photos.add(), but with primary keys only and with bulk inserts of batch_size rows into the through
+    table. m2m_changed is sent with pre_add and post_add for the photos that weren't in the gallery yet, like add().
+    """
+    through = GALLERY_MODEL.photos.through
+    gallery_attname = through._meta.get_field(GALLERY_MODEL.photos.field.m2m_field_name()).attname
+    photo_attname = through._meta.get_field(GALLERY_MODEL.photos.field.m2m_reverse_field_name()).attname
+    db = router.db_for_write(through, instance=gallery)
+    photo_ids = list(dict.fromkeys(PHOTO_MODEL._meta.pk.to_python(photo_id) for photo_id in photo_ids))
+
+    missing = []
+    for start in range(0, len(photo_ids), batch_size):
+        batch = photo_ids[start:start + batch_size]
+        existing = set(through.objects.using(db).filter(**{gallery_attname: gallery.pk, photo_attname + '__in': batch})
+                       .values_list(photo_attname, flat=True))
+        missing.extend(photo_id for photo_id in batch if photo_id not in existing)
+    if not missing:
+        return
+
+    signal_kwargs = {'sender': through, 'instance': gallery, 'reverse': False, 'model': PHOTO_MODEL,
+                     'pk_set': set(missing), 'using': db}
+    with transaction.atomic(using=db, savepoint=False):
+        m2m_changed.send(action='pre_add', **signal_kwargs)
+        through.objects.using(db).bulk_create([through(**{gallery_attname: gallery.pk, photo_attname: photo_id})
+                                               for photo_id in missing], batch_size=batch_size, ignore_conflicts=True)
+        m2m_changed.send(action='post_add', **signal_kwargs)
+
+
+# Set while photos are deleted in bulk, their galleries are refreshed once afterwards instead of once per photo
+_batched_gallery_refresh = contextvars.ContextVar('batched_gallery_refresh', default=False)
+
+
+@contextmanager
+def refreshing_galleries_of(photos):
+    """Delete photos (a queryset or a list) inside this, the galleries that showed them are refreshed once at the end"""
+    gallery_ids = list(GALLERY_MODEL.objects.filter(photos__in=photos).order_by().values_list('pk', flat=True)
+                       .distinct())
+    token = _batched_gallery_refresh.set(True)
+    try:
+        yield
+    finally:
+        _batched_gallery_refresh.reset(token)
+    refresh_gallery_photo_stats(gallery_ids)
+
+
+@receiver(m2m_changed, sender=GALLERY_MODEL.photos.through)
+def _photos_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        instance._cleared_gallery_ids = list(instance.galleries.values_list('pk', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        refresh_gallery_photo_stats([instance.pk])
+        instance.refresh_from_db(fields=['photo_count', 'cover_photo'])
+    elif action == 'post_clear':
+        refresh_gallery_photo_stats(instance.__dict__.pop('_cleared_gallery_ids', []))
+    else:
+        refresh_gallery_photo_stats(pk_set)
+
+
+@receiver(pre_delete, sender=PHOTO_MODEL)
+def _photo_deleting(sender, instance, **kwargs):
+    if not _batched_gallery_refresh.get():
+        instance._deleted_from_gallery_ids = list(instance.galleries.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=PHOTO_MODEL)
+def _photo_deleted(sender, instance, **kwargs):
+    gallery_ids = instance.__dict__.pop('_deleted_from_gallery_ids', None)
+    if gallery_ids:
+        refresh_gallery_photo_stats(gallery_ids)
+
+
 class UploadedPhotoModel(UpdateTimesModel):
-    """These model-instances and their attached photos should be deleted once every few ~days"""
+    """These model-instances and their attached photos should be deleted once every few ~days, see photos.reaper"""
     photo = models.ForeignKey(PHOTO_MODEL, verbose_name=_('photo'), null=False, on_delete=models.CASCADE,
                               related_name='uploaded_photo')
     upload_id = models.UUIDField(db_index=True, verbose_name=_('upload id'), null=False)
+    # False when the upload was a duplicate of an existing photo, the reaper never deletes those photos
+    created_photo = models.BooleanField(verbose_name=_('created photo'), default=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['created_at'], name='%(app_label)s_uploaded_created')]
 
 
 if USE_ASYNC:
@@ -252,6 +743,10 @@ if USE_ASYNC:
         upload_id = models.UUIDField(primary_key=True)
         gallery = models.ForeignKey(GALLERY_MODEL, on_delete=models.CASCADE, null=True)
 
+        class Meta:
+            indexes = [models.Index(fields=['created_at'], name='%(app_label)s_upload_gallery_created')]
+
 
     class TempZipFile(models.Model):
         file = models.FileField(storage=TEMP_FILE_STORAGE)
+        created_at = models.DateTimeField(auto_now_add=True, db_index=True)
@@ -0,0 +1,69 @@
+import binascii
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.http import Http404
+from django.utils.dateparse import parse_datetime
+
+
+def encode_cursor(direction, obj):
+    value = '{}|{}|{}'.format(direction, obj.created_at.isoformat(), obj.pk)
+    return urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor, model):
+    try:
+        direction, created_at, pk = urlsafe_b64decode(cursor.encode()).decode().split('|')
+        pk = model._meta.pk.to_python(pk)
+    except (ValueError, binascii.Error, ValidationError):
+        raise Http404('Invalid cursor')
+    created_at = parse_datetime(created_at)
+    if direction not in ('next', 'previous') or created_at is None:
+        raise Http404('Invalid cursor')
+    return direction, created_at, pk
+
+
+class KeysetPaginationMixin:
+    """
+    Paginates a ListView on (created_at, pk), newest first. Instead of page numbers, the pages are addressed by
+    cursors, so every page takes one indexed range query no matter how deep it is.
+    The context gets next_cursor and previous_cursor, which are None on the last and first page.
+    """
+    cursor_kwarg = 'cursor'
+
+    def get_cursor(self):
+        return self.request.GET.get(self.cursor_kwarg)
+
+    def paginate_queryset(self, queryset, page_size):
+        cursor = self.get_cursor()
+        direction = 'next'
+        if cursor:
+            direction, created_at, pk = decode_cursor(cursor, queryset.model)
+            if direction == 'next':  # Older objects
+                queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk),
+                                           created_at__lte=created_at)
+            else:
+                queryset = queryset.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, pk__gt=pk),
+                                           created_at__gte=created_at)
+
+        if direction == 'next':
+            object_list = list(queryset.order_by('-created_at', '-pk')[:page_size + 1])
+            has_more = len(object_list) > page_size
+            object_list = object_list[:page_size]
+            has_next, has_previous = has_more, bool(cursor)
+        else:
+            object_list = list(queryset.order_by('created_at', 'pk')[:page_size + 1])
+            has_more = len(object_list) > page_size
+            object_list = object_list[:page_size][::-1]
+            has_next, has_previous = True, has_more
+
+        self.next_cursor = encode_cursor('next', object_list[-1]) if has_next and object_list else None
+        self.previous_cursor = encode_cursor('previous', object_list[0]) if has_previous and object_list else None
+        return None, None, object_list, bool(self.next_cursor or self.previous_cursor)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['next_cursor'] = getattr(self, 'next_cursor', None)
+        context['previous_cursor'] = getattr(self, 'previous_cursor', None)
+        return context
@@ -1,44 +1,142 @@
 import os
+from functools import wraps
 from django.conf import settings
-from ..photo_processors.utils import handle_zip
-from ..models import PHOTO_MODEL, UploadedPhotoModel
+from django.db import transaction
+from .. import metrics
+from ..photo_processors.utils import handle_zip, bulk_save_photos, find_uploaded_photos, file_name_batches, \
+    verify_header, BULK_BATCH_SIZE
+from ..hashing import content_hash
+from ..models import PHOTO_MODEL, IMAGE_STORAGE, UploadedPhotoModel, delete_stored_files, add_photos_to_gallery, \
+    refreshing_galleries_of
+from ..exceptions import PhotoProcessingError
 
 
-class PhotoProcessingError(Exception):
-    """An exception that can be raised when you want to output an error to the user"""
-    def __init__(self, message):
-        self.message = message
+def instrumented(stage):
+    """Time a processor method as stage, and tag every metric recorded in it with the processor class"""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with metrics.tagged(processor=type(self).__name__), metrics.timer(stage):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
 
 
 class BasePhotoProcessor:
+    @instrumented('handle_zip')
     def handle_zip(self, file, upload_id):
         handle_zip(file, upload_id)
 
+    @instrumented('process_photo')
+    def process_photo(self, photo):
+        """Called for every stored photo before it is saved in bulk"""
+        photo.update_sizes()
+
+    @instrumented('handle_photos')
+    def handle_photos(self, files, upload_id, process=True):
+        """
+        Store all files first, then insert the photos and their UploadedPhotoModel rows in batches.
+        Files with the same content as an existing photo (or as an earlier file) are linked to that photo instead.
+        Every header is checked before its file is stored. With process False the sizes aren't created, create them
+        later with process_saved_photo.
+        """
+        with metrics.timer('hash'):
+            hashes = [content_hash(file) for file in files]
+        uploaded = find_uploaded_photos(hashes)
+        photos, duplicates, seen = [], [], set()
+        try:
+            for file, digest in zip(files, hashes):
+                if digest in seen:
+                    continue
+                seen.add(digest)
+                if digest in uploaded:
+                    duplicates.append(uploaded[digest])
+                    continue
+                verify_header(file)  # Processors that create the sizes elsewhere would otherwise store anything
+                photo = self.store_photo(file, digest)
+                photos.append(photo)
+                if process:
+                    self.process_photo(photo)
+            bulk_save_photos(photos, upload_id, duplicates)
+        except Exception:
+            self._discard_unsaved(photos)
+            raise
+        return photos
+
+    @staticmethod
+    def _discard_unsaved(photos):
+        """Delete the files of the photos of a failed batch that didn't make it into the database"""
+        saved = set(PHOTO_MODEL.objects.filter(pk__in=[photo.pk for photo in photos]).values_list('pk', flat=True))
+        for photo in photos:
+            if photo.pk not in saved:
+                photo.delete_all_files()
+
+    @instrumented('process_saved_photo')
+    def process_saved_photo(self, photo):
+        """Process a photo that handle_photos saved with process False, and save its manifest"""
+        self.process_photo(photo)
+        photo.save_renditions()
+
+    def store_photo(self, file, digest):
+        """Store the original of a new photo with content hash digest, without creating sizes or saving the photo"""
+        metrics.increment('photos_bytes_in_total', file.size)
+        photo = PHOTO_MODEL(content_hash=digest)
+        with metrics.timer('storage_write', size='original'):
+            photo.image.save(file.name, file, save=False)
+        return photo
+
     def handle_photo(self, file, upload_id):
-        photo = PHOTO_MODEL(image=file)
-        photo.save()
-        UploadedPhotoModel.objects.create(photo=photo, upload_id=upload_id)
+        self.handle_photos([file], upload_id)
 
-    def handle_file(self, file, upload_id):
+    @staticmethod
+    def _is_zip(file):
         name, extension = os.path.splitext(file.name)
-        if extension == '.zip':
+        return extension == '.zip'
+
+    def handle_file(self, file, upload_id):
+        if self._is_zip(file):
             self.handle_zip(file, upload_id)
         else:
             self.handle_photo(file, upload_id)
 
+    def handle_files(self, files, upload_id, process=True):
+        """Returns the photos of the files that aren't zips, process only applies to those, see handle_photos"""
+        photos = []
+        for file in files:
+            if self._is_zip(file):
+                self.handle_zip(file, upload_id)
+            else:
+                photos.append(file)
+        return self.handle_photos(photos, upload_id, process) if photos else []
+
     def delete_photo(self, photo):
         photo.delete()  # Calls photo.delete_all_files
 
+    @instrumented('delete_photos')
     def delete_photos(self, photos):
-        for photo in photos:
-            photo.delete_all_files()
-        photos.delete()  # Bulk delete queryset
+        """
+        Delete a queryset of photos, their files are deleted in batches without loading the photos first, once the
+        transaction commits. The galleries that showed them are refreshed once for the whole queryset.
+        """
+        batches = file_name_batches(photos)
+        with refreshing_galleries_of(photos):
+            photos.delete()  # Bulk delete queryset
+
+        def delete_files():
+            for names in batches:
+                delete_stored_files(IMAGE_STORAGE, names)
+        # A rolled back transaction keeps the photos, and so has to keep their files
+        transaction.on_commit(delete_files, using=photos.db)
 
+    @instrumented('link_photos_to_gallery')
     def link_photos_to_gallery(self, upload_id, gallery):
-        u_m = UploadedPhotoModel.objects.filter(upload_id=upload_id).select_related('photo').only('id', 'photo_id')
-        if gallery is not None:
-            gallery.photos.add(*[uploaded_model.photo for uploaded_model in u_m])
-        u_m.delete()
+        """Add the photos of an upload to gallery by their ids only, and delete their staging rows"""
+        u_m = UploadedPhotoModel.objects.filter(upload_id=upload_id)
+        with transaction.atomic():
+            if gallery is not None:
+                add_photos_to_gallery(gallery, u_m.order_by('pk').values_list('photo_id', flat=True),
+                                      BULK_BATCH_SIZE)
+            u_m.delete()
 
 
 _PHOTO_PROCESSOR = getattr(settings, 'PHOTO_PROCESSOR', BasePhotoProcessor())
@@ -1,26 +1,43 @@
-from ..photo_processors.base_processor import BasePhotoProcessor
-from ..models import PHOTO_MODEL, UploadedPhotoModel, TempZipFile, UploadIdsToGallery
-from ..photo_processors.celery_tasks import parse_zip, delete_photo, delete_photo_files
+from django.db import transaction
+from ..photo_processors.base_processor import BasePhotoProcessor, instrumented
+from ..models import TempZipFile, UploadIdsToGallery, refreshing_galleries_of
+from ..photo_processors.celery_tasks import parse_zip, delete_photo, delete_file_batch, queue_sizes
+from ..photo_processors.utils import file_name_batches
 
 
 class CeleryProcessor(BasePhotoProcessor):
+    @instrumented('handle_zip')
     def handle_zip(self, file, upload_id):
         temp = TempZipFile.objects.create(file=file)
         parse_zip.delay(temp.id, upload_id)
 
-    def handle_photo(self, file, upload_id):
-        photo = PHOTO_MODEL(image=file)
-        photo.save(process=False)
-        UploadedPhotoModel.objects.create(photo=photo, upload_id=upload_id)
+    def process_photo(self, photo):
+        pass  # The sizes are created by workers, once the photo is saved
+
+    def handle_photos(self, files, upload_id, process=True):
+        photos = super().handle_photos(files, upload_id, process)
+        # Workers can only load the photos once they are committed
+        transaction.on_commit(lambda: queue_sizes([photo.pk for photo in photos]))
+        return photos
+
+    def process_saved_photo(self, photo):
+        pass  # Its sizes were queued when it was saved
 
     def delete_photo(self, photo):
         delete_photo.delay(photo)
 
+    @instrumented('delete_photos')
     def delete_photos(self, photos):
-        for photo in photos:
-            delete_photo_files.delay(photo.image.name)
-        photos.delete()
+        batches = file_name_batches(photos)
+        with refreshing_galleries_of(photos):
+            photos.delete()
+
+        def delete_files():
+            for names in batches:
+                delete_file_batch.delay(names)
+        transaction.on_commit(delete_files)
 
+    @instrumented('link_photos_to_gallery')
     def link_photos_to_gallery(self, upload_id, gallery):
         super().link_photos_to_gallery(upload_id, gallery)
         # Celery might still be processing at this moment, that's why we make this model to check later
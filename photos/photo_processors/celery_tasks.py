@@ -1,25 +1,125 @@
-from celery import shared_task
-from ..models import PHOTO_MODEL, TempZipFile
-from ..photo_processors.utils import handle_zip
+from celery import shared_task, chord
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction, OperationalError, InterfaceError
+from ..models import PHOTO_MODEL, IMAGE_SIZES, IMAGE_STORAGE, TempZipFile, UploadIdsToGallery, delete_stored_files
+from ..photo_processors.base_processor import BasePhotoProcessor
+from ..reaper import reap_stale_uploads as _reap_stale_uploads
+from ..photo_processors.utils import shard_zip, handle_zip_shard, link_zip_shards
 
 
-@shared_task(name='photos.tasks.create_sizes', max_retries=5)
+def _area(size_name):
+    width, height = IMAGE_SIZES[size_name]
+    return width * height
+
+
+def _default_priorities():
+    # The smallest box gets priority 9, every larger box 3 less
+    areas = sorted({_area(size_name) for size_name in IMAGE_SIZES})
+    return {size_name: max(0, 9 - 3 * areas.index(_area(size_name))) for size_name in IMAGE_SIZES}
+
+
+# Celery priority of the task of every size. Higher goes first on AMQP brokers, the Redis transport reads them the
+# other way around, so set them yourself there.
+SIZE_PRIORITIES = {**_default_priorities(), **getattr(settings, 'PHOTOS_SIZE_PRIORITIES', {})}
+# Retry policy of every task but reap_stale_uploads. Only errors that may go away are retried, with exponential
+# backoff, an image that can't be decoded fails the same way every time. What a task never completes, like the photos
+# of a zip whose shards kept failing, is left to the reaper.
+TASK_RETRY_POLICY = {'autoretry_for': (ConnectionError, TimeoutError, OperationalError, InterfaceError),
+                     'retry_backoff': True, 'max_retries': 5, **getattr(settings, 'PHOTOS_TASK_RETRY_POLICY', {})}
+# Seconds a queued size keeps the same photo and size from being queued again, in case its task got lost
+SIZE_TASK_TIMEOUT = getattr(settings, 'PHOTOS_SIZE_TASK_TIMEOUT', 10 * 60)
+# The cache that remembers queued sizes. Web processes set the keys and workers delete them, so it has to be a cache
+# they share, sizes are always queued with a process-local one.
+SIZE_TASK_CACHE = getattr(settings, 'PHOTOS_SIZE_TASK_CACHE', 'default')
+
+
+def _queued_key(photo_id, size_name):
+    return 'photos:size-task:{}:{}'.format(photo_id, size_name)
+
+
+def _size_task_cache():
+    size_task_cache = caches[SIZE_TASK_CACHE]
+    return None if isinstance(size_task_cache, LocMemCache) else size_task_cache
+
+
+def queue_sizes(photo_ids, size_names=None):
+    """
+    Queue a create_size task for every photo and size, the small sizes of all photos first, so galleries can be shown
+    before the large sizes exist. A size that is still queued for a photo isn't queued again, see SIZE_TASK_CACHE.
+    """
+    size_task_cache = _size_task_cache()
+    for size_name in sorted(size_names or IMAGE_SIZES, key=_area):
+        for photo_id in photo_ids:
+            key = _queued_key(photo_id, size_name)
+            if size_task_cache is None or size_task_cache.add(key, True, SIZE_TASK_TIMEOUT):
+                create_size.apply_async((str(photo_id), size_name), priority=SIZE_PRIORITIES[size_name])
+
+
+@shared_task(name='photos.tasks.create_size', **TASK_RETRY_POLICY)
+def create_size(photo_id, size_name):
+    # From now on the size can be queued again, even when this attempt fails, a later request might be for a new image
+    size_task_cache = _size_task_cache()
+    if size_task_cache is not None:
+        size_task_cache.delete(_queued_key(photo_id, size_name))
+    photo = PHOTO_MODEL.objects.filter(pk=photo_id).first()
+    if photo is not None and size_name in IMAGE_SIZES:  # The photo might be deleted meanwhile
+        photo.get_or_create_size(size_name)  # Sets renditions_ready when this was the last missing size
+
+
+@shared_task(name='photos.tasks.create_sizes', **TASK_RETRY_POLICY)
 def update_sizes(photo_id):
-    photo = PHOTO_MODEL.objects.get(id=photo_id)
-    photo.update_sizes(running_in_task=True)
+    photo = PHOTO_MODEL.objects.filter(pk=photo_id).first()
+    if photo is not None:
+        queue_sizes([photo.pk], photo.missing_sizes())
 
 
-@shared_task(name='photos.tasks.delete_photo_files', max_retries=5)
+@shared_task(name='photos.tasks.delete_photo_files', **TASK_RETRY_POLICY)
 def delete_photo_files(filepath):
     PHOTO_MODEL.delete_files(filepath)
 
 
-@shared_task(name='photos.tasks.delete_photo', max_retries=5)
+@shared_task(name='photos.tasks.delete_file_batch', **TASK_RETRY_POLICY)
+def delete_file_batch(names):
+    delete_stored_files(IMAGE_STORAGE, names)
+
+
+@shared_task(name='photos.tasks.delete_photo', **TASK_RETRY_POLICY)
 def delete_photo(photo):
     photo.delete()
 
 
-@shared_task(name='photos.tasks.parse_zip', max_retries=5)
+@shared_task(name='photos.tasks.parse_zip', **TASK_RETRY_POLICY)
 def parse_zip(zip_file_id, upload_id):
-    file = TempZipFile.objects.get(id=zip_file_id).file
-    handle_zip(file, upload_id)
+    """Split the members of a zip in shards that are handled by parallel tasks, finish_zip runs after the last one"""
+    shards = shard_zip(TempZipFile.objects.get(id=zip_file_id).file)
+    finish = finish_zip.s(zip_file_id, str(upload_id))
+    if shards:
+        chord(parse_zip_shard.s(zip_file_id, names, str(upload_id)) for names in shards)(finish)
+    else:
+        finish.delay([])
+
+
+@shared_task(name='photos.tasks.parse_zip_shard', **TASK_RETRY_POLICY)
+def parse_zip_shard(zip_file_id, names, upload_id):
+    return handle_zip_shard(TempZipFile.objects.get(id=zip_file_id).file, names, upload_id)
+
+
+@shared_task(name='photos.tasks.finish_zip', **TASK_RETRY_POLICY)
+def finish_zip(results, zip_file_id, upload_id):
+    with transaction.atomic():
+        link_zip_shards(results, upload_id)
+    temp = TempZipFile.objects.get(id=zip_file_id)
+    temp.file.delete(save=False)
+    temp.delete()
+    # The upload might have been linked to a gallery before the photos of the zip were there
+    link = UploadIdsToGallery.objects.filter(upload_id=upload_id).select_related('gallery').first()
+    if link is not None:
+        BasePhotoProcessor().link_photos_to_gallery(upload_id, link.gallery)
+
+
+@shared_task(name='photos.tasks.reap_stale_uploads')
+def reap_stale_uploads():
+    """Run this periodically with celery beat"""
+    return _reap_stale_uploads()
@@ -1,36 +1,269 @@
+import logging
+import multiprocessing
 import os
+import tempfile
 import zipfile
-from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
 
-from PIL import Image
-from django.core.files.base import ContentFile
+from django.conf import settings
+from django.core.files.base import File
+from django.db import transaction
 
+from .. import metrics
+from ..engines import get_engine
+from ..hashing import new_content_hash
 from ..models import PHOTO_MODEL, UploadedPhotoModel
 
+logger = logging.getLogger('photos.photo_processors')
 
-def handle_zip(file, upload_id):
+# Members larger than this are spooled to disk instead of memory
+ZIP_SPOOL_MAX_SIZE = getattr(settings, 'PHOTOS_ZIP_SPOOL_MAX_SIZE', 10 * 1024 * 1024)
+ZIP_CHUNK_SIZE = 64 * 1024
+# Amount of processes that create the sizes of the photos in a zip, 1 means everything happens in this process
+ZIP_WORKERS = getattr(settings, 'PHOTOS_ZIP_WORKERS', 1)
+# Amount of rows inserted per query and per transaction when saving photos in bulk
+BULK_BATCH_SIZE = getattr(settings, 'PHOTOS_BULK_BATCH_SIZE', 500)
+# Link an upload to the existing photo with the same content instead of storing and processing it again
+DEDUPLICATE_UPLOADS = getattr(settings, 'PHOTOS_DEDUPLICATE_UPLOADS', True)
+# Amount of files deleted per storage call (or thread pool), and per task with the CeleryProcessor
+DELETE_BATCH_SIZE = getattr(settings, 'PHOTOS_DELETE_BATCH_SIZE', 1000)
+# Amount of members of a zip that are spooled and hashed before the photos they duplicate are looked up with one
+# query. Every spooled member stays open until its batch is handled, in memory when it is small.
+ZIP_LOOKUP_BATCH_SIZE = getattr(settings, 'PHOTOS_ZIP_LOOKUP_BATCH_SIZE', 20)
+# Amount of members of a zip the CeleryProcessor handles per task
+ZIP_SHARD_SIZE = getattr(settings, 'PHOTOS_ZIP_SHARD_SIZE', 10)
+
+
+def is_photo_member(info):
+    filename = info.filename
+    if filename.startswith('__') or filename.startswith('.'):
+        return False
+    if os.path.dirname(filename):
+        return False
+    return info.file_size > 0
+
+
+def photo_members(zip_file):
+    """The members of zip_file that might be photos, sorted by filename"""
+    return sorted((info for info in zip_file.infolist() if is_photo_member(info)), key=lambda info: info.filename)
+
+
+def spool_member(zip_file, info):
+    """
+    Copy a zip member, chunk by chunk, to a temporary file that only stays in memory when it is small.
+    Returns that file and the content hash of the member, which is computed while copying.
+    """
+    spooled = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_MAX_SIZE)
+    digest = new_content_hash()
+    with zip_file.open(info) as member:
+        for chunk in iter(lambda: member.read(ZIP_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            spooled.write(chunk)
+    spooled.seek(0)
+    return spooled, digest.hexdigest()
+
+
+def find_uploaded_photos(hashes):
+    """Map every content hash in hashes that belongs to an existing photo on that photo, the oldest one wins"""
+    if not DEDUPLICATE_UPLOADS or not hashes:
+        return {}
+    found = {}
+    for photo in PHOTO_MODEL.objects.filter(content_hash__in=hashes).order_by('pk').only('pk', 'content_hash'):
+        found.setdefault(photo.content_hash, photo)
+    return found
+
+
+def verify_header(file):
+    """Raise an exception if file isn't an image. Only the header is read, decoding happens when creating sizes."""
+    get_engine().verify(file)
+
+
+def _spool_members(zip_file, members):
+    """spool_member for every member in members, as (info, spooled, digest). Members that can't be read are left out."""
+    spooled_members = []
+    for info in members:
+        metrics.increment('photos_bytes_in_total', info.file_size)
+        try:
+            spooled_members.append((info, *spool_member(zip_file, info)))
+        except Exception:
+            metrics.increment('photos_errors_total', stage='zip_member')
+    return spooled_members
+
+
+def _iter_zip_photos(zip_file, duplicates, names=None):
+    """
+    Store every new photo in zip_file, or only the members names, without creating its sizes or saving it to the
+    database. Members that were uploaded before are appended to duplicates instead, members that occur twice in the
+    zip are only handled once. The members are spooled and hashed ZIP_LOOKUP_BATCH_SIZE at a time, so uploaded
+    photos are looked up with one query per batch.
+    """
+    seen = set()
+    members = photo_members(zip_file) if names is None else [zip_file.getinfo(name) for name in names]
+    for start in range(0, len(members), ZIP_LOOKUP_BATCH_SIZE):
+        spooled_members = _spool_members(zip_file, members[start:start + ZIP_LOOKUP_BATCH_SIZE])
+        try:
+            uploaded = find_uploaded_photos(list({digest for info, spooled, digest in spooled_members}))
+            for info, spooled, digest in spooled_members:
+                if digest in seen:
+                    continue
+                seen.add(digest)
+                if digest in uploaded:
+                    duplicates.append(uploaded[digest])
+                    continue
+                try:
+                    verify_header(spooled)
+                    photo = PHOTO_MODEL(content_hash=digest)
+                    with metrics.timer('storage_write', size='original'):
+                        photo.image.save(info.filename, File(spooled, name=info.filename), save=False)
+                except Exception:
+                    metrics.increment('photos_errors_total', stage='zip_member')
+                    continue
+                yield photo
+        finally:
+            for info, spooled, digest in spooled_members:
+                spooled.close()
+
+
+def _create_sizes_in_worker(image_name):
+    """Runs in a worker process, which may not touch the database. Returns the renditions manifest and the hash."""
+    try:
+        photo = PHOTO_MODEL(image=image_name)
+        photo._create_sizes()
+        return photo.renditions, photo.perceptual_hash
+    except Exception as e:
+        logger.warning("Couldn't create sizes for {}: {}".format(image_name, e))
+        return None
+
+
+def _get_worker_context():
+    # Forked workers inherit the configured settings, spawned ones would have to set up Django again
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return None
+
+
+def _handle_zip_parallel(zip_file, workers, duplicates):
+    stored = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=_get_worker_context()) as executor:
+        # Sizes are created while the next members are still being extracted
+        for photo in _iter_zip_photos(zip_file, duplicates):
+            stored.append((photo, executor.submit(_create_sizes_in_worker, photo.image.name)))
+
+        photos = []
+        for photo, future in stored:  # Keeps the order of the members
+            result = future.result()
+            if result is not None:
+                photo.renditions, photo.perceptual_hash = result
+                photo.renditions_ready = not photo.missing_sizes()
+                photos.append(photo)
+            else:
+                photo.delete_all_files()
+    return photos
+
+
+def _handle_zip_serial(zip_file, duplicates, names=None):
     photos = []
+    for photo in _iter_zip_photos(zip_file, duplicates, names):
+        try:
+            photo.update_sizes()
+            photos.append(photo)
+        except Exception:
+            photo.delete_all_files()
+    return photos
+
+
+def bulk_save_photos(photos, upload_id, duplicates=(), batch_size=None):
+    """
+    Insert already stored photos and their UploadedPhotoModel rows with bulk_create, one transaction per batch.
+    duplicates are existing photos that were uploaded again, only their UploadedPhotoModel rows are inserted.
+    Like any bulk_create, this doesn't call save() or send the pre/post_save signals.
+    """
+    batch_size = batch_size or BULK_BATCH_SIZE
+    for start in range(0, len(photos), batch_size):
+        batch = photos[start:start + batch_size]
+        with metrics.timer('db_insert'), transaction.atomic():
+            PHOTO_MODEL.objects.bulk_create(batch)
+            UploadedPhotoModel.objects.bulk_create([UploadedPhotoModel(upload_id=upload_id, photo=photo)
+                                                    for photo in batch])
+    if duplicates:
+        UploadedPhotoModel.objects.bulk_create(
+            [UploadedPhotoModel(upload_id=upload_id, photo=photo, created_photo=False) for photo in duplicates],
+            batch_size=batch_size)
 
+
+def handle_zip(file, upload_id, workers=None):
+    workers = ZIP_WORKERS if workers is None else workers
+
+    duplicates = []
     with zipfile.ZipFile(file) as zip_file:
-        for filename in sorted(zip_file.namelist()):
-            if filename.startswith('__') or filename.startswith('.'):
-                continue
-            if os.path.dirname(filename):
-                continue
-            data = zip_file.read(filename)
-            if not len(data):
-                continue
-
-            try:
-                file = BytesIO(data)
-                opened = Image.open(file)
-                opened.verify()
-                photo = PHOTO_MODEL()
-                content_file = ContentFile(data)
-                photo.image.save(filename, content_file)
-                photo.save()
-                photos.append(photo)
-            except Exception:
-                pass
+        if workers > 1:
+            photos = _handle_zip_parallel(zip_file, workers, duplicates)
+        else:
+            photos = _handle_zip_serial(zip_file, duplicates)
+
+    bulk_save_photos(photos, upload_id, duplicates)
+
+
+def shard_zip(file, shard_size=None):
+    """The names of the photo members of a zip in lists of shard_size, only its central directory is read"""
+    shard_size = shard_size or ZIP_SHARD_SIZE
+    with zipfile.ZipFile(file) as zip_file:
+        names = [info.filename for info in photo_members(zip_file)]
+    return [names[start:start + shard_size] for start in range(0, len(names), shard_size)]
+
+
+def handle_zip_shard(file, names, upload_id):
+    """
+    Store and insert the photos of the members names of a zip, with their sizes and UploadedPhotoModel rows, so the
+    reaper removes them when another shard fails. Returns the ids of the new photos and the ids of the existing photos
+    that were uploaded again, for link_zip_shards.
+    """
+    duplicates = []
+    with zipfile.ZipFile(file) as zip_file:
+        photos = _handle_zip_serial(zip_file, duplicates, names)
+    bulk_save_photos(photos, upload_id, duplicates)
+    return [str(photo.pk) for photo in photos], [str(photo.pk) for photo in duplicates]
+
+
+def link_zip_shards(results, upload_id):
+    """
+    Put the UploadedPhotoModel rows of all shards of a zip in the order of the shards. Shards don't see each other's
+    photos, of new photos with the same content only the first one is kept.
+    """
+    photo_ids, duplicate_ids = [], []
+    for new_ids, existing_ids in results:
+        photo_ids.extend(new_ids)
+        duplicate_ids.extend(existing_ids)
+
+    hashes = {str(pk): digest for pk, digest in
+              PHOTO_MODEL.objects.filter(pk__in=photo_ids).values_list('pk', 'content_hash')}
+    kept, extra, seen = [], [], set()
+    for photo_id in photo_ids:
+        if photo_id not in hashes:  # Deleted by an earlier attempt
+            continue
+        if DEDUPLICATE_UPLOADS and hashes[photo_id] in seen:
+            extra.append(photo_id)
+        else:
+            seen.add(hashes[photo_id])
+            kept.append(photo_id)
+    for photo in PHOTO_MODEL.objects.filter(pk__in=extra):
+        photo.delete()  # Their rows are deleted along
+
+    rows = [UploadedPhotoModel(upload_id=upload_id, photo_id=photo_id) for photo_id in kept]
+    seen_ids = set(kept)
+    rows.extend(UploadedPhotoModel(upload_id=upload_id, photo_id=photo_id, created_photo=False)
+                for photo_id in dict.fromkeys(duplicate_ids) if photo_id not in seen_ids)
+    # The shards inserted their rows as they finished, a gallery gets the photos in the order of the rows
+    staged = [row.photo_id for row in rows]
+    with transaction.atomic():
+        for start in range(0, len(staged), BULK_BATCH_SIZE):
+            UploadedPhotoModel.objects.filter(upload_id=upload_id,
+                                              photo_id__in=staged[start:start + BULK_BATCH_SIZE]).delete()
+        UploadedPhotoModel.objects.bulk_create(rows, batch_size=BULK_BATCH_SIZE)
+
 
-    UploadedPhotoModel.objects.bulk_create([UploadedPhotoModel(upload_id=upload_id, photo=photo) for photo in photos])
+def file_name_batches(photos, batch_size=None):
+    """The names of all stored files of a queryset of photos, in lists of batch_size"""
+    batch_size = batch_size or DELETE_BATCH_SIZE
+    names = list(dict.fromkeys(photos.stored_file_names()))
+    return [names[start:start + batch_size] for start in range(0, len(names), batch_size)]
@@ -0,0 +1,111 @@
+"""
+Removal of what abandoned uploads leave behind: UploadedPhotoModel rows whose upload was never linked to a gallery,
+the photos only those rows refer to, and, with PHOTOS_USE_ASYNC, TempZipFiles and UploadIdsToGallery rows. Also
+the directories of chunked uploads that were never completed.
+
+Everything is read and deleted in chunks of consecutive primary keys, one transaction per chunk.
+"""
+import os
+import shutil
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import models
+from .chunked_uploads import CHUNKED_UPLOAD_DIR
+from .models import PHOTO_MODEL, UploadedPhotoModel, TEMP_FILE_STORAGE, delete_stored_files
+from .photo_processors.base_processor import get_photo_processor
+
+# Uploads older than this many hours are considered abandoned
+STALE_UPLOAD_HOURS = getattr(settings, 'PHOTOS_STALE_UPLOAD_HOURS', 72)
+# Amount of rows per query and per transaction
+REAPER_BATCH_SIZE = getattr(settings, 'PHOTOS_REAPER_BATCH_SIZE', 500)
+
+
+def _chunks(queryset, batch_size):
+    """Querysets of at most batch_size rows of queryset each, by ranges of their primary keys"""
+    last_pk = None
+    while True:
+        page = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        pks = list(page.order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return
+        yield queryset.filter(pk__gte=pks[0], pk__lte=pks[-1])
+        last_pk = pks[-1]
+
+
+def reap_uploaded_photos(cutoff, batch_size):
+    """
+    Delete the UploadedPhotoModel rows created before cutoff. Their photos are deleted as well, unless they are in a
+    gallery, existed before the upload or belong to a newer upload. Returns the amount of rows and photos deleted.
+    """
+    rows_deleted = photos_deleted = 0
+    for rows in _chunks(UploadedPhotoModel.objects.filter(created_at__lt=cutoff), batch_size):
+        with transaction.atomic():
+            orphans = list(PHOTO_MODEL.objects.filter(
+                pk__in=rows.filter(created_photo=True).values('photo_id'), galleries__isnull=True,
+            ).exclude(uploaded_photo__created_at__gte=cutoff).values_list('pk', flat=True))
+            rows_deleted += rows.delete()[0]
+            if orphans:
+                get_photo_processor().delete_photos(PHOTO_MODEL.objects.filter(pk__in=orphans))
+                photos_deleted += len(orphans)
+    return rows_deleted, photos_deleted
+
+
+def reap_temp_zip_files(cutoff, batch_size):
+    """Delete the TempZipFiles created before cutoff and their files, their tasks have failed long ago"""
+    deleted = 0
+    for temp_files in _chunks(models.TempZipFile.objects.filter(created_at__lt=cutoff), batch_size):
+        with transaction.atomic():
+            names = [name for name in temp_files.values_list('file', flat=True) if name]
+            deleted += temp_files.delete()[0]
+            transaction.on_commit(partial(delete_stored_files, TEMP_FILE_STORAGE, names))
+    return deleted
+
+
+def reap_upload_galleries(cutoff, batch_size):
+    deleted = 0
+    for links in _chunks(models.UploadIdsToGallery.objects.filter(created_at__lt=cutoff), batch_size):
+        with transaction.atomic():
+            deleted += links.delete()[0]
+    return deleted
+
+
+def reap_chunked_uploads(cutoff):
+    """Remove the directories of chunked uploads in which nothing was written since cutoff"""
+    removed = 0
+    cutoff = cutoff.timestamp()
+    try:
+        directories = list(os.scandir(CHUNKED_UPLOAD_DIR))
+    except FileNotFoundError:
+        return 0
+    for directory in directories:
+        if not directory.is_dir(follow_symlinks=False):
+            continue
+        try:
+            entries = list(os.scandir(directory.path))
+            last_write = max([directory.stat().st_mtime] + [entry.stat().st_mtime for entry in entries])
+        except FileNotFoundError:  # Completed meanwhile
+            continue
+        if last_write < cutoff:
+            shutil.rmtree(directory.path, ignore_errors=True)
+            removed += 1
+    return removed
+
+
+def reap_stale_uploads(max_age_hours=None, batch_size=None):
+    """Remove everything abandoned uploads left behind that is older than max_age_hours, returns what was removed"""
+    max_age_hours = STALE_UPLOAD_HOURS if max_age_hours is None else max_age_hours
+    batch_size = batch_size or REAPER_BATCH_SIZE
+    cutoff = timezone.now() - timedelta(hours=max_age_hours)
+
+    reaped = {}
+    reaped['uploaded_photos'], reaped['photos'] = reap_uploaded_photos(cutoff, batch_size)
+    if models.USE_ASYNC:
+        reaped['temp_zip_files'] = reap_temp_zip_files(cutoff, batch_size)
+        reaped['upload_galleries'] = reap_upload_galleries(cutoff, batch_size)
+    reaped['chunked_uploads'] = reap_chunked_uploads(cutoff)
+    return reaped
@@ -0,0 +1,167 @@
+import math
+import threading
+from contextlib import contextmanager, nullcontext
+from io import BytesIO
+
+from PIL import Image
+
+from .exceptions import ImageTooLargeError
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Increase this when the renditions change, so update_sizes knows existing ones are outdated
+RENDITION_VERSION = 1
+# Same default as Image.thumbnail: the decoder and the first resize only need to get within this factor of the
+# target, the final resize takes care of the rest.
+REDUCING_GAP = 2.0
+# In low memory mode a JPEG decoder only produces the scale the largest rendition needs
+LOW_MEMORY_REDUCING_GAP = 1.0
+
+
+class PixelBudget:
+    """
+    Limits the amount of pixels that can be decoded at the same time in this process.
+    Images that are larger than the whole budget are refused, others wait until enough of the budget is free.
+    """
+    def __init__(self, max_pixels=None, timeout=None):
+        self.max_pixels = max_pixels
+        self.timeout = timeout
+        self.in_use = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, pixels):
+        if self.max_pixels is None:
+            yield
+            return
+        if pixels > self.max_pixels:
+            raise ImageTooLargeError('This image is too large to be processed ({} pixels, the maximum is {})'.format(
+                pixels, self.max_pixels))
+
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.in_use + pixels <= self.max_pixels, self.timeout):
+                raise ImageTooLargeError('The server is too busy to process this image, please try again later')
+            self.in_use += pixels
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_use -= pixels
+                self._condition.notify_all()
+
+
+def process_peak_rss():
+    """
+    The peak resident set size of this whole process so far in KiB, or None if the platform can't tell. It only grows,
+    the difference of two calls is how much the work in between raised the peak, not how much memory it used.
+    """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _round_aspect(number, key):
+    return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+
+def fit_size(image_size, box):
+    """Return the dimensions Image.thumbnail(box) would give an image of image_size"""
+    width, height = image_size
+    x, y = map(math.floor, box)
+    if x >= width and y >= height:
+        return width, height
+    aspect = width / height
+    if x / y >= aspect:
+        x = _round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = _round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return x, y
+
+
+def _covers(image, dimensions):
+    return image.width >= dimensions[0] and image.height >= dimensions[1]
+
+
+def _untimed(stage, **tags):
+    return nullcontext()
+
+
+def iter_renditions(image, sizes, low_memory=False, budget=None, timer=None):
+    """
+    Yield (size, rendition) for every size in sizes, from the largest rendition to the smallest.
+    The original is decoded only once, every rendition is resized from the previous one whenever that one is still
+    big enough, otherwise from the original.
+    When a budget is given, the decoded pixels are reserved from it until the last rendition was yielded.
+    timer(stage, **tags) can give a context manager that times the decode and every resize, see photos.metrics.
+    """
+    timer = timer or _untimed
+    targets = [(fit_size(image.size, size), size) for size in dict.fromkeys(sizes)]
+    targets.sort(key=lambda target: target[0][0] * target[0][1], reverse=True)
+    if not targets:
+        return
+
+    budget = budget or PixelBudget()
+    # Drafting only changes the scale the decoder will use, nothing is decoded yet. Only JPEG decoders can scale, other
+    # formats are decoded at full resolution whatever low_memory is, their memory is only bounded by the budget.
+    largest = targets[0][0]
+    gap = LOW_MEMORY_REDUCING_GAP if low_memory else REDUCING_GAP
+    image.draft(None, (int(largest[0] * gap), int(largest[1] * gap)))
+
+    with budget.reserve(image.width * image.height):
+        with timer('decode'):
+            image.load()
+        original = source = image
+        for dimensions, size in targets:
+            if not _covers(source, dimensions):
+                source = original
+            if source.size == dimensions:
+                rendition = source
+            else:
+                with timer('resize', box='{}x{}'.format(*size)):
+                    rendition = source.resize(dimensions, Image.ANTIALIAS, reducing_gap=REDUCING_GAP)
+            yield size, rendition
+            source = rendition
+
+
+def supports_format(image_format):
+    """Whether Pillow can encode image_format, AVIF for example needs a plugin"""
+    Image.init()
+    return image_format.upper() in Image.SAVE
+
+
+def format_extension(image_format):
+    return '.{}'.format(image_format.lower())
+
+
+def format_mime_type(image_format):
+    return Image.MIME.get(image_format.upper(), 'image/{}'.format(image_format.lower()))
+
+
+def encoder_options(image, profile=None):
+    """
+    The keyword arguments for Image.save of an encoder profile, a dict that can contain:
+    quality, progressive and subsampling (used by the formats that support them), optimize (default True) and
+    strip_metadata (True drops EXIF and ICC data, False keeps them, by default every format does what Pillow does).
+    """
+    profile = profile or {}
+    options = {'optimize': profile.get('optimize', True)}
+    for option in ('quality', 'progressive', 'subsampling'):
+        if option in profile:
+            options[option] = profile[option]
+    if 'strip_metadata' in profile:
+        if profile['strip_metadata']:
+            options.update({'exif': b'', 'icc_profile': None})
+        else:
+            options.update({'exif': image.info.get('exif', b''), 'icc_profile': image.info.get('icc_profile')})
+    return options
+
+
+def encode_image(image, image_format, profile=None):
+    if image_format.upper() == 'JPEG' and image.mode not in ('RGB', 'L', 'CMYK'):
+        image = image.convert('RGB')  # E.g. a PNG with transparency that is stored as a JPEG
+    buffer = BytesIO()
+    image.save(buffer, image_format, **encoder_options(image, profile))
+    return buffer.getvalue()
@@ -0,0 +1,82 @@
+from PIL import Image
+
+# Width and height of the gradient grid, a hash has HASH_SIZE * HASH_SIZE bits
+HASH_SIZE = 8
+
+
+def perceptual_hash(image):
+    """
+    The difference hash (dHash) of image, as a hex string. Every bit tells whether a pixel of the downscaled grayscale
+    image is brighter than its right neighbour, so it survives re-encoding, resizing and small crops or edits.
+    Meant to be computed from a small rendition, which is already decoded anyway.
+    """
+    grid = image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.ANTIALIAS)
+    return difference_hash(list(grid.getdata()))
+
+
+def difference_hash(pixels):
+    """The dHash of the grayscale values of a (HASH_SIZE + 1) x HASH_SIZE grid, row by row"""
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for column in range(HASH_SIZE):
+            value = (value << 1) | (pixels[offset + column] > pixels[offset + column + 1])
+    return '{:0{}x}'.format(value, HASH_SIZE * HASH_SIZE // 4)
+
+
+def hamming_distance(a, b):
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+
+class BKTree:
+    """
+    A Burkhard-Keller tree of perceptual hashes. The children of a node are keyed by their distance to it, so the
+    triangle inequality lets a search skip every subtree that can't hold a hash within the maximum distance.
+    """
+    def __init__(self, items=()):
+        self._root = None
+        self._size = 0
+        for hash, value in items:
+            self.add(hash, value)
+
+    def __len__(self):
+        return self._size
+
+    def add(self, hash, value):
+        node = (int(hash, 16), value, {})
+        self._size += 1
+        if self._root is None:
+            self._root = node
+            return
+        current = self._root
+        while True:
+            distance = bin(current[0] ^ node[0]).count('1')
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, hash, max_distance):
+        """Return (distance, value) for every hash within max_distance of hash, closest first"""
+        if self._root is None:
+            return []
+        target = int(hash, 16)
+        found = []
+        candidates = [self._root]
+        while candidates:
+            node_hash, value, children = candidates.pop()
+            distance = bin(node_hash ^ target).count('1')
+            if distance <= max_distance:
+                found.append((distance, value))
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    candidates.append(child)
+        found.sort(key=lambda result: result[0])
+        return found
+
+    @classmethod
+    def from_queryset(cls, queryset):
+        """Index the pk of every photo in queryset that has a perceptual hash"""
+        return cls((hash, pk) for pk, hash in queryset.exclude(perceptual_hash='')
+                   .values_list('pk', 'perceptual_hash').iterator())
@@ -1,13 +1,81 @@
 Dropzone.autoDiscover = false;
 
+// The same file in the same upload always gets the same uuid, so an interrupted upload can be resumed
+function photosFileUuid(uploadId, file) {
+    const key = [uploadId, file.name, file.size, file.lastModified].join('/');
+    let hash = '';
+    for (let seed = 1; seed <= 4; seed++) {
+        let h = 0x811c9dc5 ^ seed;
+        for (let i = 0; i < key.length; i++) {
+            h ^= key.charCodeAt(i);
+            h = Math.imul(h, 0x01000193);
+        }
+        hash += (h >>> 0).toString(16).padStart(8, '0');
+    }
+    return [hash.slice(0, 8), hash.slice(8, 12), hash.slice(12, 16), hash.slice(16, 20), hash.slice(20)].join('-');
+}
+
+function photosFinalizeChunks(dropzone, params, file, done) {
+    const data = new FormData();
+    Object.keys(params).forEach(key => data.append(key, params[key]));
+    data.append('dzuuid', file.upload.uuid);
+    data.append('dzfinalize', '1');
+    data.append('filename', file.name);
+    data.append('dztotalchunkcount', file.upload.totalChunkCount);
+    data.append('dztotalfilesize', file.size);
+    fetch(dropzone.options.url, {method: 'POST', body: data, credentials: 'same-origin'}).then(response => {
+        if (response.ok) {
+            done();
+        } else {
+            return response.text().then(message => dropzone._errorProcessing([file], message));
+        }
+    }).catch(error => dropzone._errorProcessing([file], error.message));
+}
+
+function photosResumeChunks(dropzone, params, file) {
+    const query = new URLSearchParams({'upload_id': params['upload_id'], 'dzuuid': file.upload.uuid});
+    return fetch(dropzone.options.url + '?' + query, {credentials: 'same-origin'})
+        .then(response => response.ok ? response.json() : {'received_chunks': []})
+        .then(status => file.receivedChunks = new Set(status['received_chunks']))
+        .catch(() => file.receivedChunks = new Set());
+}
+
 document.addEventListener("DOMContentLoaded", function (event) {
     document.querySelectorAll('[id^="photos-dropzone-widget"]').forEach(element => {
         options = JSON.parse(element.textContent);
-        options['params'] = {
+        const params = {
             'csrfmiddlewaretoken': document.querySelector('input[name=\"csrfmiddlewaretoken\"]').getAttributeNode('value').value,
             'upload_id': document.querySelector('input[name=\"upload_id\"]').getAttributeNode('value').value,
         };
+        options['params'] = params;
         options['paramName'] = 'file';
-        new Dropzone('div.' + options.class, options);
+        if (options['chunking']) {
+            // Files are only queued once we know which chunks the server already has
+            options['autoProcessQueue'] = false;
+            options['chunksUploaded'] = (file, done) => photosFinalizeChunks(dropzone, params, file, done);
+        }
+        const dropzone = new Dropzone('div.' + options.class, options);
+
+        if (options['chunking']) {
+            dropzone.on('addedfile', file => {
+                if (file.size <= dropzone.options.chunkSize && !dropzone.options.forceChunking) {
+                    return setTimeout(() => dropzone.processQueue());
+                }
+                file.upload.uuid = photosFileUuid(params['upload_id'], file);
+                photosResumeChunks(dropzone, params, file).then(() => dropzone.processQueue());
+            });
+            dropzone.on('complete', () => dropzone.processQueue());
+
+            // Chunks the server already stored are marked as finished instead of being sent again
+            const uploadData = dropzone._uploadData;
+            dropzone._uploadData = function (files, dataBlocks) {
+                const file = files[0];
+                const chunkIndex = dataBlocks[0].chunkIndex;
+                if (file.upload.chunked && file.receivedChunks && file.receivedChunks.has(chunkIndex)) {
+                    return setTimeout(() => file.upload.finishedChunkUpload(file.upload.chunks[chunkIndex]));
+                }
+                return uploadData.call(this, files, dataBlocks);
+            };
+        }
     })
 });
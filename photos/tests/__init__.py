@@ -0,0 +1,6 @@
+import tempfile
+from django.test import override_settings
+
+# Everything the tests store goes to a directory that is removed when the test run ends
+_media_root = tempfile.TemporaryDirectory(prefix='photos-tests-')
+override_settings(MEDIA_ROOT=_media_root.name).enable()
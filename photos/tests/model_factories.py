@@ -8,8 +8,7 @@ from PIL import Image
 from django.core.files.base import File
 
 
-def get_image_file(name='test.png', ext='png', size=(2000, 2000)):
-    color = (255, 0, 0, 0)
+def get_image_file(name='test.png', ext='png', size=(2000, 2000), color=(255, 0, 0, 0)):
     file_obj = BytesIO()
     image = Image.new("RGB", size=size, color=color)
     image.save(file_obj, ext)
@@ -0,0 +1,56 @@
+from uuid import uuid4
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.urls import reverse
+from ..admin import PhotoAdmin
+from ..forms import GalleryForm
+from ..models import PHOTO_MODEL, GALLERY_MODEL
+from ..photo_processors.base_processor import BasePhotoProcessor
+from .model_factories import GalleryFactory, get_image_file
+
+
+class DeleteWithPhotosTest(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(user)
+
+    def tearDown(self):
+        for photo in PHOTO_MODEL.objects.all():
+            photo.delete()
+
+    def upload_to(self, gallery, *colors):
+        upload_id = uuid4()
+        processor = BasePhotoProcessor()
+        processor.handle_photos([get_image_file(size=(120, 80), color=color) for color in colors], upload_id)
+        processor.link_photos_to_gallery(upload_id, gallery)
+
+    def test_shared_photo_is_kept(self):
+        deleted, kept = GalleryFactory(), GalleryFactory()
+        self.upload_to(deleted, (1, 0, 0), (2, 0, 0))
+        self.upload_to(kept, (2, 0, 0))  # A duplicate, both galleries show the same photo
+        shared = kept.photos.get()
+
+        response = self.client.post(reverse('admin:delete_with_photos'), {'id[]': [str(deleted.pk)]})
+        self.assertEqual(302, response.status_code)
+        self.assertEqual([kept.pk], list(GALLERY_MODEL.objects.values_list('pk', flat=True)))
+        self.assertEqual([shared.pk], list(PHOTO_MODEL.objects.values_list('pk', flat=True)))
+        self.assertTrue(shared.image.storage.exists(shared.image.name))
+
+
+class StagedDuplicateTest(TestCase):
+    def tearDown(self):
+        for photo in PHOTO_MODEL.objects.all():
+            photo.delete()
+
+    def test_photo_stays_listed(self):
+        processor = BasePhotoProcessor()
+        upload_id = uuid4()
+        processor.handle_photos([get_image_file(size=(120, 80), color=(3, 0, 0))], upload_id)
+        processor.link_photos_to_gallery(upload_id, GalleryFactory())
+        photo = PHOTO_MODEL.objects.get()
+        # Uploaded again, its staging row waits for the next gallery to be saved
+        processor.handle_photos([get_image_file(size=(120, 80), color=(3, 0, 0))], uuid4())
+
+        self.assertEqual([photo], list(PhotoAdmin(PHOTO_MODEL, admin.site).get_queryset(None)))
+        self.assertEqual([photo], list(GalleryForm().fields['photos'].queryset))
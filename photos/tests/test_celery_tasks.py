@@ -0,0 +1,50 @@
+import importlib.util
+import tempfile
+from unittest import mock, skipUnless
+from django.test import TestCase, override_settings
+from ..models import PHOTO_MODEL, USE_ASYNC
+from .model_factories import get_image_file
+
+
+def shared_cache(location):
+    # Unlike the default LocMemCache, a file based cache is shared by web processes and workers
+    return {'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location}}
+
+
+@skipUnless(USE_ASYNC and importlib.util.find_spec('celery'), 'needs celery and PHOTOS_USE_ASYNC = True')
+class QueueSizesTest(TestCase):
+    def setUp(self):
+        from ..photo_processors import celery_tasks
+        self.tasks = celery_tasks
+        self.photo = PHOTO_MODEL(image=get_image_file())
+        self.photo.save(process=False)
+        patcher = mock.patch.object(celery_tasks.create_size, 'apply_async')
+        self.apply_async = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.photo.delete()
+
+    def queued(self):
+        return [call.args[0] for call in self.apply_async.call_args_list]
+
+    def test_queued_once(self):
+        with tempfile.TemporaryDirectory() as location, override_settings(CACHES=shared_cache(location)):
+            self.tasks.queue_sizes([self.photo.pk], ['admin_thumbnail'])
+            self.tasks.queue_sizes([self.photo.pk], ['admin_thumbnail'])
+        self.assertEqual([(str(self.photo.pk), 'admin_thumbnail')], self.queued())
+
+    def test_queued_again_after_failing_task(self):
+        with tempfile.TemporaryDirectory() as location, override_settings(CACHES=shared_cache(location)):
+            self.tasks.queue_sizes([self.photo.pk], ['admin_thumbnail'])
+            with mock.patch.object(PHOTO_MODEL, 'get_or_create_size', side_effect=OSError), \
+                    self.assertRaises(OSError):
+                self.tasks.create_size(str(self.photo.pk), 'admin_thumbnail')
+            self.tasks.queue_sizes([self.photo.pk], ['admin_thumbnail'])
+        self.assertEqual(2, len(self.queued()))
+
+    def test_always_queued_with_process_local_cache(self):
+        # The workers would never see the keys of a LocMemCache, the size could only be queued again after a timeout
+        self.tasks.queue_sizes([self.photo.pk], ['admin_thumbnail'])
+        self.tasks.queue_sizes([self.photo.pk], ['admin_thumbnail'])
+        self.assertEqual(2, len(self.queued()))
@@ -0,0 +1,99 @@
+from io import BytesIO
+from unittest import mock, skipUnless
+from django.core.files.base import File
+from django.test import SimpleTestCase, TestCase
+from PIL import Image
+from ..engines import available_engines, load_engine
+from ..renditions import PixelBudget, fit_size
+from ..similarity import hamming_distance, perceptual_hash
+from .model_factories import get_image_file, PhotoFactory
+
+ENGINES = available_engines()
+
+
+class EngineTestMixin:
+    """The rendition tests every engine has to pass, see the subclasses below"""
+    engine_name = None
+    sizes = ((100, 100), (1920, 1080), (500, 500))
+
+    def setUp(self):
+        self.engine = ENGINES[self.engine_name]
+
+    def thumbnails(self, file, sizes=None, **kwargs):
+        with self.engine.open(file) as image:
+            return [(size, self.engine.rendition_size(rendition))
+                    for size, rendition in self.engine.thumbnails(image, sizes or self.sizes, **kwargs)]
+
+    def test_metadata(self):
+        for ext, image_format in (('png', 'PNG'), ('jpeg', 'JPEG')):
+            with self.engine.open(get_image_file(ext=ext, size=(300, 200))) as image:
+                self.assertEqual({'width': 300, 'height': 200, 'format': image_format}, self.engine.metadata(image))
+
+    def test_largest_first(self):
+        renditions = self.thumbnails(get_image_file(size=(3000, 2000)))
+        self.assertEqual([(1920, 1080), (500, 500), (100, 100)], [size for size, dimensions in renditions])
+        self.assertEqual([(1620, 1080), (500, 333), (100, 67)], [dimensions for size, dimensions in renditions])
+
+    def test_same_dimensions_as_fit_size(self):
+        for ext in ('png', 'jpeg'):
+            for low_memory in (False, True):
+                renditions = dict(self.thumbnails(get_image_file(ext=ext, size=(2999, 1777)), low_memory=low_memory))
+                self.assertEqual({size: fit_size((2999, 1777), size) for size in self.sizes}, renditions)
+
+    def test_never_enlarges(self):
+        self.assertEqual([((1920, 1080), (640, 480))], self.thumbnails(get_image_file(size=(640, 480)),
+                                                                        [(1920, 1080)]))
+
+    def test_reserves_budget(self):
+        budget = PixelBudget(1000 * 1000)
+        with self.engine.open(get_image_file(size=(1000, 1000))) as image:
+            renditions = self.engine.thumbnails(image, ((100, 100),), budget=budget)
+            next(renditions)
+            self.assertGreater(budget.in_use, 0)
+            list(renditions)
+        self.assertEqual(0, budget.in_use)
+
+    def test_encode(self):
+        with self.engine.open(get_image_file(size=(400, 300))) as image:
+            (size, rendition), = self.engine.thumbnails(image, [(200, 200)])
+            for image_format in ('JPEG', 'PNG', 'WEBP'):
+                if not self.engine.supports_format(image_format):
+                    continue
+                with Image.open(BytesIO(self.engine.encode(rendition, image_format, {'quality': 70}))) as encoded:
+                    self.assertEqual(image_format, encoded.format)
+                    self.assertEqual((200, 150), encoded.size)
+
+    def test_verify(self):
+        file = get_image_file()
+        self.engine.verify(file)
+        self.assertEqual(0, file.tell())
+        with self.assertRaises(OSError):
+            self.engine.verify(File(BytesIO(b'not an image'), name='fake.png'))
+
+    def test_perceptual_hash_matches_pillow(self):
+        image = Image.linear_gradient('L').resize((640, 480)).convert('RGB')
+        file = BytesIO()
+        image.save(file, 'PNG')
+        with self.engine.open(File(file, name='gradient.png')) as opened:
+            (size, rendition), = self.engine.thumbnails(opened, [(100, 100)])
+            self.assertLessEqual(hamming_distance(perceptual_hash(image), self.engine.perceptual_hash(rendition)), 4)
+
+
+class PillowEngineTest(EngineTestMixin, SimpleTestCase):
+    engine_name = 'pillow'
+
+
+@skipUnless('vips' in ENGINES, 'pyvips and libvips are not installed')
+class VipsEngineTest(EngineTestMixin, SimpleTestCase):
+    engine_name = 'vips'
+
+
+class EngineSettingTest(TestCase):
+    def test_photos_use_configured_engine(self):
+        engine = load_engine('photos.engines.pillow.PillowEngine')
+        with mock.patch('photos.models.get_engine', return_value=engine), \
+                mock.patch.object(engine, 'thumbnails', wraps=engine.thumbnails) as thumbnails:
+            photo = PhotoFactory()
+        thumbnails.assert_called_once()
+        self.assertEqual('PNG', photo.renditions['format'])
+        photo.delete()
@@ -0,0 +1,28 @@
+import threading
+import time
+from django.test import SimpleTestCase
+from ..locks import single_flight, _locks
+
+
+class SingleFlightTest(SimpleTestCase):
+    def test_collapses_concurrent_work(self):
+        done = []
+        running = []
+
+        def work():
+            with single_flight('test-key'):
+                running.append(1)
+                self.assertEqual(1, len(running))
+                if not done:
+                    time.sleep(0.05)
+                    done.append(1)
+                running.pop()
+
+        threads = [threading.Thread(target=work) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([1], done)
+        self.assertNotIn('test-key', _locks)
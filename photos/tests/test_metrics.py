@@ -0,0 +1,87 @@
+from io import BytesIO
+from unittest import mock
+from uuid import uuid4
+from django.core.files.base import File
+from django.http import Http404
+from django.test import SimpleTestCase, TestCase, RequestFactory
+from .. import metrics
+from ..models import PHOTO_MODEL
+from ..photo_processors.base_processor import BasePhotoProcessor
+from ..views import MetricsView
+from .model_factories import get_image_file
+
+IN_MEMORY = 'photos.metrics.InMemoryBackend'
+
+
+class InMemoryBackendTest(SimpleTestCase):
+    def test_prometheus_text(self):
+        backend = metrics.InMemoryBackend()
+        backend.timing('photos_stage_seconds', 0.5, {'stage': 'encode', 'size': 'hd'})
+        backend.timing('photos_stage_seconds', 0.25, {'stage': 'encode', 'size': 'hd'})
+        backend.increment('photos_bytes_out_total', 100, {'size': 'say "hi"'})
+        self.assertEqual('# TYPE photos_stage_seconds summary\n'
+                         'photos_stage_seconds_count{size="hd",stage="encode"} 2\n'
+                         'photos_stage_seconds_sum{size="hd",stage="encode"} 0.75\n'
+                         '# TYPE photos_bytes_out_total counter\n'
+                         'photos_bytes_out_total{size="say \\"hi\\""} 100\n', backend.prometheus_text())
+
+    def test_timer_counts_errors(self):
+        backend = metrics.InMemoryBackend()
+        with mock.patch.object(metrics, 'get_backend', return_value=backend):
+            with self.assertRaises(ValueError), metrics.tagged(processor='Test'), metrics.timer('decode'):
+                raise ValueError
+        self.assertEqual({('photos_errors_total', (('processor', 'Test'), ('stage', 'decode'))): 1},
+                         backend.counters)
+        self.assertEqual(1, backend.timings[('photos_stage_seconds', (('processor', 'Test'), ('stage', 'decode')))][0])
+
+
+class PipelineMetricsTest(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(metrics, 'METRICS_BACKEND', IN_MEMORY)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.backend = metrics.get_backend()
+        self.backend.reset()
+
+    def tearDown(self):
+        for photo in PHOTO_MODEL.objects.all():
+            photo.delete()
+
+    def stages(self):
+        return {dict(tags)['stage']: dict(tags) for name, tags in self.backend.timings}
+
+    def test_stages_are_tagged(self):
+        file = get_image_file(size=(300, 200))
+        BasePhotoProcessor().handle_photos([file], uuid4())
+
+        stages = self.stages()
+        for stage in ('handle_photos', 'hash', 'process_photo', 'create_renditions', 'decode', 'resize', 'encode',
+                      'storage_write', 'db_insert'):
+            self.assertEqual('BasePhotoProcessor', stages[stage]['processor'])
+        encoded_sizes = {dict(tags).get('size') for name, tags in self.backend.counters
+                         if name == 'photos_bytes_out_total'}
+        self.assertIn('admin_thumbnail', encoded_sizes)
+        self.assertEqual(file.size, sum(value for (name, tags), value in self.backend.counters.items()
+                                        if name == 'photos_bytes_in_total'))
+        self.assertEqual(300 * 200, sum(value for (name, tags), value in self.backend.counters.items()
+                                        if name == 'photos_pixels_decoded_total'))
+
+    def test_errors_are_counted(self):
+        with self.assertRaises(OSError):
+            # The header is fine, decoding the truncated pixels fails
+            truncated = get_image_file(size=(300, 200)).read()[:100]
+            BasePhotoProcessor().handle_photo(File(BytesIO(truncated), name='truncated.png'), uuid4())
+        errors = {dict(tags)['stage'] for (name, tags) in self.backend.counters if name == 'photos_errors_total'}
+        self.assertEqual({'decode', 'create_renditions', 'process_photo', 'handle_photos'}, errors)
+
+    def test_view(self):
+        self.backend.increment('photos_bytes_in_total', 10, {})
+        response = MetricsView.as_view()(RequestFactory().get('/metrics/'))
+        self.assertEqual(200, response.status_code)
+        self.assertIn(b'photos_bytes_in_total 10', response.content)
+
+
+class MetricsViewTest(SimpleTestCase):
+    def test_not_found_without_in_memory_backend(self):
+        with self.assertRaises(Http404):
+            MetricsView.as_view()(RequestFactory().get('/metrics/'))
@@ -1,6 +1,16 @@
 from .helpers import PhotologueBaseTest, GalleryAndPhotoTest
-from .model_factories import GalleryFactory, PhotoFactory
-from ..models import PHOTO_MODEL, IMAGE_SIZES, UPLOAD_TO
+from .model_factories import GalleryFactory, PhotoFactory, get_image_file
+from ..models import PHOTO_MODEL, IMAGE_SIZES, UPLOAD_TO, EXTRA_FORMATS, get_storage_base_url, delete_stored_files
+from ..photo_processors.base_processor import BasePhotoProcessor
+from ..renditions import RENDITION_VERSION
+from unittest import mock, skipUnless
+from io import BytesIO, StringIO
+from PIL import Image
+from django.core.files.base import File
+from django.core.management import call_command
+import hashlib
+import threading
+import time
 import os
 
 
@@ -22,6 +32,60 @@ class GalleryTest(GalleryAndPhotoTest):
 
         self.assertIn(photo, [self.p1, self.p2])
 
+    def test_photo_count_and_cover(self):
+        self.assertEqual(2, self.g1.photo_count)
+        self.assertIn(self.g1.cover_photo, [self.p1, self.p2])
+
+        self.g1.photos.remove(self.p1)
+        self.assertEqual(1, self.g1.photo_count)
+        self.assertEqual(self.p2, self.g1.cover_photo)
+
+        self.p1.galleries.add(self.g1)
+        self.g1.refresh_from_db()
+        self.assertEqual(2, self.g1.photo_count)
+
+        self.p2.galleries.clear()
+        self.g1.refresh_from_db()
+        self.assertEqual(1, self.g1.photo_count)
+        self.assertEqual(self.p1, self.g1.cover_photo)
+
+        self.g1.photos.clear()
+        self.assertEqual(0, self.g1.photo_count)
+        self.assertIsNone(self.g1.cover_photo)
+
+    def test_photo_deleted_updates_gallery(self):
+        photo = PhotoFactory()
+        self.g1.photos.set([photo])
+        self.assertEqual(photo, self.g1.cover_photo)
+        BasePhotoProcessor().delete_photo(photo)
+        self.g1.refresh_from_db()
+        self.assertEqual(0, self.g1.photo_count)
+        self.assertIsNone(self.g1.cover_photo)
+
+    def test_photo_deleted_directly_updates_gallery(self):
+        # As PhotoAdmin.delete_model does, without going through the photo processor
+        first, second = PhotoFactory(), PhotoFactory()
+        self.g1.photos.set([first, second])
+        self.g1.refresh_from_db()
+        remaining = second if self.g1.cover_photo == first else first
+        self.g1.cover_photo.delete()
+        self.g1.refresh_from_db()
+        self.assertEqual(1, self.g1.photo_count)
+        self.assertEqual(remaining, self.g1.cover_photo)
+
+    def test_photos_deleted_in_one_refresh(self):
+        photos = [PhotoFactory() for i in range(10)]
+        self.g1.photos.add(*photos)
+        g2 = GalleryFactory()
+        g2.photos.add(*photos[:5])
+        # The collector's queries for the whole queryset, and one query each for the galleries, files and refresh
+        with self.assertNumQueries(9):
+            BasePhotoProcessor().delete_photos(PHOTO_MODEL.objects.filter(pk__in=[photo.pk for photo in photos]))
+        self.g1.refresh_from_db()
+        g2.refresh_from_db()
+        self.assertEqual((2, 0), (self.g1.photo_count, g2.photo_count))
+        self.assertIsNone(g2.cover_photo)
+
 
 class PhotoTest(PhotologueBaseTest):
     def test_new_photo(self):
@@ -47,6 +111,98 @@ class PhotoTest(PhotologueBaseTest):
         for size in IMAGE_SIZES.values():
             self.assertFalse(photo.image.storage.exists(photo.get_filepath_for_size(size)))
 
+    def test_stored_file_names(self):
+        photo = PhotoFactory()
+        names = [photo.image.name] + [photo.renditions['sizes'][size_name]['name'] for size_name in IMAGE_SIZES]
+        with self.assertNumQueries(1):
+            stored = list(PHOTO_MODEL.objects.filter(pk__in=[self.p1.pk, photo.pk]).stored_file_names())
+        self.assertTrue(set(names) < set(stored))
+        self.assertTrue(all(photo.image.storage.exists(name) for name in stored if '.webp' not in name))
+
+        # Sizes missing from the manifest might still be stored under the name they had before there was one
+        legacy = PHOTO_MODEL.stored_file_names(photo.image.name, {})
+        self.assertTrue(set(names) < set(legacy))
+        photo.delete()
+
+    def test_renditions_are_stored_concurrently(self):
+        photo = PHOTO_MODEL(image=get_image_file(size=(300, 200)))
+        photo.save(process=False)
+        storage = photo.image.storage
+        save, lock, writing = storage.save, threading.Lock(), []
+        concurrent = []
+
+        def slow_save(name, content):
+            with lock:
+                writing.append(name)
+                concurrent.append(len(writing))
+            time.sleep(0.05)
+            with lock:
+                writing.remove(name)
+            return save(name, content)
+
+        with mock.patch.object(storage, 'save', side_effect=slow_save):
+            photo.update_sizes(force=True)
+        self.assertEqual([], photo.missing_sizes())
+        self.assertGreater(max(concurrent), 1)
+        photo.delete()
+
+    def test_failed_write_is_reported_per_size(self):
+        photo = PHOTO_MODEL(image=get_image_file(size=(300, 200)))
+        photo.save(process=False)
+        storage = photo.image.storage
+        save = storage.save
+
+        def fail_thumbnails(name, content):
+            if '_100x100' in name:
+                raise OSError('Storage is down')
+            return save(name, content)
+
+        with mock.patch.object(storage, 'save', side_effect=fail_thumbnails), \
+                self.assertLogs('photos.models', 'ERROR') as logs, self.assertRaises(OSError):
+            photo.update_sizes(force=True)
+        self.assertEqual(['ERROR:photos.models:Error creating size admin_thumbnail: Storage is down'], logs.output)
+        self.assertEqual(set(IMAGE_SIZES) - {'admin_thumbnail'}, set(photo.renditions['sizes']))
+        photo.delete()
+
+    def test_delete_stored_files(self):
+        storage = mock.Mock(spec=['delete', 'delete_many'])
+        delete_stored_files(storage, ['a', 'b', 'a'])
+        storage.delete_many.assert_called_once_with(['a', 'b'])
+        storage.delete.assert_not_called()
+
+        storage = mock.Mock(spec=['delete'])
+        delete_stored_files(storage, ['a', 'b', 'c'])
+        self.assertEqual({'a', 'b', 'c'}, {call.args[0] for call in storage.delete.call_args_list})
+
+    @skipUnless('WEBP' in EXTRA_FORMATS, 'Pillow was built without WebP support')
+    def test_extra_formats(self):
+        photo = PhotoFactory()
+        storage = photo.image.storage
+        for size_name, size in IMAGE_SIZES.items():
+            variant = photo.renditions['sizes'][size_name]['formats']['WEBP']
+            self.assertEqual(photo.get_filepath_for_size(size, 'WEBP'), variant['name'])
+            self.assertEqual(storage.size(variant['name']), variant['bytes'])
+        self.assertEqual('PNG', photo.renditions['format'])
+        self.assertIn('.webp 100w', photo.srcset('WEBP'))
+        self.assertIn({'type': 'image/webp', 'srcset': photo.srcset('WEBP')}, photo.sources())
+
+        photo.delete()
+        for size in IMAGE_SIZES.values():
+            self.assertFalse(storage.exists(photo.get_filepath_for_size(size, 'WEBP')))
+
+    def test_encoder_profile(self):
+        with mock.patch.dict('photos.models.IMAGE_SIZE_PROFILES', {'display': {'format': 'JPEG', 'quality': 60}}):
+            photo = PhotoFactory()
+            entry = photo.renditions['sizes']['display']
+            self.assertEqual('JPEG', entry['format'])
+            self.assertEqual(photo.get_filepath_for_size(IMAGE_SIZES['display'], 'JPEG'), entry['name'])
+            self.assertEqual(photo.get_display_url(), photo._storage_url(entry['name']))
+            self.assertEqual([], photo.missing_sizes())
+        self.assertEqual(['display'], photo.missing_sizes())
+
+        photo.delete()
+        self.assertFalse(photo.image.storage.exists(entry['name']))
+
     def test_url_sizes(self):
         size = IMAGE_SIZES['admin_thumbnail']
         url = self.p1._get_url_for_size(size)
@@ -61,5 +217,101 @@ class PhotoTest(PhotologueBaseTest):
     def test_accessor_methods(self):
         self.assertEqual(self.p1.get_admin_thumbnail_url(), self.p1._get_url_for_size(IMAGE_SIZES['admin_thumbnail']))
 
+    def test_accessors_defined_on_class(self):
+        for name in IMAGE_SIZES:
+            self.assertTrue(callable(getattr(PHOTO_MODEL, 'get_{}_url'.format(name))))
+            self.assertTrue(callable(getattr(PHOTO_MODEL, 'get_{}_dimensions'.format(name))))
+        with self.assertRaises(AttributeError):
+            self.p1.get_unknown_size_url()
+
+    def test_urls_do_not_call_storage(self):
+        expected = self.p1.image.storage.url(self.p1.get_filepath_for_size(IMAGE_SIZES['display']))
+        image_url = self.p1.image.url
+        with mock.patch.object(self.p1.image.storage, 'url') as url:
+            self.assertEqual(expected, self.p1.get_display_url())
+            self.assertEqual(image_url, self.p1.get_image_url())
+            self.p1.srcset()
+        url.assert_not_called()
+
+    def test_image_base_url(self):
+        with mock.patch('photos.models.IMAGE_BASE_URL', 'https://cdn.example.com/'):
+            get_storage_base_url.cache_clear()
+            self.assertEqual('https://cdn.example.com/' + self.p1.get_filepath_for_size(IMAGE_SIZES['hd']),
+                             self.p1.get_hd_url())
+        with mock.patch('photos.models.IMAGE_BASE_URL', 'https://cdn.example.com/media'):
+            get_storage_base_url.cache_clear()
+            self.assertEqual('https://cdn.example.com/media/' + self.p1.get_filepath_for_size(IMAGE_SIZES['hd']),
+                             self.p1.get_hd_url())
+        get_storage_base_url.cache_clear()
+
     def test_admin_thumbnail_tag(self):
         self.assertIn(self.p1.get_admin_thumbnail_url(), self.p1.admin_thumbnail_tag())
+
+    def test_renditions_manifest(self):
+        renditions = PHOTO_MODEL.objects.get(pk=self.p1.pk).renditions
+        self.assertEqual(RENDITION_VERSION, renditions['version'])
+        self.assertEqual((2000, 2000), (renditions['width'], renditions['height']))
+        self.assertEqual(set(IMAGE_SIZES), set(renditions['sizes']))
+        for name, size in IMAGE_SIZES.items():
+            entry = renditions['sizes'][name]
+            self.assertEqual(list(size), entry['box'])
+            self.assertEqual(self.p1.get_filepath_for_size(size), entry['name'])
+            self.assertEqual(self.p1.image.storage.size(entry['name']), entry['bytes'])
+            self.assertEqual(min(size), entry['width'])
+
+    def test_dimensions_and_srcset(self):
+        self.assertEqual({'width': 100, 'height': 100}, self.p1.get_admin_thumbnail_dimensions())
+        self.assertTrue(self.p1.srcset().startswith('{} 100w, '.format(self.p1.get_admin_thumbnail_url())))
+
+    def test_update_sizes_skips_existing(self):
+        self.assertEqual([], self.p1.missing_sizes())
+        with mock.patch.object(self.p1, '_create_renditions') as create_renditions:
+            self.p1.update_sizes()
+        create_renditions.assert_not_called()
+
+        del self.p1.renditions['sizes']['admin_thumbnail']
+        self.assertEqual(['admin_thumbnail'], self.p1.missing_sizes())
+        self.p1.update_sizes()
+        self.assertEqual([], self.p1.missing_sizes())
+        self.assertTrue(self.p1.image.storage.exists(self.p1.get_filepath_for_size(IMAGE_SIZES['admin_thumbnail'])))
+
+    def test_renditions_ready(self):
+        self.assertTrue(PHOTO_MODEL.objects.get(pk=self.p1.pk).renditions_ready)
+
+        photo = PHOTO_MODEL(image=get_image_file())
+        photo.save(process=False)
+        self.assertFalse(photo.renditions_ready)
+        for size_name in IMAGE_SIZES:
+            photo.refresh_from_db()
+            self.assertFalse(photo.renditions_ready)
+            photo.get_or_create_size(size_name)
+        self.assertTrue(PHOTO_MODEL.objects.get(pk=photo.pk).renditions_ready)
+        photo.delete()
+
+    def test_content_hash(self):
+        with open(self.p1.image.path, 'rb') as file:
+            expected = hashlib.sha256(file.read()).hexdigest()
+        self.assertEqual(expected, self.p1.content_hash)
+
+        PHOTO_MODEL.objects.filter(pk=self.p1.pk).update(content_hash='', perceptual_hash='')
+        call_command('photos_hash_photos', batch_size=1, stdout=StringIO())
+        perceptual_hash = self.p1.perceptual_hash
+        self.p1.refresh_from_db()
+        self.assertEqual(expected, self.p1.content_hash)
+        self.assertEqual(perceptual_hash, self.p1.perceptual_hash)
+
+    def test_backfilled_perceptual_hash(self):
+        # Stripes, so the hash isn't all zeros like the one of a plain image
+        image = Image.new('RGB', (600, 400))
+        for x in range(0, 600, 80):
+            image.paste((255, 255, 255), (x, 0, x + 40, 400))
+        file = BytesIO()
+        image.save(file, 'png')
+        photo = PHOTO_MODEL(image=File(file, name='stripes.png'))
+        photo.save()
+        self.assertNotEqual('0' * 16, photo.perceptual_hash)
+
+        PHOTO_MODEL.objects.filter(pk=photo.pk).update(perceptual_hash='')
+        call_command('photos_hash_photos', stdout=StringIO())
+        self.assertEqual(photo.perceptual_hash, PHOTO_MODEL.objects.get(pk=photo.pk).perceptual_hash)
+        photo.delete()
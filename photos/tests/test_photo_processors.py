@@ -0,0 +1,209 @@
+from zipfile import ZipFile
+from io import BytesIO
+from unittest import mock
+from uuid import uuid4
+from django.core.files.base import File
+from django.db.models.signals import m2m_changed
+from django.test import TestCase
+from ..models import PHOTO_MODEL, GALLERY_MODEL, UploadedPhotoModel, IMAGE_SIZES, UPLOAD_TO
+from ..photo_processors.utils import handle_zip, find_uploaded_photos, shard_zip, handle_zip_shard, link_zip_shards, \
+    file_name_batches
+from ..photo_processors.base_processor import BasePhotoProcessor
+from .model_factories import GalleryFactory, get_image_file
+
+
+def get_mixed_zip_file(name='mixed.zip'):
+    file_obj = BytesIO()
+    with ZipFile(file_obj, mode='w') as zf:
+        zf.writestr('b.png', get_image_file(name='b.png', size=(300, 200)).read())
+        zf.writestr('a.png', get_image_file(name='a.png', size=(300, 200), color=(0, 0, 255)).read())
+        zf.writestr('empty.png', b'')
+        zf.writestr('not-an-image.png', b'just some text')
+        zf.writestr('.hidden.png', get_image_file(size=(300, 200)).read())
+        zf.writestr('__MACOSX/c.png', get_image_file(size=(300, 200)).read())
+        zf.writestr('folder/d.png', get_image_file(size=(300, 200)).read())
+    file_obj.seek(0)
+    return File(file_obj, name=name)
+
+
+class HandleZipTest(TestCase):
+    def tearDown(self):
+        for photo in PHOTO_MODEL.objects.all():
+            photo.delete()
+
+    def test_only_photos_are_created(self):
+        upload_id = uuid4()
+        handle_zip(get_mixed_zip_file(), upload_id)
+
+        photos = PHOTO_MODEL.objects.all()
+        self.assertEqual(['a.png', 'b.png'], sorted(photo.image_filename() for photo in photos))
+        self.assertEqual(2, UploadedPhotoModel.objects.filter(upload_id=upload_id).count())
+        for photo in photos:
+            self.assertTrue(photo.image.storage.exists(photo.image.name))
+            for size in IMAGE_SIZES.values():
+                self.assertTrue(photo.image.storage.exists(photo.get_filepath_for_size(size)))
+
+    def test_uploaded_photos_are_looked_up_per_batch(self):
+        existing = PHOTO_MODEL(image=get_image_file(name='b.png', size=(300, 200)))
+        existing.save()
+        duplicates = []
+        with mock.patch('photos.photo_processors.utils.find_uploaded_photos',
+                        wraps=find_uploaded_photos) as find, \
+                mock.patch('photos.photo_processors.utils.ZIP_LOOKUP_BATCH_SIZE', 2):
+            handle_zip(get_mixed_zip_file(), uuid4())
+        # a.png and b.png are hashed in the first batch, not-an-image.png in the second
+        self.assertEqual(2, find.call_count)
+        self.assertEqual(2, PHOTO_MODEL.objects.count())
+        self.assertEqual(1, UploadedPhotoModel.objects.filter(photo=existing).count())
+
+    def test_parallel(self):
+        upload_id = uuid4()
+        handle_zip(get_mixed_zip_file(), upload_id, workers=2)
+
+        uploaded = UploadedPhotoModel.objects.filter(upload_id=upload_id).order_by('id').select_related('photo')
+        self.assertEqual(['a.png', 'b.png'], [u.photo.image_filename() for u in uploaded])
+        for u in uploaded:
+            self.assertEqual(set(IMAGE_SIZES), set(u.photo.renditions['sizes']))
+            for size in IMAGE_SIZES.values():
+                self.assertTrue(u.photo.image.storage.exists(u.photo.get_filepath_for_size(size)))
+
+    def test_shards(self):
+        file = get_mixed_zip_file()
+        shards = shard_zip(file, shard_size=1)
+        self.assertEqual([['a.png'], ['b.png'], ['not-an-image.png']], shards)
+
+        existing = PHOTO_MODEL(image=get_image_file(name='b.png', size=(300, 200)))
+        existing.save()
+        with ZipFile(file, mode='a') as zf:  # The same content as a.png, in another shard
+            zf.writestr('z.png', get_image_file(size=(300, 200), color=(0, 0, 255)).read())
+        upload_id = uuid4()
+        results = [handle_zip_shard(file, names, upload_id) for names in shards]
+        self.assertEqual([], results[1][0])
+        self.assertEqual([str(existing.pk)], results[1][1])
+        # A shard running at the same time as the one of a.png doesn't find it
+        with mock.patch('photos.photo_processors.utils.find_uploaded_photos', return_value={}):
+            results.append(handle_zip_shard(file, ['z.png'], upload_id))
+        self.assertEqual(3, PHOTO_MODEL.objects.count())
+        # Staged by the shards themselves, in case the zip is never finished
+        self.assertEqual({(results[0][0][0], True), (str(existing.pk), False), (results[3][0][0], True)},
+                         {(str(photo_id), created) for photo_id, created in
+                          UploadedPhotoModel.objects.filter(upload_id=upload_id)
+                          .values_list('photo_id', 'created_photo')})
+
+        link_zip_shards(results, upload_id)
+        uploaded = UploadedPhotoModel.objects.filter(upload_id=upload_id).order_by('id').select_related('photo')
+        self.assertEqual([results[0][0][0], str(existing.pk)], [str(u.photo_id) for u in uploaded])
+        self.assertEqual(2, PHOTO_MODEL.objects.count())
+        self.assertTrue(uploaded[0].photo.renditions_ready)
+
+
+class BasePhotoProcessorTest(TestCase):
+    def tearDown(self):
+        for photo in PHOTO_MODEL.objects.all():
+            photo.delete()
+
+    def test_handle_photos_in_bulk(self):
+        upload_id = uuid4()
+        files = [get_image_file(name='photo{}.png'.format(i), size=(300, 200), color=(i, 0, 0)) for i in range(3)]
+        with self.assertNumQueries(5):  # Duplicate lookup, savepoint, 2 inserts, release
+            photos = BasePhotoProcessor().handle_photos(files, upload_id)
+
+        self.assertEqual({photo.pk for photo in photos}, set(PHOTO_MODEL.objects.values_list('pk', flat=True)))
+        self.assertEqual(3, UploadedPhotoModel.objects.filter(upload_id=upload_id).count())
+        for photo in photos:
+            for size in IMAGE_SIZES.values():
+                self.assertTrue(photo.image.storage.exists(photo.get_filepath_for_size(size)))
+
+    def test_handle_files(self):
+        upload_id = uuid4()
+        files = [get_image_file(name='photo.png', size=(300, 200), color=(0, 255, 0)), get_mixed_zip_file()]
+        BasePhotoProcessor().handle_files(files, upload_id)
+        self.assertEqual(3, UploadedPhotoModel.objects.filter(upload_id=upload_id).count())
+
+    def test_duplicate_upload_reuses_photo(self):
+        processor = BasePhotoProcessor()
+        photo, = processor.handle_photos([get_image_file(name='photo.png', size=(300, 200))], uuid4())
+
+        upload_id = uuid4()
+        files = [get_image_file(name='copy.png', size=(300, 200)), get_image_file(name='copy2.png', size=(300, 200))]
+        with mock.patch.object(photo.image.storage, 'save') as save:
+            self.assertEqual([], processor.handle_photos(files, upload_id))
+        save.assert_not_called()
+        self.assertEqual(1, PHOTO_MODEL.objects.count())
+        self.assertEqual([photo.pk], list(UploadedPhotoModel.objects.filter(upload_id=upload_id)
+                                          .values_list('photo_id', flat=True)))
+
+    def test_duplicate_zip_members(self):
+        photo, = BasePhotoProcessor().handle_photos([get_image_file(name='b.png', size=(300, 200))], uuid4())
+        upload_id = uuid4()
+        handle_zip(get_mixed_zip_file(), upload_id)
+
+        self.assertEqual(2, PHOTO_MODEL.objects.count())
+        uploaded = UploadedPhotoModel.objects.filter(upload_id=upload_id).select_related('photo')
+        self.assertEqual(2, len(uploaded))
+        self.assertIn(photo, [u.photo for u in uploaded])
+
+    def test_link_photos_to_gallery(self):
+        upload_id = uuid4()
+        files = [get_image_file(name='photo{}.png'.format(i), size=(120, 80), color=(i, 0, 0)) for i in range(3)]
+        photos = BasePhotoProcessor().handle_photos(files, upload_id)
+        gallery = GalleryFactory()
+        gallery.photos.add(photos[1])
+
+        received = []
+
+        def receiver(action, pk_set, **kwargs):
+            received.append((action, pk_set))
+        m2m_changed.connect(receiver, sender=GALLERY_MODEL.photos.through)
+        self.addCleanup(m2m_changed.disconnect, receiver, sender=GALLERY_MODEL.photos.through)
+
+        with mock.patch.object(PHOTO_MODEL, '__init__', side_effect=AssertionError('Photos are loaded')):
+            BasePhotoProcessor().link_photos_to_gallery(upload_id, gallery)
+        added = {photos[0].pk, photos[2].pk}
+        self.assertEqual([('pre_add', added), ('post_add', added)], received)
+        self.assertEqual({photo.pk for photo in photos}, set(gallery.photos.values_list('pk', flat=True)))
+        self.assertEqual(3, gallery.photo_count)
+        self.assertFalse(UploadedPhotoModel.objects.filter(upload_id=upload_id).exists())
+
+    def test_delete_photos(self):
+        processor = BasePhotoProcessor()
+        files = [get_image_file(name='photo{}.png'.format(i), size=(300, 200), color=(i, 0, 0)) for i in range(3)]
+        photos = processor.handle_photos(files, uuid4())
+        storage = photos[0].image.storage
+        names = {photo.pk: [photo.image.name] + [photo.get_filepath_for_size(size) for size in IMAGE_SIZES.values()]
+                 for photo in photos}
+
+        deleted = PHOTO_MODEL.objects.filter(pk__in=[photo.pk for photo in photos[:2]])
+        self.assertEqual([2, 2, 2], [len(names) for names in file_name_batches(deleted, batch_size=2)][:3])
+        with self.captureOnCommitCallbacks(execute=True):
+            processor.delete_photos(deleted)
+            # The files are kept until the transaction commits
+            self.assertTrue(all(storage.exists(name) for photo_names in names.values() for name in photo_names))
+        self.assertEqual([photos[2].pk], list(PHOTO_MODEL.objects.values_list('pk', flat=True)))
+        for photo in photos:
+            self.assertEqual([photo is photos[2]] * len(names[photo.pk]),
+                             [storage.exists(name) for name in names[photo.pk]])
+
+    def test_failed_batch_leaves_no_files(self):
+        storage = PHOTO_MODEL._meta.get_field('image').storage
+        stored = set(storage.listdir(UPLOAD_TO)[1]) if storage.exists(UPLOAD_TO) else set()
+        files = [get_image_file(name='good.png', size=(300, 200)), File(BytesIO(b'corrupt'), name='bad.png')]
+        with self.assertRaises(OSError):
+            BasePhotoProcessor().handle_photos(files, uuid4())
+        self.assertEqual(0, PHOTO_MODEL.objects.count())
+        self.assertEqual(stored, set(storage.listdir(UPLOAD_TO)[1]))
+
+    def test_invalid_photo_is_not_stored(self):
+        with self.assertRaises(OSError):
+            BasePhotoProcessor().handle_photo(File(BytesIO(b'not an image'), name='fake.png'), uuid4())
+        self.assertEqual(0, PHOTO_MODEL.objects.count())
+
+    def test_header_checked_when_sizes_are_created_elsewhere(self):
+        # Like the celery processor, which leaves process_photo to its workers
+        processor = BasePhotoProcessor()
+        with mock.patch.object(processor, 'process_photo') as process_photo, \
+                mock.patch.object(processor, 'store_photo') as store_photo, self.assertRaises(OSError):
+            processor.handle_photos([File(BytesIO(b'not an image'), name='fake.png')], uuid4())
+        store_photo.assert_not_called()
+        process_photo.assert_not_called()
+        self.assertEqual(0, PHOTO_MODEL.objects.count())
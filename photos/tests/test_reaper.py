@@ -0,0 +1,62 @@
+import os
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from uuid import uuid4
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+from ..models import PHOTO_MODEL, UploadedPhotoModel
+from ..photo_processors.base_processor import BasePhotoProcessor
+from .model_factories import GalleryFactory, get_image_file
+
+
+class ReaperTest(TestCase):
+    def setUp(self):
+        self.processor = BasePhotoProcessor()
+        self.chunk_dir = tempfile.TemporaryDirectory()
+        patcher = mock.patch('photos.reaper.CHUNKED_UPLOAD_DIR', self.chunk_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.chunk_dir.cleanup)
+
+    def tearDown(self):
+        for photo in PHOTO_MODEL.objects.all():
+            photo.delete()
+
+    def upload(self, *colors, age_hours=0):
+        upload_id = uuid4()
+        files = [get_image_file(name='photo.png', size=(120, 80), color=color) for color in colors]
+        photos = self.processor.handle_photos(files, upload_id)
+        UploadedPhotoModel.objects.filter(upload_id=upload_id).update(
+            created_at=timezone.now() - timedelta(hours=age_hours))
+        return upload_id, photos
+
+    def test_reap(self):
+        abandoned, (orphan, in_gallery, reuploaded) = self.upload((1, 0, 0), (2, 0, 0), (3, 0, 0), age_hours=100)
+        GalleryFactory().photos.add(in_gallery)
+        self.upload((3, 0, 0))  # The same content again, still fresh
+        existing = PHOTO_MODEL(image=get_image_file(size=(120, 80), color=(4, 0, 0)))
+        existing.save()
+        self.upload((4, 0, 0), age_hours=100)  # Only links the existing photo
+
+        old_directory = os.path.join(self.chunk_dir.name, str(uuid4()))
+        os.makedirs(old_directory)
+        open(os.path.join(old_directory, 'chunk'), 'w').close()
+        old = (timezone.now() - timedelta(hours=100)).timestamp()
+        for path in (os.path.join(old_directory, 'chunk'), old_directory):
+            os.utime(path, (old, old))
+        new_directory = os.path.join(self.chunk_dir.name, str(uuid4()))
+        os.makedirs(new_directory)
+
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('photos_reap_uploads', batch_size=1, stdout=out)
+        self.assertEqual('4 uploaded photos, 1 photos, 1 chunked uploads', out.getvalue().strip())
+
+        self.assertEqual({in_gallery.pk, reuploaded.pk, existing.pk},
+                         set(PHOTO_MODEL.objects.values_list('pk', flat=True)))
+        self.assertFalse(orphan.image.storage.exists(orphan.image.name))
+        self.assertEqual(1, UploadedPhotoModel.objects.count())
+        self.assertEqual([new_directory], [entry.path for entry in os.scandir(self.chunk_dir.name)])
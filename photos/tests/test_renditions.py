@@ -0,0 +1,126 @@
+from django.test import SimpleTestCase
+from PIL import Image
+from io import BytesIO
+from ..renditions import fit_size, iter_renditions, PixelBudget, encode_image, encoder_options
+from ..exceptions import ImageTooLargeError
+from .model_factories import get_image_file
+
+
+class FitSizeTest(SimpleTestCase):
+    def test_matches_thumbnail(self):
+        for image_size in ((2000, 2000), (6000, 4000), (4000, 6000), (1001, 333), (640, 480)):
+            for box in ((100, 100), (500, 500), (1920, 1080), (333, 1000)):
+                image = Image.new('RGB', image_size)
+                image.thumbnail(box)
+                self.assertEqual(image.size, fit_size(image_size, box))
+
+    def test_never_enlarges(self):
+        self.assertEqual((640, 480), fit_size((640, 480), (1920, 1080)))
+
+
+class IterRenditionsTest(SimpleTestCase):
+    sizes = ((100, 100), (1920, 1080), (500, 500))
+
+    def test_largest_first(self):
+        with Image.open(get_image_file(size=(3000, 2000))) as image:
+            renditions = list(iter_renditions(image, self.sizes))
+        self.assertEqual([(1920, 1080), (500, 500), (100, 100)], [size for size, rendition in renditions])
+        self.assertEqual([(1620, 1080), (500, 333), (100, 67)], [rendition.size for size, rendition in renditions])
+
+    def test_same_dimensions_as_thumbnail(self):
+        for ext in ('png', 'jpeg'):
+            for size in self.sizes:
+                with Image.open(get_image_file(ext=ext, size=(2999, 1777))) as image:
+                    image.thumbnail(size, Image.ANTIALIAS)
+                    expected = image.size
+                with Image.open(get_image_file(ext=ext, size=(2999, 1777))) as image:
+                    rendition = dict(iter_renditions(image, self.sizes))[size]
+                self.assertEqual(expected, rendition.size)
+
+    def test_boxes_that_do_not_nest(self):
+        with Image.open(get_image_file(size=(2000, 2000))) as image:
+            renditions = dict(iter_renditions(image, ((1000, 50), (400, 400))))
+        self.assertEqual((50, 50), renditions[(1000, 50)].size)
+        self.assertEqual((400, 400), renditions[(400, 400)].size)
+
+    def test_low_memory_same_dimensions(self):
+        for ext in ('png', 'jpeg'):
+            with Image.open(get_image_file(ext=ext, size=(2999, 1777))) as image:
+                expected = {size: rendition.size for size, rendition in iter_renditions(image, self.sizes)}
+            with Image.open(get_image_file(ext=ext, size=(2999, 1777))) as image:
+                renditions = {size: rendition.size for size, rendition in iter_renditions(image, self.sizes, True)}
+            self.assertEqual(expected, renditions)
+
+    def test_low_memory_drafts_jpeg(self):
+        with Image.open(get_image_file(ext='jpeg', size=(4000, 4000))) as image:
+            list(iter_renditions(image, ((500, 500),)))
+            self.assertEqual((1000, 1000), image.size)
+        with Image.open(get_image_file(ext='jpeg', size=(4000, 4000))) as image:
+            list(iter_renditions(image, ((500, 500),), low_memory=True))
+            self.assertEqual((500, 500), image.size)
+
+    def test_low_memory_decodes_other_formats_fully(self):
+        budget = PixelBudget(4000 * 4000)
+        with Image.open(get_image_file(ext='png', size=(4000, 4000))) as image:
+            renditions = iter_renditions(image, ((500, 500),), low_memory=True, budget=budget)
+            next(renditions)
+            self.assertEqual(((4000, 4000), 4000 * 4000), (image.size, budget.in_use))
+            list(renditions)
+
+
+class PixelBudgetTest(SimpleTestCase):
+    def test_unlimited(self):
+        with PixelBudget().reserve(10 ** 12):
+            pass
+
+    def test_too_large(self):
+        with self.assertRaises(ImageTooLargeError):
+            with PixelBudget(100).reserve(101):
+                pass
+
+    def test_waits_for_budget(self):
+        budget = PixelBudget(100, timeout=0.01)
+        with budget.reserve(60):
+            self.assertEqual(60, budget.in_use)
+            with self.assertRaises(ImageTooLargeError):
+                with budget.reserve(60):
+                    pass
+        self.assertEqual(0, budget.in_use)
+        with budget.reserve(60):
+            pass
+
+    def test_renditions_reserve_decoded_pixels(self):
+        budget = PixelBudget(1000 * 1000)
+        with Image.open(get_image_file(size=(1000, 1000))) as image:
+            renditions = iter_renditions(image, ((100, 100),), budget=budget)
+            next(renditions)
+            self.assertEqual(1000 * 1000, budget.in_use)
+            list(renditions)
+        self.assertEqual(0, budget.in_use)
+
+
+class EncoderProfileTest(SimpleTestCase):
+    def get_image(self):
+        image = Image.linear_gradient('L').resize((400, 300)).convert('RGB')
+        image.info.update({'icc_profile': b'fake icc profile', 'exif': Image.Exif().tobytes()})
+        return image
+
+    def test_default_options(self):
+        self.assertEqual({'optimize': True}, encoder_options(self.get_image()))
+
+    def test_quality(self):
+        image = self.get_image()
+        self.assertLess(len(encode_image(image, 'JPEG', {'quality': 30})),
+                        len(encode_image(image, 'JPEG', {'quality': 95})))
+
+    def test_strip_metadata(self):
+        image = self.get_image()
+        with Image.open(BytesIO(encode_image(image, 'PNG', {'strip_metadata': True}))) as encoded:
+            self.assertNotIn('icc_profile', encoded.info)
+        with Image.open(BytesIO(encode_image(image, 'JPEG', {'strip_metadata': False}))) as encoded:
+            self.assertEqual(b'fake icc profile', encoded.info['icc_profile'])
+
+    def test_jpeg_from_transparent_image(self):
+        image = Image.new('RGBA', (10, 10))
+        with Image.open(BytesIO(encode_image(image, 'JPEG'))) as encoded:
+            self.assertEqual('RGB', encoded.mode)
@@ -0,0 +1,91 @@
+import random
+from unittest import mock
+from django.core.files.base import File
+from django.test import SimpleTestCase, TestCase
+from io import BytesIO
+from PIL import Image
+from ..engines import get_engine
+from ..models import PHOTO_MODEL
+from ..similarity import perceptual_hash, hamming_distance, BKTree
+
+
+def get_gradient_image(size=(640, 480), seed=0):
+    rng = random.Random(seed)
+    image = Image.new('L', (8, 6))
+    image.putdata([rng.randrange(256) for i in range(8 * 6)])
+    return image.resize(size, Image.BICUBIC).convert('RGB')
+
+
+def get_image_file(image, name='photo.jpg'):
+    file_obj = BytesIO()
+    image.save(file_obj, 'JPEG')
+    file_obj.seek(0)
+    return File(file_obj, name=name)
+
+
+class PerceptualHashTest(SimpleTestCase):
+    def test_survives_resizing_and_reencoding(self):
+        image = get_gradient_image()
+        with Image.open(get_image_file(image.resize((200, 150)))) as small:
+            self.assertLessEqual(hamming_distance(perceptual_hash(image), perceptual_hash(small)), 4)
+
+    def test_different_images(self):
+        self.assertGreater(hamming_distance(perceptual_hash(get_gradient_image(seed=1)),
+                                            perceptual_hash(get_gradient_image(seed=2))), 10)
+
+
+class BKTreeTest(SimpleTestCase):
+    def test_search_matches_linear_scan(self):
+        rng = random.Random(0)
+        hashes = ['{:016x}'.format(rng.getrandbits(64)) for i in range(500)]
+        tree = BKTree((hash, i) for i, hash in enumerate(hashes))
+        self.assertEqual(500, len(tree))
+
+        for target in hashes[:20]:
+            expected = sorted(i for i, hash in enumerate(hashes) if hamming_distance(hash, target) <= 24)
+            self.assertEqual(expected, sorted(i for distance, i in tree.search(target, 24)))
+
+    def test_empty(self):
+        self.assertEqual([], BKTree().search('0' * 16, 64))
+
+
+class SimilarPhotosTest(TestCase):
+    def setUp(self):
+        image = get_gradient_image(seed=1)
+        self.photo = PHOTO_MODEL.objects.create(image=get_image_file(image))
+        self.crop = PHOTO_MODEL.objects.create(image=get_image_file(image.crop((8, 6, 632, 474))))
+        self.other = PHOTO_MODEL.objects.create(image=get_image_file(get_gradient_image(seed=2)))
+
+    def tearDown(self):
+        for photo in PHOTO_MODEL.objects.all():
+            photo.delete()
+
+    def test_hash_created_with_sizes(self):
+        self.assertEqual(16, len(self.photo.perceptual_hash))
+
+    def test_hash_made_once_from_smallest_size(self):
+        image = get_gradient_image(seed=1)
+        photo = PHOTO_MODEL(image=get_image_file(image))
+        photo.save(process=False)
+        photo.get_or_create_size('hd')
+        self.assertEqual('', PHOTO_MODEL.objects.get(pk=photo.pk).perceptual_hash)
+        photo.get_or_create_size('admin_thumbnail')
+        self.assertEqual(self.photo.perceptual_hash, PHOTO_MODEL.objects.get(pk=photo.pk).perceptual_hash)
+
+        with mock.patch.object(type(get_engine()), 'perceptual_hash') as hash_rendition:
+            photo.update_sizes(force=True)
+        hash_rendition.assert_not_called()
+        self.assertEqual(self.photo.perceptual_hash, photo.perceptual_hash)
+
+    def test_similar_photos(self):
+        self.assertEqual([self.crop], list(self.photo.get_similar_photos()))
+        self.assertEqual([self.crop], list(PHOTO_MODEL.objects.similar_to(self.photo)))
+        self.assertEqual([], list(self.photo.get_similar_photos(max_distance=0)))
+
+    def test_index_built_once(self):
+        photos = PHOTO_MODEL.objects.all()
+        with mock.patch.object(BKTree, 'from_queryset', wraps=BKTree.from_queryset) as from_queryset:
+            self.assertEqual([self.crop], list(photos.similar_to(self.photo)))
+            self.assertEqual([self.photo], list(photos.similar_to(self.crop)))
+            self.assertEqual([], list(photos.similar_to(self.other)))
+        from_queryset.assert_called_once()
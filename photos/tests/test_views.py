@@ -1,7 +1,25 @@
-from django.test import TestCase
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser, Permission
+from django.core.exceptions import PermissionDenied
+from django.test import TestCase, TransactionTestCase, RequestFactory, AsyncRequestFactory
+from django.test.client import encode_multipart, BOUNDARY, MULTIPART_CONTENT
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.urls import reverse_lazy
-from ..models import PHOTO_MODEL, UploadedPhotoModel, IMAGE_SIZES
-from .model_factories import get_image_file, get_zip_file
+from django.utils import timezone
+from ..models import PHOTO_MODEL, UploadedPhotoModel, IMAGE_SIZES, EXTRA_FORMATS
+from ..views import RenditionView, GalleryListView, AsyncUploadPhotoApiView, AsyncUploadPhotoWithPermissionApiView, \
+    accepted_media_types
+from ..pagination import encode_cursor
+from ..chunked_uploads import ChunkedUpload
+from .model_factories import get_image_file, get_zip_file, PhotoFactory, GalleryFactory
+from unittest import mock, skipUnless
+import threading
+from urllib.parse import urlencode
 import time
 from uuid import uuid4
 
@@ -29,7 +47,8 @@ class UploadPhotoApiViewTest(TestCase):
         UploadedPhotoModel.objects.all().delete()
 
     def test_upload_zip(self):
-        zip_file = get_zip_file(images=[get_image_file(name='img1.png'), get_image_file(name='img2.png')])
+        zip_file = get_zip_file(images=[get_image_file(name='img1.png'),
+                                         get_image_file(name='img2.png', color=(0, 0, 255))])
         self.client.post(reverse_lazy('image_upload'), {'file': zip_file, 'upload_id': str(uuid4())})
 
         time.sleep(1)  # Different process implementations might need a little bit longer
@@ -41,3 +60,259 @@ class UploadPhotoApiViewTest(TestCase):
             self.check_photo_ok_and_delete(photo)
 
         UploadedPhotoModel.objects.all().delete()
+
+
+class AsyncUploadPhotoApiViewTest(TransactionTestCase):
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        patcher = mock.patch('photos.views.CPU_EXECUTOR', self.executor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        for photo in PHOTO_MODEL.objects.all():
+            photo.delete()
+
+    async def upload(self, file):
+        body = encode_multipart(BOUNDARY, {'file': file, 'upload_id': str(uuid4())})
+        # Like ASGI servers do, and unlike async_client.post() of Django 3.2, pass a body that can be read to its end
+        headers = [(b'host', b'testserver'), (b'content-type', MULTIPART_CONTENT.encode()),
+                   (b'content-length', str(len(body)).encode())]
+        return await self.async_client.request(method='POST', path=str(reverse_lazy('image_upload_async')),
+                                               query_string='', scheme='http', server=('127.0.0.1', '80'),
+                                               headers=headers, _body_file=BytesIO(body))
+
+    def test_is_async_view(self):
+        self.assertTrue(asyncio.iscoroutinefunction(AsyncUploadPhotoApiView.as_view()))
+
+    async def test_upload_photo(self):
+        busy = threading.Event()
+        self.executor.submit(busy.wait, 5)  # The sizes can only be created once the response was sent
+        response = await self.upload(get_image_file(size=(300, 200)))
+        self.assertEqual(201, response.status_code)
+        photo = await sync_to_async(lambda: UploadedPhotoModel.objects.select_related('photo').get().photo)()
+        self.assertTrue(photo.image.storage.exists(photo.image.name))
+        self.assertFalse(photo.renditions_ready)
+
+        busy.set()
+        self.executor.shutdown(wait=True)
+        await sync_to_async(photo.refresh_from_db)()
+        self.assertTrue(photo.renditions_ready)
+        self.assertEqual(set(IMAGE_SIZES), set(photo.renditions['sizes']))
+        for size in IMAGE_SIZES.values():
+            self.assertTrue(photo.image.storage.exists(photo.get_filepath_for_size(size)))
+
+        self.assertEqual(201, (await self.upload(get_image_file(name='again.png', size=(300, 200)))).status_code)
+        self.assertEqual(1, await sync_to_async(PHOTO_MODEL.objects.count)())
+        self.assertEqual(2, await sync_to_async(UploadedPhotoModel.objects.filter(photo=photo).count)())
+
+    async def test_invalid_photo(self):
+        response = await self.upload(SimpleUploadedFile('fake.png', b'not an image'))
+        self.assertEqual(500, response.status_code)
+        self.assertEqual(0, await sync_to_async(PHOTO_MODEL.objects.count)())
+
+    async def test_upload_zip(self):
+        zip_file = get_zip_file(images=[get_image_file(name='img1.png', size=(300, 200))])
+        self.assertEqual(201, (await self.upload(zip_file)).status_code)
+        photo = await sync_to_async(lambda: UploadedPhotoModel.objects.select_related('photo').get().photo)()
+        self.assertTrue(photo.renditions_ready)
+
+
+class AsyncUploadPhotoWithPermissionApiViewTest(TransactionTestCase):
+    async def get(self, user):
+        # AsyncRequestFactory of Django 3.2 drops the data argument of get()
+        request = AsyncRequestFactory().get('/?' + urlencode({'upload_id': uuid4(), 'dzuuid': uuid4()}))
+        request.user = user
+        return await AsyncUploadPhotoWithPermissionApiView.as_view()(request)
+
+    async def test_permission(self):
+        self.assertEqual(302, (await self.get(AnonymousUser())).status_code)
+
+        user = await sync_to_async(get_user_model().objects.create_user)('uploader', password='password')
+        with self.assertRaises(PermissionDenied):
+            await self.get(user)
+
+        permission = await sync_to_async(Permission.objects.get)(
+            content_type__app_label=PHOTO_MODEL._meta.app_label, codename='add_' + PHOTO_MODEL._meta.model_name)
+        await sync_to_async(user.user_permissions.add)(permission)
+        user = await sync_to_async(get_user_model().objects.get)(pk=user.pk)  # Without the cached permissions
+        response = await self.get(user)
+        self.assertEqual((200, []), (response.status_code, json.loads(response.content)['received_chunks']))
+
+
+class RenditionViewTest(TestCase):
+    def setUp(self):
+        self.photo = PHOTO_MODEL(image=get_image_file())
+        self.photo.save(process=False)
+
+    def tearDown(self):
+        self.photo.delete()
+
+    def get_rendition(self, size_name='display'):
+        return self.client.get(reverse_lazy('photo-rendition', kwargs={'pk': self.photo.pk, 'size_name': size_name}))
+
+    def test_creates_missing_size(self):
+        size = IMAGE_SIZES['display']
+        self.assertFalse(self.photo.image.storage.exists(self.photo.get_filepath_for_size(size)))
+
+        response = self.get_rendition()
+        self.assertEqual(302, response.status_code)
+        self.assertIn('max-age={}'.format(RenditionView.redirect_max_age), response['Cache-Control'])
+        self.assertTrue(self.photo.image.storage.exists(self.photo.get_filepath_for_size(size)))
+        self.photo.refresh_from_db()
+        self.assertEqual(response.url, self.photo.get_display_url())
+        self.assertEqual(['display'], list(self.photo.renditions['sizes']))
+
+        with mock.patch.object(PHOTO_MODEL, '_create_renditions') as create_renditions:
+            self.assertEqual(response.url, self.get_rendition().url)
+        create_renditions.assert_not_called()
+
+    def test_stream(self):
+        with mock.patch.object(RenditionView, 'serve', 'stream'):
+            response = self.get_rendition('admin_thumbnail')
+        self.assertEqual(200, response.status_code)
+        self.assertIn('max-age={}'.format(RenditionView.max_age), response['Cache-Control'])
+        self.assertEqual('image/png', response['Content-Type'])
+        name = self.photo.get_filepath_for_size(IMAGE_SIZES['admin_thumbnail'])
+        self.assertEqual(self.photo.image.storage.size(name), len(b''.join(response.streaming_content)))
+
+    def test_unknown_size(self):
+        self.assertEqual(404, self.get_rendition('unknown').status_code)
+
+    @skipUnless('WEBP' in EXTRA_FORMATS, 'Pillow was built without WebP support')
+    def test_accept_negotiation(self):
+        url = reverse_lazy('photo-rendition', kwargs={'pk': self.photo.pk, 'size_name': 'display'})
+        response = self.client.get(url, HTTP_ACCEPT='image/webp,image/*,*/*;q=0.8')
+        self.assertTrue(response.url.endswith('.webp'))
+        self.assertIn('Accept', response['Vary'])
+        self.assertTrue(self.client.get(url, HTTP_ACCEPT='*/*').url.endswith('.png'))
+        self.assertTrue(self.client.get(url, HTTP_ACCEPT='image/webp;q=0, */*').url.endswith('.png'))
+
+    def test_accepted_media_types(self):
+        request = RequestFactory().get('/', HTTP_ACCEPT='image/AVIF;q=0.0, image/webp; Q=0.5, image/jxl;q=0 ,*/*;q=0.8')
+        self.assertEqual({'image/webp', '*/*'}, accepted_media_types(request))
+
+    def test_lazy_url(self):
+        with mock.patch('photos.models.LAZY_RENDITIONS', True):
+            self.assertEqual(reverse_lazy('photo-rendition', kwargs={'pk': self.photo.pk, 'size_name': 'hd'}),
+                             self.photo.get_hd_url())
+
+
+class GalleryListViewTest(TestCase):
+    def test_constant_queries(self):
+        photo = PhotoFactory()
+        for i in range(5):
+            GalleryFactory().photos.add(photo)
+
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse_lazy('gallery-list'))
+        self.assertContains(response, photo.get_display_url(), count=5)
+        photo.delete()
+
+    def test_keyset_pagination(self):
+        galleries = [GalleryFactory() for i in range(5)]
+        expected = sorted(galleries, key=lambda gallery: (gallery.created_at, gallery.pk), reverse=True)
+
+        with mock.patch.object(GalleryListView, 'paginate_by', 2):
+            pages = []
+            response = self.client.get(reverse_lazy('gallery-list'))
+            pages.append(list(response.context['gallery_list']))
+            self.assertIsNone(response.context['previous_cursor'])
+            while response.context['next_cursor']:
+                response = self.client.get(reverse_lazy('gallery-list'), {'cursor': response.context['next_cursor']})
+                pages.append(list(response.context['gallery_list']))
+            self.assertEqual([expected[:2], expected[2:4], expected[4:]], pages)
+
+            response = self.client.get(reverse_lazy('gallery-list'), {'cursor': response.context['previous_cursor']})
+            self.assertEqual(expected[2:4], list(response.context['gallery_list']))
+            response = self.client.get(reverse_lazy('gallery-list'), {'cursor': response.context['previous_cursor']})
+            self.assertEqual(expected[:2], list(response.context['gallery_list']))
+            self.assertIsNone(response.context['previous_cursor'])
+
+        self.assertEqual(404, self.client.get(reverse_lazy('gallery-list'), {'cursor': 'nonsense'}).status_code)
+
+    def test_cursor_with_invalid_pk(self):
+        cursor = encode_cursor('next', mock.Mock(created_at=timezone.now(), pk='nonsense'))
+        self.assertEqual(404, self.client.get(reverse_lazy('gallery-list'), {'cursor': cursor}).status_code)
+
+    def test_gallery_photos(self):
+        gallery, other = GalleryFactory(), GalleryFactory()
+        photos = [PhotoFactory() for i in range(3)]
+        gallery.photos.add(*photos[:2])
+        other.photos.add(photos[2])
+        response = self.client.get(reverse_lazy('gallery-detail', kwargs={'slug': gallery.slug}))
+        self.assertEqual(gallery, response.context['gallery'])
+        self.assertEqual(sorted(photos[:2], key=lambda photo: (photo.created_at, photo.pk), reverse=True),
+                         list(response.context['photo_list']))
+        self.assertEqual(404, self.client.get(reverse_lazy('gallery-detail', kwargs={'slug': 'missing'})).status_code)
+
+
+class ChunkedUploadTest(TestCase):
+    chunk_size = 100
+
+    def post_chunk(self, upload_id, file_uuid, data, index, total_chunks):
+        chunk = SimpleUploadedFile('blob', data[index * self.chunk_size:(index + 1) * self.chunk_size])
+        return self.client.post(reverse_lazy('image_upload'), {
+            'file': chunk, 'upload_id': upload_id, 'dzuuid': file_uuid, 'dzchunkindex': index,
+            'dzchunkbyteoffset': index * self.chunk_size, 'dztotalchunkcount': total_chunks,
+            'dztotalfilesize': len(data), 'dzchunksize': self.chunk_size})
+
+    def finalize(self, upload_id, file_uuid, data, total_chunks):
+        return self.client.post(reverse_lazy('image_upload'), {
+            'upload_id': upload_id, 'dzuuid': file_uuid, 'dzfinalize': '1', 'filename': 'chunked.png',
+            'dztotalchunkcount': total_chunks, 'dztotalfilesize': len(data)})
+
+    def test_chunked_upload(self):
+        upload_id, file_uuid = str(uuid4()), str(uuid4())
+        data = get_image_file(size=(300, 300)).read()
+        total_chunks = -(-len(data) // self.chunk_size)
+        self.assertGreater(total_chunks, 2)
+
+        for index in range(total_chunks - 1):
+            self.assertEqual(200, self.post_chunk(upload_id, file_uuid, data, index, total_chunks).status_code)
+        self.post_chunk(upload_id, file_uuid, data, 0, total_chunks)  # A retried chunk
+
+        # Interrupted before the last chunk
+        self.assertEqual(400, self.finalize(upload_id, file_uuid, data, total_chunks).status_code)
+        self.assertEqual(0, PHOTO_MODEL.objects.count())
+        status = self.client.get(reverse_lazy('image_upload'), {'upload_id': upload_id, 'dzuuid': file_uuid}).json()
+        self.assertEqual(total_chunks - 1, status['next_chunk'])
+
+        self.post_chunk(upload_id, file_uuid, data, total_chunks - 1, total_chunks)
+        self.assertEqual(201, self.finalize(upload_id, file_uuid, data, total_chunks).status_code)
+
+        photo = PHOTO_MODEL.objects.get()
+        self.assertEqual(upload_id, str(UploadedPhotoModel.objects.get().upload_id))
+        with photo.image.open() as image:
+            self.assertEqual(data, image.read())
+        status = self.client.get(reverse_lazy('image_upload'), {'upload_id': upload_id, 'dzuuid': file_uuid}).json()
+        self.assertEqual(0, status['next_chunk'])
+        photo.delete()
+
+    def test_invalid_chunks(self):
+        upload_id, file_uuid = str(uuid4()), str(uuid4())
+        data = get_image_file(size=(300, 300)).read()
+        total_chunks = -(-len(data) // self.chunk_size)
+
+        def post(**params):
+            chunk = SimpleUploadedFile('blob', data[:self.chunk_size])
+            return self.client.post(reverse_lazy('image_upload'), {
+                'file': chunk, 'upload_id': upload_id, 'dzuuid': file_uuid, 'dzchunkindex': 0, 'dzchunkbyteoffset': 0,
+                'dztotalchunkcount': total_chunks, 'dztotalfilesize': len(data), 'dzchunksize': self.chunk_size,
+                **params})
+
+        self.assertEqual(400, post(dzchunkbyteoffset=self.chunk_size).status_code)
+        self.assertEqual(400, post(dztotalchunkcount=total_chunks + 1).status_code)
+        self.assertEqual(400, post(dzchunkindex=total_chunks).status_code)
+        self.assertEqual(400, post(dzchunksize=self.chunk_size * 2).status_code)
+        with mock.patch('photos.chunked_uploads.MAX_UPLOAD_SIZE', len(data) - 1):
+            response = post()
+        self.assertEqual((400, b'The file is too large'), (response.status_code, response.content))
+        self.assertEqual([], self.client.get(reverse_lazy('image_upload'),
+                                             {'upload_id': upload_id, 'dzuuid': file_uuid}).json()['received_chunks'])
+        self.addCleanup(ChunkedUpload(upload_id, file_uuid).delete)
+        self.assertEqual(200, post().status_code)
+
+    def test_invalid_uuid(self):
+        response = self.client.get(reverse_lazy('image_upload'), {'upload_id': str(uuid4()), 'dzuuid': '../../x'})
+        self.assertEqual(400, response.status_code)
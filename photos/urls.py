@@ -1,9 +1,12 @@
 from django.urls import path
-from .views import UploadPhotosView, UploadPhotoApiView, GalleryPhotosView, GalleryListView
+from .views import UploadPhotosView, UploadPhotoApiView, AsyncUploadPhotoApiView, GalleryPhotosView, \
+    GalleryListView, RenditionView
 
 urlpatterns = [
     path('create/', UploadPhotosView.as_view(), name='gallery_create'),
     path('upload/', UploadPhotoApiView.as_view(), name='image_upload'),
+    path('upload/async/', AsyncUploadPhotoApiView.as_view(), name='image_upload_async'),
+    path('renditions/<uuid:pk>/<str:size_name>/', RenditionView.as_view(), name='photo-rendition'),
     path('', GalleryListView.as_view(), name='gallery-list'),
     path('<slug:slug>/', GalleryPhotosView.as_view(), name='gallery-detail'),
 ]
@@ -1,14 +1,32 @@
-from django.http import HttpResponse
+import asyncio
+import logging
+import mimetypes
+import os
+from functools import update_wrapper
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseRedirect, FileResponse, Http404, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import patch_cache_control, patch_vary_headers
 from django.urls import reverse_lazy
+from django.utils.decorators import classonlymethod
 from django.views import generic, View
 from .forms import UploadPhotosToNewGalleryForm
-from .models import PHOTO_MODEL, GALLERY_MODEL
+from .models import PHOTO_MODEL, GALLERY_MODEL, IMAGE_SIZES, EXTRA_FORMATS
+from .renditions import format_mime_type
 from django.core.exceptions import ImproperlyConfigured
 from django.contrib.auth.mixins import PermissionRequiredMixin, LoginRequiredMixin
 from django.utils.translation import ugettext_lazy as _
 from .mixins import StaffRequiredMixin
+from .pagination import KeysetPaginationMixin
+from . import metrics
+from .chunked_uploads import ChunkedUpload
 from .photo_processors.base_processor import get_photo_processor, PhotoProcessingError
 
+logger = logging.getLogger('photos.views')
+
 PHOTO_APP_LABEL = PHOTO_MODEL._meta.app_label
 GALLERY_APP_LABEL = GALLERY_MODEL._meta.app_label
 
@@ -18,6 +36,20 @@ GALLERY_MODEL_NAME = GALLERY_MODEL._meta.model_name
 CREATE_PHOTO_PERMISSION_NAME = '{}.add_{}'.format(PHOTO_APP_LABEL, PHOTO_MODEL_NAME)
 CREATE_GALLERY_PERMISSION_NAME = '{}.add_{}'.format(GALLERY_APP_LABEL, GALLERY_MODEL_NAME)
 
+RENDITION_CACHE_MAX_AGE = getattr(settings, 'PHOTOS_RENDITION_CACHE_MAX_AGE', 60 * 60 * 24 * 365)
+# A redirect points to the current file of the size, which changes when the photo is replaced or its sizes are
+# recreated, so it is cached much shorter than the file itself
+RENDITION_REDIRECT_MAX_AGE = getattr(settings, 'PHOTOS_RENDITION_REDIRECT_MAX_AGE', 60 * 60)
+SERVE_RENDITIONS = getattr(settings, 'PHOTOS_SERVE_RENDITIONS', 'redirect')  # 'redirect' or 'stream'
+PAGE_SIZE = getattr(settings, 'PHOTOS_PAGE_SIZE', 40)
+# Threads of AsyncUploadPhotoApiView that parse the uploads and store the originals, and threads that create their
+# sizes after the response was sent. Both are thread pools of the server process, so they share its GIL: Pillow
+# releases it while decoding, resizing and encoding, but everything else the processor does holds it.
+ASYNC_IO_WORKERS = getattr(settings, 'PHOTOS_ASYNC_IO_WORKERS', 16)
+ASYNC_CPU_WORKERS = getattr(settings, 'PHOTOS_ASYNC_CPU_WORKERS', os.cpu_count() or 1)
+IO_EXECUTOR = ThreadPoolExecutor(max_workers=ASYNC_IO_WORKERS, thread_name_prefix='photos-io')
+CPU_EXECUTOR = ThreadPoolExecutor(max_workers=ASYNC_CPU_WORKERS, thread_name_prefix='photos-cpu')
+
 
 class UploadPhotosView(generic.CreateView):
     form_class = UploadPhotosToNewGalleryForm
@@ -52,10 +84,45 @@ class UploadPhotosWithPermissionView(LoginRequiredMixin, PermissionRequiredMixin
 
 
 class UploadPhotoApiView(View):
+    """
+    Receives the files of the Dropzone widget, either in one request or in chunks (Dropzone's dzuuid, dzchunkindex,
+    dzchunkbyteoffset, dzchunksize, dztotalchunkcount and dztotalfilesize parameters, which every chunk has to agree
+    with). Chunked files are processed when the widget posts dzfinalize.
+    A GET with upload_id and dzuuid returns the chunks that were already received, to resume an upload.
+    """
+    def get(self, request, *args, **kwargs):
+        try:
+            upload = ChunkedUpload(request.GET.get('upload_id'), request.GET.get('dzuuid'))
+        except PhotoProcessingError as e:
+            return HttpResponse(_(e.message), status=400)
+        return JsonResponse(upload.status())
+
+    def handle_chunk(self, request, upload_id):
+        upload = ChunkedUpload(upload_id, request.POST.get('dzuuid'))
+        if 'dzfinalize' not in request.POST:
+            try:
+                upload.write_chunk(int(request.POST['dzchunkindex']), int(request.POST['dzchunkbyteoffset']),
+                                   request.FILES['file'], int(request.POST['dzchunksize']),
+                                   int(request.POST['dztotalchunkcount']), int(request.POST['dztotalfilesize']))
+            except PhotoProcessingError as e:
+                return HttpResponse(_(e.message), status=400)
+            return HttpResponse(status=200)
+
+        if not upload.is_complete(int(request.POST['dztotalchunkcount']), int(request.POST['dztotalfilesize'])):
+            return JsonResponse(upload.status(), status=400)
+        try:
+            with upload.open(os.path.basename(request.POST['filename'])) as file:
+                get_photo_processor().handle_file(file, upload_id)
+        finally:
+            upload.delete()
+        return HttpResponse(status=201)
+
     def post(self, request, *args, **kwargs):
         try:
-            file = request.FILES.get('file')
             upload_id = request.POST.get('upload_id')
+            if 'dzuuid' in request.POST:
+                return self.handle_chunk(request, upload_id)
+            file = request.FILES.get('file')
             get_photo_processor().handle_file(file, upload_id)
             return HttpResponse(status=201)
         except PhotoProcessingError as e:
@@ -64,6 +131,71 @@ class UploadPhotoApiView(View):
             return HttpResponse(_('Something unexpected happened while processing the file'), status=500)
 
 
+def _parse_upload(request):
+    return request.POST, request.FILES  # Parses the multipart body, which the ASGI handler has already received
+
+
+def _handle_upload(file, upload_id):
+    """Runs on IO_EXECUTOR, returns the saved photos whose sizes still have to be created"""
+    try:
+        return get_photo_processor().handle_files([file], upload_id, process=False)
+    finally:
+        connections.close_all()
+
+
+def _process_saved_photo(photo_pk):
+    """Runs on CPU_EXECUTOR, after the upload was answered"""
+    try:
+        get_photo_processor().process_saved_photo(PHOTO_MODEL.objects.get(pk=photo_pk))
+    except Exception as e:
+        logger.error("Couldn't create the sizes of {}: {}".format(photo_pk, e))
+    finally:
+        connections.close_all()
+
+
+class AsyncUploadPhotoApiView(View):
+    """
+    UploadPhotoApiView for ASGI servers. A single photo is stored without holding a thread while the body arrives
+    or the sizes are created: the body is parsed and the photo handled by the photo processor on IO_EXECUTOR, without
+    its sizes, and the response sent. Then the processor creates the sizes on CPU_EXECUTOR. Until then the photo has
+    renditions_ready False, with PHOTOS_LAZY_RENDITIONS its sizes can be shown already.
+    CPU_EXECUTOR is a ThreadPoolExecutor, so creating sizes competes with the server for the GIL, see
+    ASYNC_CPU_WORKERS. Chunks and GETs are handled like UploadPhotoApiView does, in a thread.
+    """
+    @classonlymethod
+    def as_view(cls, **initkwargs):
+        base_view = super().as_view(**initkwargs)
+
+        # A coroutine function, which Django runs as an async view without wrapping it in a thread
+        async def view(request, *args, **kwargs):
+            return await base_view(request, *args, **kwargs)
+        return update_wrapper(view, base_view)
+
+    async def dispatch(self, request, *args, **kwargs):
+        response = super().dispatch(request, *args, **kwargs)
+        return await response if asyncio.iscoroutine(response) else response
+
+    async def get(self, request, *args, **kwargs):
+        return await sync_to_async(UploadPhotoApiView().get)(request, *args, **kwargs)
+
+    async def post(self, request, *args, **kwargs):
+        try:
+            data, files = await sync_to_async(_parse_upload, thread_sensitive=False, executor=IO_EXECUTOR)(request)
+            upload_id, file = data.get('upload_id'), files.get('file')
+            if 'dzuuid' in data or file is None:
+                return await sync_to_async(UploadPhotoApiView().post)(request, *args, **kwargs)
+
+            # A zip is processed completely, a photo is answered as soon as it is saved
+            photos = await sync_to_async(_handle_upload, thread_sensitive=False, executor=IO_EXECUTOR)(file, upload_id)
+            for photo in photos:
+                CPU_EXECUTOR.submit(_process_saved_photo, photo.pk)
+            return HttpResponse(status=201)
+        except PhotoProcessingError as e:
+            return HttpResponse(_(e.message), status=500)
+        except Exception as e:
+            return HttpResponse(_('Something unexpected happened while processing the file'), status=500)
+
+
 class UploadPhotoWithPermissionApiView(LoginRequiredMixin, PermissionRequiredMixin, UploadPhotoApiView):
     permission_required = (CREATE_PHOTO_PERMISSION_NAME,)
 
@@ -72,19 +204,112 @@ class UploadPhotoAdminApiView(UploadPhotoWithPermissionApiView, StaffRequiredMix
     pass
 
 
-class GalleryListView(generic.ListView):
+class AsyncUploadPhotoWithPermissionApiView(LoginRequiredMixin, PermissionRequiredMixin, AsyncUploadPhotoApiView):
+    """
+    AsyncUploadPhotoApiView for users with CREATE_PHOTO_PERMISSION_NAME. The user and the permissions are loaded from
+    the database, so they are checked in a thread before the async dispatch.
+    """
+    permission_required = (CREATE_PHOTO_PERMISSION_NAME,)
+
+    def _denied(self, request):
+        """The response of LoginRequiredMixin and PermissionRequiredMixin for a denied request, None otherwise"""
+        if not request.user.is_authenticated or not self.has_permission():
+            return self.handle_no_permission()
+        return None
+
+    async def dispatch(self, request, *args, **kwargs):
+        denied = await sync_to_async(self._denied)(request)
+        if denied is not None:
+            return denied
+        return await AsyncUploadPhotoApiView.dispatch(self, request, *args, **kwargs)
+
+
+class GalleryListView(KeysetPaginationMixin, generic.ListView):
     model = GALLERY_MODEL
     context_object_name = 'gallery_list'
+    paginate_by = PAGE_SIZE
 
+    def get_queryset(self):
+        return super().get_queryset().select_related('cover_photo')
 
-class GalleryPhotosView(generic.ListView):
+
+class GalleryPhotosView(KeysetPaginationMixin, generic.ListView):
     model = PHOTO_MODEL
     context_object_name = 'photo_list'
+    paginate_by = PAGE_SIZE
 
     def get_queryset(self):
-        return PHOTO_MODEL.objects.filter(galleries__slug=self.kwargs['slug'])
+        # Filtering on the through table's gallery id keeps the gallery table out of the paginated query
+        self.gallery = get_object_or_404(GALLERY_MODEL, slug=self.kwargs['slug'])
+        return PHOTO_MODEL.objects.filter(galleries=self.gallery)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['gallery'] = GALLERY_MODEL.objects.get(slug=self.kwargs['slug'])
+        context['gallery'] = self.gallery
         return context
+
+
+def accepted_media_types(request):
+    """The media types the Accept header names, without the ones it refuses with q=0"""
+    accepted = set()
+    for media_range in request.META.get('HTTP_ACCEPT', '').split(','):
+        media_type, *params = media_range.split(';')
+        params = dict(param.strip().lower().partition('=')[::2] for param in params)
+        try:
+            if float(params.get('q', 1)) <= 0:
+                continue
+        except ValueError:  # An invalid q counts as the default one
+            pass
+        accepted.add(media_type.strip().lower())
+    return accepted
+
+
+class RenditionView(View):
+    """
+    Serves one size of a photo, creating it first if it doesn't exist yet.
+    Set serve to 'stream' to send the file itself instead of redirecting to the storage.
+    The size is served in the first of the extra formats the Accept header explicitly names, e.g. image/webp.
+    """
+    serve = SERVE_RENDITIONS
+    max_age = RENDITION_CACHE_MAX_AGE
+    redirect_max_age = RENDITION_REDIRECT_MAX_AGE
+    formats = EXTRA_FORMATS
+
+    def get(self, request, pk, size_name):
+        if size_name not in IMAGE_SIZES:
+            raise Http404
+        photo = get_object_or_404(PHOTO_MODEL.objects.only('id', 'image', 'renditions', 'perceptual_hash'), pk=pk)
+        entry = photo.get_or_create_size(size_name)
+        response = self.serve_rendition(photo.image.storage, self.select_name(request, entry))
+        max_age = self.redirect_max_age if isinstance(response, HttpResponseRedirect) else self.max_age
+        patch_cache_control(response, public=True, max_age=max_age)
+        if self.formats:
+            patch_vary_headers(response, ('Accept',))
+        return response
+
+    def select_name(self, request, entry):
+        accepted = accepted_media_types(request)
+        variants = entry.get('formats', {})
+        for image_format in self.formats:
+            if image_format in variants and format_mime_type(image_format) in accepted:
+                return variants[image_format]['name']
+        return entry['name']
+
+    def serve_rendition(self, storage, name):
+        if self.serve == 'stream':
+            content_type, encoding = mimetypes.guess_type(name)
+            return FileResponse(storage.open(name), content_type=content_type)
+        return HttpResponseRedirect(storage.url(name))
+
+
+class MetricsView(View):
+    """
+    The metrics of photos.metrics in the Prometheus text format, when PHOTOS_METRICS_BACKEND is
+    'photos.metrics.InMemoryBackend'. Every process has its own metrics, so every process has to be scraped.
+    This view isn't in photos.urls, include it where only the scraper can reach it.
+    """
+    def get(self, request):
+        backend = metrics.get_backend()
+        if not hasattr(backend, 'prometheus_text'):
+            raise Http404
+        return HttpResponse(backend.prometheus_text(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,4 +1,8 @@
 from django import forms
+from django.conf import settings
+
+# Files larger than this are uploaded in chunks of this size, None uploads every file in one request
+UPLOAD_CHUNK_SIZE = getattr(settings, 'PHOTOS_UPLOAD_CHUNK_SIZE', 2 * 1024 * 1024)
 
 
 class DropzoneWidget(forms.widgets.FileInput):
@@ -15,6 +19,9 @@ class DropzoneWidget(forms.widgets.FileInput):
         super().__init__(attrs)
         if options is None:
             options = {}
+        if UPLOAD_CHUNK_SIZE:
+            options = {'chunking': True, 'chunkSize': UPLOAD_CHUNK_SIZE, 'retryChunks': True,
+                       'retryChunksLimit': 3, **options}
         self.options = options
 
     def get_context(self, name, value, attrs):